@@ -3,13 +3,19 @@
 
 import configparser
 import collections
+import contextlib
+import copy
+import hashlib
 import importlib
+import json
 import logging
 import os
 import sys
 import textwrap
+import types
 
 from . import defaultproject
+from . import validators
 
 
 LOG = logging.getLogger('kanzo.backend')
@@ -59,8 +65,199 @@ class Project(object):
                                'project %s' % (self._project, project))
 
 
+def _code_digest(code):
+    """Returns hash of given code object including nested code objects."""
+    digest = hashlib.sha256(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            const = _code_digest(const)
+        digest.update(repr(const).encode('utf-8'))
+    digest.update(repr(code.co_names).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _schema_default(obj):
+    if callable(obj):
+        module = getattr(obj, '__module__', '')
+        func = getattr(obj, '__func__', obj)
+        code = getattr(func, '__code__', None)
+        if code is None:
+            name = getattr(obj, '__qualname__', getattr(obj, '__name__', ''))
+            return '{}.{}'.format(module, name)
+        # lambdas and closures share qualified names, so callables are
+        # identified by their code, captured values and defaults
+        cells = [i.cell_contents for i in func.__closure__ or ()]
+        return '{}:{}:{!r}:{!r}'.format(
+            module, _code_digest(code), cells, func.__defaults__
+        )
+    return repr(obj)
+
+
+class ConfigCache(object):
+    """Cache of validated configuration values. Entries are keyed by content
+    of config file, hash of meta (schema) and given versions of plugins.
+    Entries are kept in memory (shared by all instances, only memory_size
+    recently used entries are kept) and persisted to given directory if it
+    is set.
+    """
+    _memory = collections.OrderedDict()
+    memory_size = 4
+
+    def __init__(self, directory=None, versions=None):
+        self.directory = directory
+        self.versions = versions or {}
+
+    def key(self, path, meta):
+        """Returns cache key for given config file and meta."""
+        digest = hashlib.sha256()
+        if os.path.exists(path):
+            with open(path, 'rb') as confile:
+                digest.update(confile.read())
+        digest.update(
+            json.dumps(meta, sort_keys=True, default=_schema_default).encode()
+        )
+        digest.update(
+            json.dumps(self.versions, sort_keys=True, default=repr).encode()
+        )
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, '{}.json'.format(key))
+
+    def get(self, key):
+        """Returns copy of cached values for given key or None if there
+        are none.
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return copy.deepcopy(self._memory[key])
+        if not self.directory or not os.path.isfile(self._entry_path(key)):
+            return None
+        try:
+            with open(self._entry_path(key)) as entry:
+                values = json.load(entry)
+        except ValueError:
+            LOG.warning('Ignoring corrupted config cache entry %s.' % key)
+            return None
+        self._remember(key, values)
+        return copy.deepcopy(values)
+
+    def _remember(self, key, values):
+        self._memory[key] = values
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def set(self, key, values):
+        """Saves copy of given values under given key."""
+        values = copy.deepcopy(dict(values))
+        self._remember(key, values)
+        if not self.directory:
+            return
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        path = self._entry_path(key)
+        tmppath = '{}.tmp'.format(path)
+        try:
+            # values can contain passwords, so file has to be private
+            fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as entry:
+                json.dump(values, entry)
+        except TypeError:
+            LOG.debug('Config values are not serializable, config cache '
+                      'entry %s is kept only in memory.' % key)
+            os.unlink(tmppath)
+            return
+        os.rename(tmppath, path)
+
+
+def _fuse_processors(key, processors):
+    """Returns single callable running all given processors in chain."""
+    if not processors:
+        return None
+    processors = tuple(processors)
+
+    def process(value, config):
+        debug = LOG.isEnabledFor(logging.DEBUG)
+        for fnc in processors:
+            new_value = fnc(value, key=key, config=config)
+            if debug:
+                LOG.debug('Parameter processor %s(%s, key=%s) changed '
+                          'value.' % (fnc.__name__, value, key))
+            value = new_value
+        return value
+    return process
+
+
+class ParameterPipeline(object):
+    """Processing and validation pipeline of single parameter compiled
+    from parameter's metadata.
+    """
+    __slots__ = ('key', 'is_multi', 'separator', 'options', 'valid_options',
+                 'process', 'validators', 'impure')
+
+    def __init__(self, key, metadata):
+        self.key = key
+        self.is_multi = metadata.get('is_multi', False)
+        self.separator = project.CONFIG_MULTI_PARAMETER_SEPARATOR
+        self.options = metadata.get('options')
+        try:
+            self.valid_options = (
+                frozenset(self.options) if self.options else None
+            )
+        except TypeError:
+            # unhashable options
+            self.valid_options = self.options
+        self.process = _fuse_processors(key, metadata.get('processors'))
+        self.validators = tuple(metadata.get('validators') or ())
+        self.impure = tuple(
+            i for i in self.validators if not getattr(i, 'pure', False)
+        )
+        if metadata.get('regexps'):
+            validators.compile_regexps(metadata['regexps'])
+
+    def _is_option(self, value):
+        try:
+            return value in self.valid_options
+        except TypeError:
+            return value in self.options
+
+    def __call__(self, value, config):
+        """Returns processed and validated value. Raises ValueError
+        if value is invalid.
+        """
+        if self.is_multi:
+            value = [i.strip() for i in value.split(self.separator) if i]
+        else:
+            value = [value]
+        if self.process is not None:
+            value = [self.process(i, config) for i in value]
+        for val in value:
+            if self.valid_options is not None and not self._is_option(val):
+                raise ValueError('Value of parameter %s is not from valid '
+                                 'values %s: %s' % (self.key, self.options,
+                                                     val))
+            self._run_validators(self.validators, val, config)
+        return value if self.is_multi else value[0]
+
+    def _run_validators(self, validators, value, config):
+        for fnc in validators:
+            try:
+                fnc(value, key=self.key, config=config)
+            except ValueError:
+                LOG.debug('Parameter validator %s(%s, key=%s) failed '
+                          'validation.' % (fnc.__name__, value, self.key))
+                raise
+
+    def revalidate(self, value, config):
+        """Runs validators which are not marked pure on given already
+        processed value. Raises ValueError if value is invalid.
+        """
+        for val in (value if self.is_multi else [value]):
+            self._run_validators(self.impure, val, config)
+
+
 class Config(object):
-    def __init__(self, path, meta):
+    def __init__(self, path, meta, cache=None, lazy=False):
         """Class used for reading/writing configuration from/to file given by
         attribute 'path'.
 
@@ -69,17 +266,49 @@ class Config(object):
         {'default': 'default value', 'is_multi': False,
          'processors': [func, func], 'validators': [func, func],
          'usage': 'Description'}
+
+        If 'cache' (ConfigCache object) is given and it contains values
+        validated for the same config file content, meta and plugin versions,
+        parsing, processing and pure validators (see validators.pure) are
+        skipped. Validators which are not pure (eg. checking hostnames
+        or files) are always run.
+
+        If 'lazy' is True, values are validated on first access. Method
+        validate_all has to be called to make sure whole config is valid.
         """
         self._path = path
         self._meta = meta
         self._values = {}
+        # raw values of parameters which were not validated yet
+        self._raw = {}
+        self._validating = set()
+        self._pipelines = {}
+        self._trackers = []
 
         self._config = configparser.SafeConfigParser()
+        self._cache = cache
+        if cache is not None:
+            self._cache_key = cache.key(path, meta)
+            values = cache.get(self._cache_key)
+            if values is not None:
+                LOG.debug('Using cached values of config %s.' % path)
+                self._values.update(values)
+                self._revalidate()
+                return
+
         if os.path.exists(path) and not self._config.read(path):
             raise ValueError('Failed to parse config file %s.' % path)
 
         self._get_values()
-        self._validate_config()
+        if not lazy:
+            self.validate_all()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # compiled pipelines contain closures and trackers are local
+        state['_pipelines'] = {}
+        state['_trackers'] = []
+        return state
 
     def _iter_conf(self):
         for key in sorted(self._meta.keys()):
@@ -117,46 +346,104 @@ class Config(object):
                 )
                 confile.write(fmt.format(**locals()))
 
+    def _get_pipeline(self, key):
+        try:
+            return self._pipelines[key]
+        except KeyError:
+            pipeline = ParameterPipeline(key, self._meta[key])
+            self._pipelines[key] = pipeline
+            return pipeline
+
     def _validate_value(self, key, value):
-        metadata = self._meta[key]
-        # split multi value
-        is_multi = metadata.get('is_multi', False)
-        if is_multi:
-            separator = project.CONFIG_MULTI_PARAMETER_SEPARATOR
-            value = [i.strip() for i in value.split(separator) if i]
-        else:
-            value = [value]
-        options = metadata.get('options')
-        # process value
-        new_value = []
-        for val in value:
-            nv = val
-            for fnc in metadata.get('processors', []):
-                nv = fnc(nv, key=key, config=self)
-                LOG.debug('Parameter processor %s(%s, key=%s) changed '
-                          'value.' % (fnc.__name__, val, key))
-            new_value.append(nv)
-        value = new_value
-        # validate value
-        for val in value:
-            if options and val not in options:
-                raise ValueError('Value of parameter %s is not from valid '
-                                 'values %s: %s' % (key, options, val))
-            for fnc in metadata.get('validators', []):
-                try:
-                    fnc(val, key=key, config=self)
-                except ValueError:
-                    LOG.debug('Parameter validator %s(%s, key=%s) failed '
-                              'validation.' % (fnc.__name__, val, key))
-                    raise
-        return value if is_multi else value.pop()
-
-    def _validate_config(self):
+        return self._get_pipeline(key)(value, self)
+
+    def _revalidate(self):
+        """Runs validators which are not pure on cached values."""
+        self._prefetch_hostnames(self._values)
+        for key in self._meta:
+            if key in self._values:
+                self._get_pipeline(key).revalidate(self._values[key], self)
+
+    def _prefetch_hostnames(self, values=None):
+        """Resolves values of all hostname parameters at once, so that
+        validators do not wait for resolution one by one. Values are raw
+        values by default.
+        """
+        separator = project.CONFIG_MULTI_PARAMETER_SEPARATOR
+        hostnames = []
+        values = self._raw if values is None else values
+        for key, value in values.items():
+            metadata = self._meta[key]
+            if (not value or validators.validate_hostname not in
+                    metadata.get('validators', [])):
+                continue
+            if not isinstance(value, str):
+                # processed value of multi parameter
+                hostnames.extend(i for i in value if i)
+            elif metadata.get('is_multi', False):
+                hostnames.extend(
+                    [i.strip() for i in value.split(separator) if i.strip()]
+                )
+            else:
+                hostnames.append(value)
+        if hostnames:
+            validators.get_resolver().prefetch(hostnames)
+
+    def _validate_key(self, key):
+        if key in self._validating:
+            # parameter is referenced by its own processor or validator
+            return self._raw[key]
+        self._validating.add(key)
+        try:
+            value = self._validate_value(key, self._raw[key])
+        finally:
+            self._validating.discard(key)
+        self._values[key] = value
+        del self._raw[key]
+        return value
+
+    def validate_all(self):
+        """Validates all parameters which were not validated yet. Raises
+        ValueError if any value is invalid.
+        """
+        if not self._raw:
+            return
+        self._prefetch_hostnames()
         for key in self._meta:
-            self._values[key] = self._validate_value(key, self._values[key])
+            if key in self._raw:
+                self._validate_key(key)
+        if self._cache is not None:
+            self._cache.set(self._cache_key, self._values)
 
     def __getitem__(self, key):
-        return self._values[key]
+        for accessed in self._trackers:
+            accessed.add(key)
+        try:
+            return self._values[key]
+        except KeyError:
+            if key not in self._raw:
+                raise
+        return self._validate_key(key)
+
+    @contextlib.contextmanager
+    def track(self):
+        """Context manager yielding set, which is filled with keys
+        of parameters read within the context.
+        """
+        accessed = set()
+        self._trackers.append(accessed)
+        try:
+            yield accessed
+        finally:
+            self._trackers.remove(accessed)
+
+    def diff(self, other):
+        """Returns set of keys of parameters which differ in given config."""
+        changed = set()
+        for key in set(self.keys()) | set(other.keys()):
+            if key not in self or key not in other or self[key] != other[key]:
+                changed.add(key)
+        return changed
 
     def _get_values(self):
         for key in self._meta:
@@ -165,7 +452,7 @@ class Config(object):
                 value = self._config.get(section, variable)
             except (configparser.NoOptionError, configparser.NoSectionError):
                 value = self._meta[key].get('default', None)
-            self._values[key] = value
+            self._raw[key] = value
 
     def __setitem__(self, key, value):
         try:
@@ -175,6 +462,7 @@ class Config(object):
                            'dictionary.' % key)
         # process and validate new value
         self._values[key] = self._validate_value(key, value)
+        self._raw.pop(key, None)
 
     def __contains__(self, item):
         return item in self._meta
@@ -198,7 +486,8 @@ class Config(object):
         return self._meta[key]
 
     def get_validated(self, key):
-        return self._validate_value(key, self._values[key])
+        """Returns processed and validated value of given parameter."""
+        return self[key]
 
 
 project = Project()
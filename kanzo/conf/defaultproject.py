@@ -16,6 +16,22 @@ PROJECT_RUN_TEMPDIR = os.path.join(PROJECT_TEMPDIR, _timestamp)
 # Separator for multiple value parameters
 CONFIG_MULTI_PARAMETER_SEPARATOR = ','
 
+# If validated config values should be cached, so that reloading unchanged
+# config skips parsing, processing and pure validators (validators which are
+# not marked by kanzo.conf.validators.pure are always run). Cache is kept
+# in memory and also persisted to CONFIG_CACHE_DIR if it is set.
+CONFIG_CACHE = False
+CONFIG_CACHE_DIR = None
+
+# Hostname resolution cache settings. Resolved hostnames are cached for
+# HOSTNAME_CACHE_TTL seconds, unresolvable ones for HOSTNAME_CACHE_NEGATIVE_TTL
+# seconds. Cache is persisted to HOSTNAME_CACHE_FILE if it is set.
+HOSTNAME_CACHE_TTL = 300
+HOSTNAME_CACHE_NEGATIVE_TTL = 30
+HOSTNAME_CACHE_FILE = None
+# Count of hostnames resolved concurrently
+HOSTNAME_RESOLVER_WORKERS = 32
+
 # SSH connection settings
 DEFAULT_SSH_USER = 'root'
 DEFAULT_SSH_PORT = 22
@@ -23,6 +39,58 @@ DEFAULT_SSH_PRIVATE_KEY = '~/.ssh/id_rsa'
 
 # SSH reconnect attempts count
 SHELL_RECONNECT_RETRY = 3
+# Delay (seconds) before first reconnect attempt. Delay doubles with each
+# further attempt up to SHELL_RETRY_MAX_DELAY and SHELL_RETRY_JITTER
+# fraction of it is randomized, so that reconnects to flapping host from
+# many greenlets do not synchronize.
+SHELL_RETRY_DELAY = 0.5
+SHELL_RETRY_MAX_DELAY = 30
+SHELL_RETRY_JITTER = 0.5
+
+# Host is marked down after HOST_FAILURE_THRESHOLD consecutive failed SSH
+# connections or commands (command failing after all reconnect attempts
+# counts as single failure) and operations on it fail immediately with
+# kanzo.utils.health.HostDown for HOST_DOWN_COOLDOWN seconds. After that
+# single operation is let through and its result decides whether the host
+# is marked up again, other operations fail until then.
+HOST_FAILURE_THRESHOLD = 3
+HOST_DOWN_COOLDOWN = 60
+
+# Output of commands executed by RemoteShell is kept in memory up to
+# SHELL_OUTPUT_MEMORY_LIMIT bytes per stream and spilled to temporary file
+# above it. Of output exceeding SHELL_OUTPUT_LIMIT bytes per stream only
+# the first and the last half of SHELL_OUTPUT_LIMIT bytes is kept, the rest
+# is dropped. Value None or 0 means unlimited, the whole output is then
+# returned in memory. Limit can be overridden per command by output_limit
+# parameter of RemoteShell.execute, where 0 means unlimited.
+SHELL_OUTPUT_MEMORY_LIMIT = 1024 ** 2
+SHELL_OUTPUT_LIMIT = 16 * 1024 ** 2
+
+# Timeout (s) of each command and script executed on hosts by RemoteShell,
+# None means no timeout (can be overridden per command). Process group
+# of timed out command is killed on host by command which itself has to
+# finish in SHELL_CANCEL_TIMEOUT seconds.
+SHELL_COMMAND_TIMEOUT = None
+SHELL_CANCEL_TIMEOUT = 10
+
+# Execution engine used by controller: 'greenlet' or 'asyncio'. Asyncio engine
+# runs synchronous work of tasks in executor of ASYNCIO_ENGINE_WORKERS workers.
+ENGINE = 'greenlet'
+ASYNCIO_ENGINE_WORKERS = 100
+
+# Count of worker processes across which hosts are partitioned. Each worker
+# owns drones and SSH connections of its hosts. 0 disables sharding.
+CONTROLLER_SHARDS = 0
+
+# If hosts should advance through initialization, Puppet installation and
+# preparation independently (only steps with barrier wait for all hosts)
+# instead of waiting for all hosts to finish each phase.
+PIPELINE_INIT = False
+
+# Size of process pool used for CPU heavy tasks (None means number of CPUs)
+# and thread pool used for blocking tasks.
+PROCESS_POOL_SIZE = None
+THREAD_POOL_SIZE = 10
 
 # List of regular exceptions which are used to catch recognised errors from
 # Puppet logs
@@ -47,6 +115,58 @@ PUPPET_ERROR_SURROGATES = []
 # List of regexp strings to match errors which should be ignored
 PUPPET_ERROR_IGNORE = []
 
+# If Puppet logs of debug runs should be scanned in process pool instead
+# of controller process. Useful when many hosts finish at the same time.
+PUPPET_LOG_SCAN_IN_POOL = False
+
+# Path to file where Puppet run timing metrics are saved after deployment.
+# If None, metrics are saved to puppet-metrics.json in run temporary directory.
+PUPPET_METRICS_FILE = None
+
+# Count of slowest resources recorded in metrics for each Puppet run
+PUPPET_METRICS_SLOWEST = 10
+
+# Path to file where summary of run timing events (durations of phases, steps,
+# markers, SSH command counts and transferred bytes per host) is saved
+# after each part of the run. If None, summary is saved to run-summary.json
+# in run temporary directory.
+RUN_SUMMARY_FILE = None
+
+# Path to file where run timeline in Chrome Trace Event Format (loadable
+# by Perfetto UI or chrome://tracing) is saved after each part of the run.
+# Each host has its own track. If None, trace is not saved unless
+# Controller.save_trace is called.
+TRACE_FILE = None
+
+# Path to file where run metrics (SSH command latency, reconnects, transfer
+# bytes and throughput, Puppet run durations, markers queue and greenlet
+# counts) are written in Prometheus text format, eg. to textfile collector
+# directory of node_exporter. File is rewritten atomically every
+# METRICS_TEXTFILE_INTERVAL seconds while Kanzo is running. If None, metrics
+# are not exported.
+METRICS_TEXTFILE = None
+METRICS_TEXTFILE_INTERVAL = 15
+
+# Count of the hottest functions printed after each profiled part of the run
+# and the pstats sort key used for ordering them (see profile parameter
+# of kanzo.core.main.main)
+PROFILE_TOP = 20
+PROFILE_SORT = 'tottime'
+
+# Regular expressions and their replacements applied to commands of recorded
+# remote sessions, so that volatile parts of commands (names of transfer
+# tarballs, timestamps of builds and temporary directories) do not prevent
+# matching commands of replayed run with recorded ones
+# (see kanzo.utils.sessions)
+SESSION_VOLATILE_PATTERNS = [
+    (r'transfer-[0-9a-f]{8}', 'transfer-*'),
+    (r'\d{8}-\d{6}', '*'),
+]
+
+# Multiplier of recorded durations of remote operations when session
+# is replayed. Value 0 replays session without any delays.
+SESSION_REPLAY_TIME_SCALE = 1.0
+
 # If Kanzo should try to apply all manifests even if one (or more) failed
 # for some reason
 PUPPET_FINISH_ON_ERROR = False
@@ -64,14 +184,34 @@ PUPPET_DEPENDENCY_COMMANDS = [
     'apt-get install -y tar',                # Debian based distros
 ]
 
-# Command to start Puppet agent which will run single installation phase
+# Command to start Puppet agent which will run single installation phase.
+# Fact kanzo_manifest selects manifest's layer in Hiera hierarchy. Run summary
+# and report are saved to {reports} directory for timing metrics.
 PUPPET_APPLY_COMMAND = (
     '( flock {tmpdir}/puppet-run.lock '
-        'puppet apply {debug} {manifest} > {log}.running 2>&1 < /dev/null; '
+        'env FACTER_kanzo_manifest={name} '
+        'puppet apply {debug} '
+            '--lastrunfile {reports}/last_run_summary.yaml '
+            '--lastrunreport {reports}/last_run_report.yaml '
+            '{manifest} > {log}.running 2>&1 < /dev/null; '
         'mv {log}.running {log} '
     ') > /dev/null 2>&1 < /dev/null &'
 )
 
+# Command to fetch Puppet log content from given byte offset. Command has
+# to exit with return code 100 when Puppet run is finished.
+PUPPET_LOG_POLL_COMMAND = (
+    'test -e {log} && {{ tail -c +{offset} {log}; exit 100; }}; '
+    'tail -c +{offset} {log}.running 2>/dev/null; true'
+)
+
+# Seconds between polls of Puppet log while Puppet is running
+PUPPET_LOG_POLL_INTERVAL = 2
+
+# Command to kill Puppet run of given manifest when deployment timeout
+# is reached
+PUPPET_CANCEL_COMMAND = 'pkill -TERM -f "[p]uppet apply .*{manifest}"'
+
 PUPPET_CONFIG = '''
 [main]
 basemodulepath={moduledir}
@@ -88,12 +228,16 @@ HIERA_CONFIG = '''
 :hierarchy:
   - "%{{::fqdn}}"
   - config
-  - {manifest_name}
+  - "%{{::kanzo_manifest}}/host"
+  - "%{{::kanzo_manifest}}/roles"
+  - "%{{::kanzo_manifest}}"
 '''
 
 # Configuration files for Puppet
 # Content variable host is internal variable.
-# All other variables are formated from PUPPET_CONFIGURATION_VALUES dictionary
+# All other variables are formated from PUPPET_CONFIGURATION_VALUES dictionary.
+# Paths are formated the same way as content. HIERA_CONFIG is always saved
+# to path given by 'hiera_config' value, so it is not part of the list.
 PUPPET_CONFIGURATION = [
     ('/etc/puppet/puppet.conf', PUPPET_CONFIG),
 ]
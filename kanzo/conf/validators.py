@@ -3,23 +3,41 @@
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
+import concurrent.futures
+import json
 import os
 import re
 import socket
 import logging
+import time
 
 
-__all__ = ('validate_not_empty', 'validate_integer', 'validate_float',
+__all__ = ('pure', 'validate_not_empty', 'validate_integer', 'validate_float',
            'validate_regexp', 'validate_options', 'validate_ip',
-           'validate_port', 'validate_hostname', 'validate_file')
+           'validate_port', 'validate_hostname', 'validate_file',
+           'HostnameResolver', 'get_resolver', 'compile_regexps')
 
 
+LOG = logging.getLogger('kanzo.backend')
+
+
+def pure(func):
+    """Marks given validator as pure, eg. its result depends only on given
+    value and parameter metadata. Only pure validators are skipped when
+    validated values are loaded from config cache.
+    """
+    func.pure = True
+    return func
+
+
+@pure
 def validate_not_empty(value, key=None, config=None):
     """Raises ValueError if given value is empty."""
     if not value:
         raise ValueError('Empty value is not allowed')
 
 
+@pure
 def validate_integer(value, key=None, config=None):
     """Raises ValueError if given value is not an integer."""
     if not value:
@@ -31,6 +49,7 @@ def validate_integer(value, key=None, config=None):
         raise ValueError('Given value is not an integer: %s' % value)
 
 
+@pure
 def validate_float(value, key=None, config=None):
     """Raises ValueError if given value is not a float."""
     if not value:
@@ -42,21 +61,38 @@ def validate_float(value, key=None, config=None):
         raise ValueError('Given value is not a float: %s' % value)
 
 
+_regexps = {}
+def compile_regexps(regexps):
+    """Returns tuple of compiled regular expressions. Compiled expressions
+    are cached.
+    """
+    regexps = tuple(regexps)
+    try:
+        return _regexps[regexps]
+    except KeyError:
+        compiled = tuple(re.compile(i) for i in regexps)
+        _regexps[regexps] = compiled
+        return compiled
+
+
+@pure
 def validate_regexp(value, key=None, config=None):
     """Raises ValueError if given value doesn't match at least one of regular
-    expressions given in options.
+    expressions given in parameter metadata 'regexps'.
     """
     if not value:
         return
 
-    for regex in config[key]['regexps']:
-        if re.search(regex, value):
+    metadata = config.meta(key) if hasattr(config, 'meta') else config[key]
+    for regex in compile_regexps(metadata['regexps']):
+        if regex.search(value):
             break
     else:
         raise ValueError('Given value does not match required regular '
                          'expression(s): %s' % value)
 
 
+@pure
 def validate_ip(value, key=None, config=None):
     """Raises ValueError if given value is not in IPv4 or IPv6 address."""
     if not value:
@@ -72,6 +108,7 @@ def validate_ip(value, key=None, config=None):
         raise ValueError('Given value is not in IP address format: %s' % value)
 
 
+@pure
 def validate_port(value, key=None, config=None):
     """Raises Value if given value is not a decimal number
     in range (0, 65535).
@@ -87,18 +124,103 @@ def validate_port(value, key=None, config=None):
         raise ValueError('Given value is not in valid port range: %s' % value)
 
 
-_hosts = set()
+class HostnameResolver(object):
+    """Resolves hostnames concurrently and caches results of resolution.
+    Both successful and failed resolutions are cached for given time
+    to live (in seconds). Cache can be persisted to given JSON file.
+    """
+    def __init__(self, ttl=300, negative_ttl=30, cache_file=None,
+                 workers=32, resolve=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache_file = cache_file
+        self.workers = workers
+        self._resolve = resolve or socket.gethostbyname
+        self._cache = {}
+        self.load()
+
+    def load(self):
+        """Loads cache content from cache file if there is any."""
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as cache:
+                content = json.load(cache)
+        except ValueError:
+            LOG.warning('Ignoring corrupted hostname cache file '
+                        '%s.' % self.cache_file)
+            return
+        now = time.time()
+        for hostname, (resolvable, expires) in content.items():
+            if expires > now:
+                self._cache[hostname] = (resolvable, expires)
+
+    def save(self):
+        """Saves cache content to cache file if it is set."""
+        if not self.cache_file:
+            return
+        tmpfile = '{}.tmp'.format(self.cache_file)
+        with open(tmpfile, 'w') as cache:
+            json.dump(self._cache, cache)
+        os.rename(tmpfile, self.cache_file)
+
+    def _cached(self, hostname):
+        entry = self._cache.get(hostname)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    def _lookup(self, hostname):
+        try:
+            self._resolve(hostname)
+            resolvable, ttl = True, self.ttl
+        except (socket.error, UnicodeError):
+            resolvable, ttl = False, self.negative_ttl
+        self._cache[hostname] = (resolvable, time.time() + ttl)
+        return resolvable
+
+    def resolve(self, hostname):
+        """Returns True if given hostname is resolvable, False otherwise."""
+        resolvable = self._cached(hostname)
+        if resolvable is None:
+            resolvable = self._lookup(hostname)
+        return resolvable
+
+    def prefetch(self, hostnames):
+        """Resolves all given hostnames, which are not cached, concurrently
+        and saves results to cache.
+        """
+        missing = set(i for i in hostnames if self._cached(i) is None)
+        if not missing:
+            return
+        LOG.debug('Resolving %s hostname(s) concurrently.' % len(missing))
+        workers = max(1, min(self.workers, len(missing)))
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            list(executor.map(self._lookup, missing))
+        self.save()
+
+
+_resolver = None
+def get_resolver():
+    """Returns hostname resolver configured by project settings."""
+    global _resolver
+    if _resolver is None:
+        from . import project
+        _resolver = HostnameResolver(
+            ttl=project.HOSTNAME_CACHE_TTL,
+            negative_ttl=project.HOSTNAME_CACHE_NEGATIVE_TTL,
+            cache_file=project.HOSTNAME_CACHE_FILE,
+            workers=project.HOSTNAME_RESOLVER_WORKERS,
+        )
+    return _resolver
+
+
 def validate_hostname(value, key=None, config=None):
     """Raises ValueError if given value is not valid hostname."""
     if not value:
         return
-    if value in _hosts:
-        return
 
-    try:
-        socket.gethostbyname(value)
-        _hosts.add(value)
-    except socket.error:
+    if not get_resolver().resolve(value):
         raise ValueError('Given value is not in resolvable hostname: %s'
                          % value)
 
@@ -1,17 +1,24 @@
 # -*- coding: utf-8 -*-
 
 import collections
-import greenlet
+import contextlib
+import functools
+import json
 import logging
 import os
 import tempfile
+import time
 
+from .. import __version__ as KANZO_VERSION
 from .. import conf
 from .. import utils
 
 from . import drones
+from . import engines
 from . import plugins
 from . import puppet
+from . import sharding
+from .engines import run_task_graph, wait_for_runners
 
 
 LOG = logging.getLogger('kanzo.backend')
@@ -30,39 +37,35 @@ PluginData = collections.namedtuple(
 )
 
 
-def wait_for_runners(runners):
-    """Switches between given set of runners until all are finished."""
-    while runners:
-        LOG.debug(
-            'Checking greenlets: {runners}'.format(**locals())
-        )
-        for run in list(runners):
-            if run.dead:
-                runners.remove(run)
-                LOG.debug('Greenlet {run} is dead.'.format(**locals()))
-            else:
-                try:
-                    LOG.debug('Greenlet {run} is alive.'.format(**locals()))
-                    run.switch()
-                except Exception:
-                    # kills remaining greenlets
-                    for i in runners:
-                        LOG.debug('Killing greenlet: {}'.format(i))
-                        i.throw()
-                    raise
-
-
 class Controller(object):
     """Master class which is driving the installation process."""
     def __init__(self, config, work_dir=None, remote_tmpdir=None,
-                 local_tmpdir=None):
+                 local_tmpdir=None, engine=None, shards=None):
+        """Parameter engine selects execution engine ('greenlet', 'asyncio'
+        or engine object, see kanzo.core.engines). Default is project's
+        ENGINE.
+
+        If shards is greater than zero (default is project's
+        CONTROLLER_SHARDS), hosts are partitioned across given count
+        of worker processes, which own hosts' drones and SSH connections
+        (see kanzo.core.sharding).
+        """
         self._callbacks = {}
+        self._summary = None
+        self._exporter = None
+        if conf.project.METRICS_TEXTFILE:
+            self._exporter = utils.metrics.MetricsExporter(
+                conf.project.METRICS_TEXTFILE,
+                interval=conf.project.METRICS_TEXTFILE_INTERVAL,
+            )
+        self._engine = engines.get_engine(engine)
         self._messages = []
 
         work_dir = work_dir or conf.project.PROJECT_TEMPDIR
         os.makedirs(work_dir, mode=0o700, exist_ok=True)
         local_tmpdir = local_tmpdir or conf.project.PROJECT_RUN_TEMPDIR
         os.makedirs(local_tmpdir, mode=0o700, exist_ok=True)
+        self._local_tmpdir = local_tmpdir
 
         # load config files
         self._plugin_modules = plugins.load_all_plugins()
@@ -88,7 +91,30 @@ class Controller(object):
         # creates drone for each deploy host
         self._drones = {}
         self._info = {}
+        self._shards = []
+        if shards is None:
+            shards = conf.project.CONTROLLER_SHARDS
+        if shards:
+            self._shards = sharding.start_shards(
+                utils.config.get_hosts(self._config), shards, self._config,
+                reporter=self._report,
+                drone_kwargs=dict(
+                    work_dir=work_dir,
+                    remote_tmpdir=remote_tmpdir,
+                    local_tmpdir=local_tmpdir,
+                ),
+            )
+            # connections of hosts are owned by workers, so health of hosts
+            # is passed from them
+            utils.events.subscribe(utils.health.track)
+            for shard in self._shards:
+                for host in shard.hosts:
+                    self._drones[host] = sharding.DroneProxy(
+                        shard, host, self._config, self._messages
+                    )
         for host in utils.config.get_hosts(self._config):
+            if host in self._drones:
+                continue
             # connect to host to solve ssh keys as first step
             utils.shell.RemoteShell(host)
             self._drones[host] = drones.Drone(
@@ -96,11 +122,12 @@ class Controller(object):
                 work_dir=work_dir,
                 remote_tmpdir=remote_tmpdir,
                 local_tmpdir=local_tmpdir,
+                reporter=self._report,
             )
 
         # register resources and modules to drones
         for plug in self._plugins:
-            for drone in self._drones:
+            for drone in self._drones.values():
                 for resource in plug.resources:
                     drone.add_resource(resource)
                 for module in plug.modules:
@@ -113,102 +140,299 @@ class Controller(object):
             'waiting': set(),
             'in-progress': set(),
             'finished': set(),
+            'consumed': {},
         }
 
     @classmethod
-    def build_config_obj(cls, config_path, plugin_modules=None):
-        plugin_modules = plugins.load_all_plugins()
+    def build_config_obj(cls, config_path, plugin_modules=None, lazy=False):
+        """Loads config from given file. If lazy is True parameters
+        are validated on first access.
+        """
+        plugin_modules = plugin_modules or plugins.load_all_plugins()
+        cache = None
+        if conf.project.CONFIG_CACHE:
+            versions = plugins.plugin_versions(plugin_modules)
+            versions['kanzo'] = KANZO_VERSION
+            cache = conf.ConfigCache(conf.project.CONFIG_CACHE_DIR, versions)
         return conf.Config(
-            config_path, plugins.meta_builder(plugin_modules)
+            config_path, plugins.meta_builder(plugin_modules), cache=cache,
+            lazy=lazy
         )
 
+    def _report(self, *args, **kwargs):
+        """Passes given status to status callback if it is registered."""
+        callback = self._callbacks.get('status')
+        if callback:
+            callback(*args, **kwargs)
+
+    @contextlib.contextmanager
+    def _instrument(self, name):
+        """Collects events emitted during given part of the run ('init',
+        'deployment' or 'cleanup') and saves run summary afterwards.
+        """
+        if self._summary is None:
+            self._summary = utils.events.RunSummary()
+        callbacks = [self._summary]
+        if self._callbacks.get('event'):
+            callbacks.append(self._callbacks['event'])
+        if self._exporter:
+            callbacks.append(self._exporter)
+            self._exporter.start()
+        for callback in callbacks:
+            utils.events.subscribe(callback)
+        try:
+            with utils.events.span('run', name):
+                yield
+        finally:
+            for callback in callbacks:
+                utils.events.unsubscribe(callback)
+            if self._exporter:
+                self._exporter.stop()
+            self.save_summary()
+            if conf.project.TRACE_FILE:
+                self.save_trace()
+
     def _iter_phase(self, phase):
         for plugin in self._plugins:
             for step in getattr(plugin, '{}_steps'.format(phase)):
                 yield step
 
-    def _run_phase(self, phase, timeout=None, debug=False):
+    def _run_step(self, step, drone):
+        """Runs given step for given drone (see Drone.run_step)."""
+        drone.run_step(step)
+
+    def _install_puppet(self, drone):
+        """Installs and configures Puppet on drone's host and discovers
+        host's info.
+        """
+        drone.init_host()
+        utils.pools.cooperate()
+        self._info[drone.host] = drone.discover()
+        utils.pools.cooperate()
+        drone.configure()
+
+    def _add_step_tasks(self, tasks, steps, after=None, pipeline=False):
+        """Adds (host, step) task of each given step and host to given task
+        graph. Steps which opt in by attribute 'requires' or 'independent'
+        (see plugins.step_graph) and all steps without barrier if pipeline
+        is True are started on host as soon as all their prerequisites are
+        finished on that host. All other steps wait until their
+        prerequisites are finished on all hosts, as if the phase ran step
+        by step. Steps with attribute 'barrier' set to True wait also
+        for tasks given in 'after' on all hosts. Parameter 'after' can
+        contain dictionary {host: set of tasks} which have to be finished
+        before any step is started on host. Fleet-wide dependencies are
+        expressed by join tasks (None, step), which only wait for their
+        prerequisites. Returns set of added join tasks.
+        """
+        after = after or {}
+        joins = set()
+        graph = plugins.step_graph(steps)
+        for step, reqs in graph.items():
+            barrier = getattr(step, 'barrier', False)
+            per_host = not barrier and (
+                pipeline or hasattr(step, 'requires') or
+                hasattr(step, 'independent')
+            )
+            join = None
+            if not per_host:
+                deps = set((h, i) for h in self._drones for i in reqs)
+                if barrier:
+                    for h in self._drones:
+                        deps.update(after.get(h, ()))
+                if deps:
+                    join = (None, step)
+                    tasks[join] = deps
+                    joins.add(join)
+            for host in self._drones:
+                if per_host:
+                    deps = set((host, i) for i in reqs)
+                else:
+                    deps = {join} if join else set()
+                deps.update(after.get(host, ()))
+                tasks[(host, step)] = deps
+        return joins
+
+    def _run_host_phases(self, phases, pipeline=False):
+        """Runs steps of given phases ('init', 'prep' or 'clean') on all hosts.
+        Puppet is installed on hosts after 'init' steps are finished on all
+        hosts. If pipeline is True, Puppet is installed on host right after
+        'init' steps are finished on the host and each host proceeds to steps
+        of next phase as soon as it has finished previous phase, only steps
+        with barrier wait for all hosts.
+        """
+        tasks = collections.OrderedDict()
+        phase_tasks = collections.OrderedDict()
+        internal = set()
+        joins = set()
+        after = None
+        for phase in phases:
+            steps = list(self._iter_phase(phase))
+            added = set(tasks.keys())
+            joins.update(self._add_step_tasks(
+                tasks, steps, after=after, pipeline=pipeline
+            ))
+            if steps:
+                after = dict(
+                    (host, set((host, step) for step in steps))
+                    for host in self._drones
+                )
+            if phase == 'init':
+                # install and configure Puppet on hosts and run discover
+                if not pipeline and after:
+                    # wait until 'init' steps are finished on all hosts
+                    join = (None, self._install_puppet)
+                    tasks[join] = set.union(*after.values())
+                    joins.add(join)
+                    after = dict((host, {join}) for host in self._drones)
+                for host in self._drones:
+                    task = (host, self._install_puppet)
+                    tasks[task] = set((after or {}).get(host, ()))
+                    internal.add(task)
+                after = dict(
+                    (host, {(host, self._install_puppet)})
+                    for host in self._drones
+                )
+            phase_tasks[phase] = set(tasks.keys()) - added
+
+        # count of unfinished tasks of each step and phase for reporting
+        remaining_steps = collections.Counter(
+            step for host, step in tasks
+            if (host, step) not in internal and host is not None
+        )
+        remaining_phases = collections.Counter()
+        phase_of = {}
+        for phase, keys in phase_tasks.items():
+            remaining_phases[phase] = len(keys)
+            phase_of.update((task, phase) for task in keys)
+            if not keys:
+                self._callbacks['status']('phase', phase, 'start')
+                utils.events.emit('phase', phase)
+                self._callbacks['status']('phase', phase, 'end')
+        started = {}
 
-        def _install_puppet(drone):
-            parent = greenlet.getcurrent().parent
-            drone.init_host()
-            parent.switch()
-            self._info[drone._shell.host] = drone.discover()
-            parent.switch()
-            drone.configure()
+        def _run(task):
+            host, step = task
+            phase = phase_of[task]
+            if task in joins:
+                # join task only synchronizes hosts
+                remaining_phases[phase] -= 1
+                return
+            if phase not in started:
+                started[phase] = time.monotonic()
+                self._callbacks['status']('phase', phase, 'start')
+            # host marked down fails the task without full SSH retry cycle,
+            # probing is left to SSH operations of the task
+            utils.health.check(host, probe=False)
+            with utils.events.context(phase=phase, host=host):
+                if task in internal:
+                    with utils.events.span('task', 'puppet-install'):
+                        step(self._drones[host])
+                else:
+                    if step not in started:
+                        started[step] = time.monotonic()
+                        self._callbacks['status'](
+                            'step', step.__name__, 'start',
+                            additional={'messages': self._messages}
+                        )
+                    with utils.events.span(
+                            'step', step.__name__, step=step.__name__):
+                        self._run_step(step, self._drones[host])
+                    remaining_steps[step] -= 1
+                    if not remaining_steps[step]:
+                        self._callbacks['status'](
+                            'step', step.__name__, 'end'
+                        )
+            remaining_phases[phase] -= 1
+            if not remaining_phases[phase]:
+                utils.events.emit('phase', phase, start=started[phase])
+                self._callbacks['status']('phase', phase, 'end')
+
+        self._engine.run_graph(tasks, _run)
+
+    def _run_phase(self, phase, timeout=None, debug=False):
+        if phase != 'plan':
+            return self._run_host_phases([phase])
 
         # phase run
         self._callbacks['status']('phase', phase, 'start')
-        for step in self._iter_phase(phase):
+        phase_span = utils.events.span('phase', phase)
+        with phase_span, utils.events.context(phase=phase):
+            self._plan_deployment()
+            # phase post-run: prepare deployment builds
+            self._engine.run_parallel([
+                utils.events.bind(drone.make_build, host=host)
+                for host, drone in self._drones.items()
+            ])
+        self._callbacks['status']('phase', phase, 'end')
+
+    def _plan_deployment(self):
+        """Runs 'plan' steps and prepares plan of Puppet runs."""
+        for step in self._iter_phase('plan'):
             self._callbacks['status'](
                 'step', step.__name__, 'start',
                 additional={'messages': self._messages}
             )
-            if phase == 'plan':
-                # prepare Puppet runs plan
+            # prepare Puppet runs plan
+            step_span = utils.events.span(
+                'step', step.__name__, step=step.__name__
+            )
+            with step_span, self._config.track() as consumed:
                 records = step(
                     config=self._config,
                     info=self._info,
                     messages=self._messages
                 )
-                records = records or []
-                for host, manifest, marker, prereqs in records:
-                    self._drones[host].add_manifest(manifest)
-                    self._drones[host].add_hiera(manifest)
-                    self._plan['waiting'].add(marker)
-                    self._plan['manifests'].setdefault(marker, []).append(
-                        (host, manifest)
-                    )
-                    self._plan['dependency'].setdefault(marker, set()).update(
-                        prereqs or set()
-                    )
-            else:
-                runners = set()
-                for drone in self._drones.values():
-                    run = greenlet.greenlet(step)
-                    runners.add(run)
-                    run.switch(
-                        shell=drone._shell,
-                        config=self._config,
-                        info=drone.info,
-                        messages=self._messages
-                    )
-                wait_for_runners(runners)
+            records = records or []
+            for host, manifest, marker, prereqs in records:
+                self._drones[host].add_manifest(manifest)
+                self._drones[host].add_hiera(manifest)
+                # config parameters which affect the manifest on host
+                keys = self._plan['consumed'].setdefault(
+                    marker, {}
+                ).setdefault(host, set())
+                keys.update(consumed)
+                keys.update(puppet.get_consumed_keys(manifest))
+                self._plan['waiting'].add(marker)
+                self._plan['manifests'].setdefault(marker, []).append(
+                    (host, manifest)
+                )
+                self._plan['dependency'].setdefault(marker, set()).update(
+                    prereqs or set()
+                )
             self._callbacks['status']('step', step.__name__, 'end')
-        # phase post-run
-        runners = set()
-        for drone in self._drones.values():
-            if phase == 'init':
-                # install and configure Puppet on hosts and run discover
-                run = greenlet.greenlet(_install_puppet)
-                runners.add(run)
-                run.switch(drone)
-            elif phase == 'plan':
-                # prepare deployment builds
-                run = greenlet.greenlet(drone.make_build)
-                runners.add(run)
-                run.switch()
-            else:
-                break
-        wait_for_runners(runners)
-        self._callbacks['status']('phase', phase, 'end')
 
-    def run_init(self, timeout=None, debug=False):
+    def run_init(self, timeout=None, debug=False, pipeline=None):
         """Completely initialize and prepare deploy hosts
 
         As first 'init' phase is executed. After that Puppet is installed
         on all host and hosts' info is discovered. After that 'prep' phase
         is executed and as last phase 'plan' is executed. Deployment builds
         are built and sent to hosts at the end.
+
+        If pipeline is True (default is project's PIPELINE_INIT), each host
+        advances through 'init' phase, Puppet installation and 'prep' phase
+        independently and only steps with barrier wait for all hosts.
         """
-        self._run_phase('init', timeout=timeout, debug=debug)
-        self._run_phase('prep', timeout=timeout, debug=debug)
-        self._run_phase('plan', timeout=timeout, debug=debug)
+        if pipeline is None:
+            pipeline = conf.project.PIPELINE_INIT
+        # make sure whole config is valid before touching hosts
+        self._config.validate_all()
+        with self._instrument('init'):
+            if pipeline:
+                self._run_host_phases(['init', 'prep'], pipeline=True)
+            else:
+                self._run_phase('init', timeout=timeout, debug=debug)
+                self._run_phase('prep', timeout=timeout, debug=debug)
+            self._run_phase('plan', timeout=timeout, debug=debug)
 
     def run_deployment(self, timeout=None, debug=False):
         """Run planned deployment."""
+        with self._instrument('deployment'):
+            self._run_deployment(timeout=timeout, debug=debug)
+
+    def _run_deployment(self, timeout=None, debug=False):
         self._callbacks['status']('phase', 'deployment', 'start')
-        runners = {}
         while self._plan['waiting'] or self._plan['in-progress']:
             # initiate deployment
             for marker, manifests in self._plan['manifests'].items():
@@ -224,34 +448,156 @@ class Controller(object):
                         '{reqs}'.format(**locals())
                     )
                     continue
-                # initiate marker deployment
-                if marker not in runners:
-                    LOG.debug(
-                        'Initiating marked deployment: '
-                        '{marker}'.format(**locals())
-                    )
-                    self._plan['waiting'].remove(marker)
-                    self._plan['in-progress'].add(marker)
-                    for host, manifest in manifests:
-                        run = greenlet.greenlet(self._drones[host].deploy)
-                        runners.setdefault(marker, set()).add(run)
-                        run.switch(manifest, timeout=timeout, debug=debug)
-                wait_for_runners(runners[marker])
-                # check marker deployment end
-                if not runners[marker]:
-                    self._plan['finished'].add(marker)
-                    self._plan['in-progress'].remove(marker)
+                # fail fast if any of marker's hosts is marked down
+                for host, manifest in manifests:
+                    utils.health.check(host, probe=False)
+                # run marker deployment
+                LOG.debug(
+                    'Initiating marked deployment: '
+                    '{marker}'.format(**locals())
+                )
+                self._plan['waiting'].remove(marker)
+                self._plan['in-progress'].add(marker)
+                self._emit_queue()
+                marker_span = utils.events.span(
+                    'marker', marker,
+                    hosts=sorted(set(host for host, _ in manifests)),
+                    requires=sorted(self._plan['dependency'][marker]),
+                )
+                with marker_span, utils.events.context(marker=marker):
+                    self._engine.run_parallel([
+                        utils.events.bind(functools.partial(
+                            self._drones[host].deploy, manifest,
+                            timeout=timeout, debug=debug
+                        ), host=host, manifest=manifest)
+                        for host, manifest in manifests
+                    ])
+                self._plan['finished'].add(marker)
+                self._plan['in-progress'].remove(marker)
+                self._emit_queue()
+        self.save_metrics()
         self._callbacks['status']('phase', 'deployment', 'end')
 
+    def _emit_queue(self):
+        """Emits event with current counts of deployment markers."""
+        finished = self._plan['finished']
+        utils.events.emit(
+            'queue', 'markers',
+            ready=len([
+                i for i in self._plan['waiting']
+                if self._plan['dependency'][i] <= finished
+            ]),
+            waiting=len(self._plan['waiting']),
+            in_progress=len(self._plan['in-progress']),
+            finished=len(finished),
+        )
+
+    def get_metrics(self):
+        """Returns timing metrics of Puppet runs. Result is dictionary
+        containing list of per host metrics of each marker ('runs') and per
+        marker summary ('markers') with the longest run and the longest time
+        spent on each resource type across all hosts.
+        """
+        runs = []
+        markers = {}
+        for marker, manifests in self._plan['manifests'].items():
+            for host, manifest in manifests:
+                metrics = self._drones[host].metrics.get(manifest)
+                if metrics is None:
+                    continue
+                run = dict(metrics, host=host, marker=marker,
+                           manifest=manifest)
+                runs.append(run)
+                summary = markers.setdefault(
+                    marker, {'total': 0.0, 'host': None, 'types': {}}
+                )
+                if metrics['total'] >= summary['total']:
+                    summary['total'] = metrics['total']
+                    summary['host'] = host
+                for rtype, seconds in metrics['types'].items():
+                    summary['types'][rtype] = max(
+                        seconds, summary['types'].get(rtype, 0.0)
+                    )
+        return {'runs': runs, 'markers': markers}
+
+    def save_metrics(self, path=None):
+        """Saves timing metrics of Puppet runs to given JSON file."""
+        path = path or conf.project.PUPPET_METRICS_FILE or os.path.join(
+            self._local_tmpdir, 'puppet-metrics.json'
+        )
+        with open(path, 'w') as metrics_file:
+            json.dump(self.get_metrics(), metrics_file, indent=2)
+        LOG.debug('Saved Puppet metrics to {path}.'.format(**locals()))
+        return path
+
+    def get_summary(self):
+        """Returns summary of events emitted so far during the run (see
+        kanzo.utils.events.RunSummary).
+        """
+        if self._summary is None:
+            self._summary = utils.events.RunSummary()
+        return self._summary.summary()
+
+    def save_summary(self, path=None):
+        """Saves run summary to given JSON file."""
+        path = path or conf.project.RUN_SUMMARY_FILE or os.path.join(
+            self._local_tmpdir, 'run-summary.json'
+        )
+        self.get_summary()
+        return self._summary.save(path)
+
+    def save_trace(self, path=None):
+        """Saves events emitted so far during the run to given file in Chrome
+        Trace Event Format, which can be loaded to Perfetto UI.
+        """
+        path = path or conf.project.TRACE_FILE or os.path.join(
+            self._local_tmpdir, 'run-trace.json'
+        )
+        self.get_summary()
+        return self._summary.save_trace(path)
+
+    def diff(self, config):
+        """Returns markers and hosts which have to be redeployed to apply
+        given config (Config object or path to config file). Result is
+        dictionary {marker: [host, ...]}. Only parameters read by deployment
+        planning steps and manifest templates are taken into account, so
+        deployment has to be planned (see run_init) first.
+        """
+        if not isinstance(config, conf.Config):
+            config = self.build_config_obj(config, self._plugin_modules)
+        changed = self._config.diff(config)
+        LOG.debug('Changed config parameters: {changed}'.format(**locals()))
+        affected = collections.OrderedDict()
+        for marker in self._plan['manifests']:
+            hosts = self._plan['consumed'].get(marker, {})
+            hosts = sorted(
+                host for host, keys in hosts.items() if keys & changed
+            )
+            if hosts:
+                affected[marker] = hosts
+        return affected
+
     def run_cleanup(self):
         """Completely cleans deploy hosts
 
         As first 'clean' phase is executed. At the end all temporary
         directories are deleted.
         """
-        self._run_phase('clean')
-        for drone in self._drones.values():
-            drone.clean()
+        with self._instrument('cleanup'):
+            self._run_phase('clean')
+            for host, drone in self._drones.items():
+                with utils.events.context(phase='clean', host=host):
+                    drone.clean()
+        self.close()
+
+    def close(self):
+        """Stops shard worker processes if there are any and releases
+        resources of execution engine.
+        """
+        for shard in self._shards:
+            shard.close()
+        utils.events.unsubscribe(utils.health.track)
+        self._engine.close()
 
     def register_status_callback(self, callback, calltype='status'):
         """Registers callbacks
@@ -261,5 +607,14 @@ class Controller(object):
         of additional data depending on unit_type.
         For 'status' callback parameter unit_type can contain values:
             'phase', 'step', 'manifest'.
+        Status 'error' of unit_type 'manifest' is reported as soon as errors
+        appear in Puppet log, additional then contains 'host' and 'errors'.
+        Status 'metrics' of unit_type 'manifest' is reported after Puppet run,
+        additional then contains 'host' and 'metrics' (see get_metrics).
+
+        Callback of calltype 'event' accepts single parameter containing
+        event dictionary (see kanzo.utils.events) and receives structured
+        timing events of all units, SSH commands and transfers while
+        the Controller runs.
         """
         self._callbacks[calltype] = callback
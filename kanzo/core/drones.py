@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import codecs
 import collections
 import datetime
-import greenlet
+import gevent
 import logging
 import os
 import shutil
@@ -19,6 +20,64 @@ from . import puppet
 LOG = logging.getLogger('kanzo.backend')
 
 
+class _LazyShell(object):
+    """Shell of steps run in process pool. SSH connection is opened only
+    when the step really runs command on host, steps of class 'cpu' usually
+    need only host name.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self._shell = None
+
+    def _get_shell(self):
+        if self._shell is None:
+            self._shell = utils.shell.RemoteShell(self.host)
+        return self._shell
+
+    def execute(self, *args, **kwargs):
+        return self._get_shell().execute(*args, **kwargs)
+
+    def run_script(self, *args, **kwargs):
+        return self._get_shell().run_script(*args, **kwargs)
+
+
+class _ThreadShell(object):
+    """Shell of steps run in thread pool. Commands are run by drone's shell
+    in greenlet of controller's thread, as SSH connection is bound to its
+    gevent hub.
+    """
+
+    def __init__(self, shell):
+        self.host = shell.host
+        self._shell = shell
+        self._hub = gevent.get_hub()
+
+    def execute(self, *args, **kwargs):
+        return utils.pools.run_in_hub(
+            self._hub, self._shell.execute, *args, **kwargs
+        )
+
+    def run_script(self, *args, **kwargs):
+        return utils.pools.run_in_hub(
+            self._hub, self._shell.run_script, *args, **kwargs
+        )
+
+
+def _run_isolated_step(step, host, config, info):
+    """Runs given step in worker process. Returns host info and messages
+    created by the step.
+    """
+    messages = []
+    step(
+        shell=_LazyShell(host),
+        config=config,
+        info=info,
+        messages=messages
+    )
+    return info, messages
+
+
 class Drone(object):
     """Drone manages host where Puppet agent has to run. It prepares
     environment on host and registers it to Puppet master which is managed
@@ -26,14 +85,21 @@ class Drone(object):
     """
 
     def __init__(self, host, config, messages,
-                 work_dir=None, remote_tmpdir=None, local_tmpdir=None):
+                 work_dir=None, remote_tmpdir=None, local_tmpdir=None,
+                 reporter=None):
         """Initializes drone and host's environment
 
         Parameters remote_tmpdir and local_tmpdir are overrides of parameter
         work_dir. Usually it's enough to set work_dir which is the local base
-        directory for drone and rest is created automatically.
+        directory for drone and rest is created automatically. Parameter
+        reporter is callable with the same interface as status callback
+        of kanzo.core.Controller.
         """
         self.info = {}
+        self.metrics = {}
+        self._next_poll = 0
+        self._messages = messages
+        self._reporter = reporter
         self._modules = set()
         self._resources = set()
         self._hiera = set()
@@ -62,10 +128,51 @@ class Drone(object):
         self._remote_builddir = os.path.join(self._remote_tmpdir, builddir)
         os.mkdir(self._local_builddir, 0o700)
         for subdir in (
-                'modules', 'resources', 'manifests', 'logs', 'hieradata'
+                'modules', 'resources', 'manifests', 'logs', 'hieradata',
+                'reports'
             ):
             os.mkdir(os.path.join(self._local_builddir, subdir), 0o700)
 
+    @property
+    def host(self):
+        return self._shell.host
+
+    def run_step(self, step):
+        """Runs given plugin step for drone's host according to step's
+        execution class. Steps of class 'cpu' and 'blocking' are run in pools
+        and other tasks keep running until they are finished.
+        """
+        execution = getattr(step, 'execution', 'io')
+        kwargs = dict(
+            config=self._config, info=self.info, messages=self._messages
+        )
+        if execution == 'blocking':
+            # pool threads do not share event context with controller
+            step = utils.events.bind(step)
+        if execution == 'io':
+            return step(shell=self._shell, **kwargs)
+        LOG.debug(
+            'Running {execution} step {step.__name__} on host '
+            '{self.host} in pool.'.format(**locals())
+        )
+        if execution == 'blocking':
+            future = utils.pools.get_pool('thread').submit(
+                step, shell=_ThreadShell(self._shell), **kwargs
+            )
+            return utils.pools.wait_for(future)
+        if execution == 'cpu':
+            future = utils.pools.get_pool('process').submit(
+                _run_isolated_step, step, self.host, self._config, self.info
+            )
+            info, messages = utils.pools.wait_for(future)
+            self.info.update(info)
+            self._messages.extend(messages)
+            return
+        raise ValueError(
+            'Unknown execution class {execution} of step '
+            '{step.__name__}.'.format(**locals())
+        )
+
     def init_host(self):
         """Installs Puppet and other dependencies required for installation"""
         for cmd in project.PUPPET_INSTALLATION_COMMANDS:
@@ -127,11 +234,22 @@ class Drone(object):
         return conf_dict
 
     def configure(self):
-        """Creates and saves Puppet configuration files."""
+        """Creates and saves Puppet configuration files and Hiera
+        configuration.
+        """
+        context = self._get_configuration_context()
+        if 'hiera_config' not in context:
+            raise ValueError(
+                'Project setting PUPPET_CONFIGURATION_VALUES has to contain '
+                'path of Hiera configuration (hiera_config).'
+            )
         for path, content in project.PUPPET_CONFIGURATION:
             self._create_remote_file(
-                path, content.format(**self._get_configuration_context())
+                path.format(**context), content.format(**context)
             )
+        self._create_remote_file(
+            context['hiera_config'], project.HIERA_CONFIG.format(**context)
+        )
 
     def add_module(self, path):
         """Registers Puppet module."""
@@ -159,13 +277,20 @@ class Drone(object):
         )
         self._resources.add(path)
 
-    def add_manifest(self, name):
-        """Renders manifest right into the build."""
-        path = puppet.render_manifest(
+    def add_manifest(self, name, path=None):
+        """Renders manifest right into the build. If path is given, manifest
+        is expected to be rendered there already and it is only registered.
+        """
+        path = path or puppet.render_manifest(
             name,
             tmpdir=os.path.join(self._local_builddir, 'manifests'),
             config=self._config
         )
+        # directory for Puppet run summary and report of the manifest
+        os.makedirs(
+            os.path.join(self._local_builddir, 'reports', name),
+            mode=0o700, exist_ok=True
+        )
         LOG.debug(
             'Registering manifest {name} ({path}) to drone '
             'of host {self._shell.host}'.format(**locals())
@@ -173,31 +298,28 @@ class Drone(object):
         self._manifests.append(path)
 
     def add_hiera(self, name):
-        """Renders hiera file right into the build."""
-        path = puppet.render_hiera(
-            name,
-            tmpdir=os.path.join(self._local_builddir, 'hieradata'),
-        )
+        """Registers hiera file, which will be rendered to the build
+        together with host's overlays when the build is created.
+        """
         LOG.debug(
-            'Registering hiera {name} ({path}) to drone '
+            'Registering hiera {name} to drone '
             'of host {self._shell.host}'.format(**locals())
         )
-        self._hiera.add(path)
+        self._hiera.add(name)
 
     def make_build(self):
         """Creates and transfers deployment build to remote temporary
         directory.
         """
-        parent = greenlet.getcurrent().parent
         LOG.debug('Creating build {self._local_builddir}.'.format(**locals()))
-        self._create_build(self._local_builddir)
-        if parent:
-            parent.switch()
-        LOG.debug(
-            'Transferring build {self._local_builddir} for host '
-            '{self._shell.host}.'.format(**locals())
-        )
-        self._transfer.send(self._local_builddir, self._remote_builddir)
+        with utils.events.span('build', self._local_builddir, host=self.host):
+            self._create_build(self._local_builddir)
+            utils.pools.cooperate()
+            LOG.debug(
+                'Transferring build {self._local_builddir} for host '
+                '{self._shell.host}.'.format(**locals())
+            )
+            self._transfer.send(self._local_builddir, self._remote_builddir)
 
     def _create_build(self, builddir):
         """Creates deployment resources build."""
@@ -223,73 +345,221 @@ class Drone(object):
                     shutil.copytree(build_file, dest)
                 else:
                     shutil.copy(build_file, subdir)
+        # render registered hiera files including host's overlays
+        for name in self._hiera:
+            path = puppet.render_hiera(
+                name,
+                tmpdir=os.path.join(builddir, 'hieradata'),
+                host=host
+            )
+            LOG.debug(
+                'Adding hiera {name} ({path}) to build '
+                'of host {host}.'.format(**locals())
+            )
 
-    def _create_manifest_hiera(self, name):
-        # update hiera.yaml config
-        conf_dict = self._get_configuration_context()
-        conf_dict['manifest_name'] = name
-        self._create_remote_file(
-            project.PUPPET_CONFIGURATION_VALUES['hiera_config'],
-            project.HIERA_CONFIG.format(**conf_dict)
-        )
-        # create <manifest_name>.yaml data file
-        self._create_remote_file(
-            os.path.join(
-                self._remote_builddir, 'hieradata', '{}.yaml'.format(name)
-            ),
-            puppet._hieralib.dump(name),
-        )
+    def _polled(self):
+        """Marks Puppet log as polled now."""
+        self._next_poll = time.monotonic() + project.PUPPET_LOG_POLL_INTERVAL
+
+    def _wait(self):
+        """Waits until next poll of Puppet log is due. In controller's
+        greenlet cooperate only switches to parent greenlet, so other tasks
+        run until the poll interval passes.
+        """
+        while True:
+            left = self._next_poll - time.monotonic()
+            if left <= 0:
+                break
+            utils.pools.cooperate(left)
+
+    def _check_timeout(self, name, deadline):
+        """Returns seconds remaining to given deadline of Puppet run
+        or None if there is no deadline.
+        """
+        try:
+            return utils.shell.remaining(deadline)
+        except utils.shell.ExecutionTimeout:
+            raise utils.shell.ExecutionTimeout(
+                'Timeout reached while deploying manifest {name} '
+                'on {self._shell.host}.'.format(**locals())
+            )
+
+    def _stream_log(self, name, log, local_log, deadline):
+        """Polls growing Puppet log and checks it until Puppet finishes."""
+        host = self._shell.host
+        checker = puppet.LogChecker(local_log)
+        # offset has to be counted in received bytes, multibyte characters
+        # can be split between polls
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        offset = 1
+        with open(local_log, 'w') as logfile:
+            while True:
+                left = self._check_timeout(name, deadline)
+                LOG.debug(
+                    'Polling log {log} on host {host}.'.format(**locals())
+                )
+                self._polled()
+                # output is not limited, so that offset matches the log
+                rc, stdout, stderr = self._shell.execute(
+                    project.PUPPET_LOG_POLL_COMMAND.format(**locals()),
+                    can_fail=False, log=False, output_limit=0, timeout=left,
+                    decode=False
+                )
+                offset += len(stdout)
+                finished = rc == 100
+                content = decoder.decode(stdout, final=finished)
+                logfile.write(content)
+                self._report_errors(name, checker.feed(content))
+                if finished:
+                    # log was moved, which means apply finished
+                    break
+                self._wait()
+        reported = len(checker.result.errors)
+        result = checker.close()
+        self._report_errors(name, result.errors[reported:])
+        return result
+
+    def _scan_log(self, name, log, local_log, deadline):
+        """Waits until Puppet finishes, fetches whole log and scans it."""
+        host = self._shell.host
+        while True:
+            left = self._check_timeout(name, deadline)
+            try:
+                LOG.debug(
+                    'Polling log {log} on host {host}.'.format(**locals())
+                )
+                self._polled()
+                self._transfer.receive(
+                    log, os.path.dirname(local_log), timeout=left
+                )
+            except ValueError:
+                # log does not exists which means apply did not finish yet
+                self._wait()
+            else:
+                break
+        if project.PUPPET_LOG_SCAN_IN_POOL:
+            future = utils.pools.get_pool('process').submit(
+                puppet.scan_log, local_log
+            )
+            result = utils.pools.wait_for(future)
+        else:
+            result = puppet.LogChecker.scan(local_log)
+        self._report_errors(name, result.errors)
+        return result
 
     def deploy(self, name, timeout=None, debug=False):
-        """Applies Puppet manifest given by name."""
-        debug = '--debug' if debug else ''
+        """Applies Puppet manifest given by name. Puppet log is validated
+        while it grows, so errors are reported while Puppet is still running.
+        Debug logs tend to be huge, so in debug mode whole log is fetched
+        after Puppet finishes and memory-mapped log is scanned instead.
+        Raises RuntimeError containing all errors found in the log. If Puppet
+        run does not finish in given timeout, it is killed and
+        ExecutionTimeout is raised. Returns log validation result.
+        """
+        with utils.events.span('apply', name, host=self.host):
+            return self._deploy(name, timeout=timeout, debug=debug)
+
+    def _deploy(self, name, timeout=None, debug=False):
+        deadline = utils.shell.get_deadline(timeout)
         tmpdir = self._remote_builddir
         host = self._shell.host
         log = (
             '{self._remote_builddir}/logs/{name}.log'.format(**locals())
         )
         manifest = (
-            '{self._remote_builddir}/manifests/{name}'.format(**locals())
+            '{self._remote_builddir}/manifests/{name}.pp'.format(**locals())
+        )
+        reports = (
+            '{self._remote_builddir}/reports/{name}'.format(**locals())
         )
-        # prepare manifest specific hiera file
-        self._create_manifest_hiera(name)
         # spawn Puppet process
         LOG.debug(
             'Applying manifest "{name}" (remote path: {manifest}) on host '
             '{self._shell.host}.'.format(**locals())
         )
-        cmd = project.PUPPET_APPLY_COMMAND.format(**locals())
+        cmd = project.PUPPET_APPLY_COMMAND.format(
+            **dict(locals(), debug='--debug' if debug else '')
+        )
         LOG.debug(
             'Running command {cmd} on host {host}.'.format(**locals())
         )
-        self._shell.execute(cmd)
-        # wait till Puppet process finishes
+        self._shell.execute(cmd, timeout=self._check_timeout(name, deadline))
+        # wait till Puppet process finishes and check the log
         local_log = '{self._local_builddir}/logs/{name}.log'.format(
             **locals()
         )
-        start_time = time.time()
-        while True:
-            if timeout and (timeout >= time.time() - start_time):
-                raise RuntimeError(
-                    'Timeout reached while deploying manifest {name} '
-                    'on {host}.'.format(**locals())
-                )
-            try:
-                LOG.debug(
-                    'Polling log {log} on host {host}.'.format(**locals())
-                )
-                self._transfer.receive(log, local_log)
-            except ValueError:
-                # log does not exists which means apply did not finish yet
-                parent = greenlet.getcurrent().parent
-                if parent:
-                    parent.switch()
-                else:
-                    # for cases when deployment is not run in separate green
-                    # thread, we just wait sleep
-                    time.sleep(2)
-            else:
-                return puppet.LogChecker.validate(local_log)
+        check = self._scan_log if debug else self._stream_log
+        try:
+            result = check(name, log, local_log, deadline)
+        except utils.shell.ExecutionTimeout:
+            self._cancel(name, manifest, log)
+            raise
+        self._fetch_metrics(name, reports)
+        result.raise_for_errors()
+        return result
+
+    def _cancel(self, name, manifest, log):
+        """Kills Puppet run of given manifest."""
+        host = self._shell.host
+        LOG.warning(
+            'Killing Puppet run of manifest {name} on host '
+            '{host}.'.format(**locals())
+        )
+        try:
+            self._shell.execute(
+                project.PUPPET_CANCEL_COMMAND.format(**locals()),
+                can_fail=False, timeout=project.SHELL_CANCEL_TIMEOUT
+            )
+        except RuntimeError as ex:
+            LOG.warning(
+                'Failed to kill Puppet run of manifest {name} on host '
+                '{host}: {ex}'.format(**locals())
+            )
+
+    def _fetch_metrics(self, name, reports):
+        """Fetches Puppet run summary and report of given manifest and parses
+        timing metrics from them.
+        """
+        host = self._shell.host
+        local_reports = os.path.join(self._local_builddir, 'reports')
+        # metrics are best-effort, failure to get them must not fail the run
+        try:
+            self._transfer.receive(reports, local_reports)
+        except (ValueError, OSError, RuntimeError) as ex:
+            LOG.warning(
+                'Failed to fetch Puppet run report of manifest {name} '
+                'from host {host}: {ex}'.format(**locals())
+            )
+            return
+        local_reports = os.path.join(local_reports, name)
+        self.metrics[name] = metrics = puppet.parse_run_report(
+            os.path.join(local_reports, 'last_run_summary.yaml'),
+            os.path.join(local_reports, 'last_run_report.yaml')
+        )
+        LOG.debug(
+            'Puppet run of manifest {name} on host {host} took '
+            '{metrics[total]:.2f}s.'.format(**locals())
+        )
+        if self._reporter:
+            self._reporter(
+                'manifest', name, 'metrics',
+                additional={'host': host, 'metrics': metrics}
+            )
+
+    def _report_errors(self, name, errors):
+        if not errors:
+            return
+        host = self._shell.host
+        for error in errors:
+            LOG.error(
+                'Puppet error on host {host} in manifest {name} (line '
+                '{error.lineno}): {error.message}'.format(**locals())
+            )
+        if self._reporter:
+            self._reporter(
+                'manifest', name, 'error',
+                additional={'host': host, 'errors': errors}
+            )
 
     def clean(self):
         """Removes all temporary files."""
@@ -306,3 +576,11 @@ class Drone(object):
             '{self._local_builddir}'.format(**locals())
         )
         shutil.rmtree(self._local_builddir, ignore_errors=True)
+
+    # async variants of drone lifecycle for asyncio based tooling
+    init_host_async = utils.decorators.asynchronous(init_host)
+    discover_async = utils.decorators.asynchronous(discover)
+    configure_async = utils.decorators.asynchronous(configure)
+    make_build_async = utils.decorators.asynchronous(make_build)
+    deploy_async = utils.decorators.asynchronous(deploy)
+    clean_async = utils.decorators.asynchronous(clean)
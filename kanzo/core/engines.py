@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+"""Execution engines used by Controller for running tasks on hosts
+concurrently.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import greenlet
+import logging
+
+from ..conf import project
+
+
+LOG = logging.getLogger('kanzo.backend')
+
+
+def wait_for_runners(runners):
+    """Switches between given set of runners until all are finished."""
+    while runners:
+        LOG.debug(
+            'Checking greenlets: {runners}'.format(**locals())
+        )
+        for run in list(runners):
+            if run.dead:
+                runners.remove(run)
+                LOG.debug('Greenlet {run} is dead.'.format(**locals()))
+            else:
+                try:
+                    LOG.debug('Greenlet {run} is alive.'.format(**locals()))
+                    run.switch()
+                except Exception:
+                    # kills remaining greenlets
+                    for i in runners:
+                        LOG.debug('Killing greenlet: {}'.format(i))
+                        i.throw()
+                    raise
+
+
+def run_task_graph(graph, run):
+    """Runs callable 'run' in separate greenlet for each task of given graph
+    as soon as all task's prerequisites are finished. Graph has to be ordered
+    dictionary {task: set of prerequisite tasks}. Task is passed to 'run'
+    as the only argument.
+    """
+    waiting = collections.OrderedDict(graph)
+    finished = set()
+    runners = collections.OrderedDict()
+    while waiting or runners:
+        for task, reqs in list(waiting.items()):
+            if reqs <= finished:
+                del waiting[task]
+                run_task = greenlet.greenlet(run)
+                runners[run_task] = task
+                LOG.debug('Starting task {task}.'.format(**locals()))
+                run_task.switch(task)
+        if not runners:
+            raise RuntimeError(
+                'Tasks with unsatisfiable prerequisites: '
+                '{}'.format(list(waiting.keys()))
+            )
+        for run_task, task in list(runners.items()):
+            try:
+                if not run_task.dead:
+                    run_task.switch()
+            except Exception:
+                # kills remaining greenlets
+                for i in runners:
+                    LOG.debug('Killing greenlet: {}'.format(i))
+                    i.throw()
+                raise
+            if run_task.dead:
+                del runners[run_task]
+                finished.add(task)
+                LOG.debug('Task {task} is finished.'.format(**locals()))
+
+
+def check_task_graph(graph):
+    """Raises RuntimeError if given task graph contains tasks with
+    prerequisites, which cannot be satisfied.
+    """
+    waiting = collections.OrderedDict(graph)
+    finished = set()
+    while waiting:
+        ready = [task for task, reqs in waiting.items() if reqs <= finished]
+        if not ready:
+            raise RuntimeError(
+                'Tasks with unsatisfiable prerequisites: '
+                '{}'.format(list(waiting.keys()))
+            )
+        for task in ready:
+            del waiting[task]
+            finished.add(task)
+
+
+class GreenletEngine(object):
+    """Engine running each task in separate greenlet. Tasks have to switch
+    to parent greenlet (see kanzo.utils.pools.cooperate) when waiting.
+    """
+    name = 'greenlet'
+
+    def run_graph(self, graph, run):
+        """Runs callable 'run' for each task of given graph as soon as
+        task's prerequisites are finished (see run_task_graph).
+        """
+        run_task_graph(graph, run)
+
+    def run_parallel(self, calls):
+        """Runs given callables concurrently and waits for all of them."""
+        runners = set()
+        for call in calls:
+            run = greenlet.greenlet(call)
+            runners.add(run)
+            run.switch()
+        wait_for_runners(runners)
+
+    def close(self):
+        """Greenlet engine does not hold any resources."""
+
+
+class AsyncioEngine(object):
+    """Engine running each task as asyncio task. Synchronous work of tasks
+    is run in executor, so the event loop stays free for asyncio based
+    tooling. Async variants of RemoteShell, transfer and Drone methods
+    (*_async) use the same executor.
+    """
+    name = 'asyncio'
+
+    def __init__(self, loop=None, workers=None):
+        self._loop = loop
+        self._workers = workers or project.ASYNCIO_ENGINE_WORKERS
+        self._executor = None
+
+    @property
+    def loop(self):
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                self._workers
+            )
+            self._loop.set_default_executor(self._executor)
+        return self._loop
+
+    def run(self, coroutine):
+        """Runs given coroutine in engine's event loop."""
+        return self.loop.run_until_complete(coroutine)
+
+    async def run_graph_async(self, graph, run):
+        """Coroutine running callable 'run' in executor for each task
+        of given graph as soon as task's prerequisites are finished.
+        """
+        check_task_graph(graph)
+        loop = asyncio.get_running_loop()
+        tasks = {}
+
+        async def _run(task):
+            if graph[task]:
+                await asyncio.gather(*[tasks[i] for i in graph[task]])
+            LOG.debug('Starting task {task}.'.format(**locals()))
+            await loop.run_in_executor(None, run, task)
+            LOG.debug('Task {task} is finished.'.format(**locals()))
+
+        for task in graph:
+            tasks[task] = asyncio.ensure_future(_run(task))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            # cancels remaining tasks
+            for i in tasks.values():
+                i.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+
+    async def run_parallel_async(self, calls):
+        """Coroutine running given callables concurrently in executor."""
+        graph = collections.OrderedDict((i, set()) for i in range(len(calls)))
+        await self.run_graph_async(graph, lambda index: calls[index]())
+
+    def run_graph(self, graph, run):
+        self.run(self.run_graph_async(graph, run))
+
+    def run_parallel(self, calls):
+        self.run(self.run_parallel_async(calls))
+
+    def close(self):
+        """Closes engine's event loop and executor."""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+ENGINES = {
+    GreenletEngine.name: GreenletEngine,
+    AsyncioEngine.name: AsyncioEngine,
+}
+
+
+def get_engine(engine=None):
+    """Returns engine object for given engine name or object. If engine
+    is not given project's ENGINE is used.
+    """
+    engine = engine or project.ENGINE
+    if not isinstance(engine, str):
+        return engine
+    try:
+        return ENGINES[engine]()
+    except KeyError:
+        raise ValueError(
+            'Unknown engine {engine}. Valid engines are: '
+            '{engines}'.format(engine=engine, engines=', '.join(ENGINES))
+        )
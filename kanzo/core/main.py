@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
 import sys
 
-from ..utils import set_logging
+from ..conf import project
+from ..utils import profiling, sessions, set_logging
 from .controller import Controller
 
 
@@ -16,15 +18,42 @@ def simple_reporter(unit_type, unit_name, unit_status, additional=None):
 
 def main(config_path, log_path=None, debug=False, timeout=None,
          reporter=simple_reporter, work_dir=None, remote_tmpdir=None,
-         local_tmpdir=None):
-    """This default main function can be used by project runner."""
+         local_tmpdir=None, profile=None, record=None, replay=None):
+    """This default main function can be used by project runner.
+
+    If profile is set, each part of the run (init, deployment and cleanup)
+    is profiled and its profile is saved to profile-<part>.pstats in run
+    temporary directory. Value True selects yappi profiler if it is
+    installed and cProfile otherwise, values 'cprofile' and 'yappi' select
+    given profiler.
+
+    If record is set, all remote operations are recorded to given session
+    file. If replay is set, remote operations are not run on hosts, but
+    results recorded in given session file are served instead
+    (see kanzo.utils.sessions).
+    """
     set_logging(logfile=log_path, loglevel='DEBUG' if debug else 'INFO')
-    ctrl = Controller(config_path,
-        work_dir=work_dir,
-        local_tmpdir=local_tmpdir,
-        remote_tmpdir=remote_tmpdir
-    )
-    ctrl.register_status_callback(reporter)
-    ctrl.run_init(debug=debug, timeout=timeout)
-    ctrl.run_deployment(debug=debug, timeout=timeout)
-    ctrl.run_cleanup()
+    with contextlib.ExitStack() as stack:
+        if record:
+            stack.enter_context(sessions.recording(record))
+        if replay:
+            stack.enter_context(sessions.replaying(replay))
+        ctrl = Controller(config_path,
+            work_dir=work_dir,
+            local_tmpdir=local_tmpdir,
+            remote_tmpdir=remote_tmpdir
+        )
+        ctrl.register_status_callback(reporter)
+        profile_dir = local_tmpdir or project.PROJECT_RUN_TEMPDIR
+
+        def _profiled(name):
+            if not profile:
+                return contextlib.nullcontext()
+            return profiling.profiled(name, profile_dir, backend=profile)
+
+        with _profiled('init'):
+            ctrl.run_init(debug=debug, timeout=timeout)
+        with _profiled('deployment'):
+            ctrl.run_deployment(debug=debug, timeout=timeout)
+        with _profiled('cleanup'):
+            ctrl.run_cleanup()
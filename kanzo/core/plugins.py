@@ -54,3 +54,71 @@ def meta_builder(plugins):
                 raise ValueError('Duplicated parameter found: %s.' % key)
             meta[key] = parameter
     return meta
+
+
+def plugin_versions(plugins):
+    """Returns dictionary containing version of each given plugin module.
+    Plugins without __version__ attribute are versioned by modification time
+    and size of their source file.
+    """
+    versions = {}
+    for plg in plugins:
+        version = getattr(plg, '__version__', None)
+        path = getattr(plg, '__file__', None)
+        if version is None and path and os.path.isfile(path):
+            stat = os.stat(path)
+            version = '{0.st_mtime}-{0.st_size}'.format(stat)
+        versions[plg.__name__] = version
+    return versions
+
+
+def step_graph(steps):
+    """Returns ordered dictionary {step: set of prerequisite steps} for given
+    list of steps. Prerequisites can be set by step attribute 'requires'
+    (list of steps or their names). Steps with attribute 'independent' set
+    to True do not have any prerequisites. All other steps require all steps
+    preceding them (and controller runs them only after the preceding steps
+    are finished on all hosts). Raises ValueError if prerequisite is not
+    in given steps or if dependencies are cyclic.
+    """
+    names = dict((step.__name__, step) for step in steps)
+    graph = collections.OrderedDict()
+    for index, step in enumerate(steps):
+        requires = getattr(step, 'requires', None)
+        if requires is not None:
+            reqs = set()
+            for req in requires:
+                req = names.get(req, req) if isinstance(req, str) else req
+                if req not in steps:
+                    raise ValueError(
+                        'Prerequisite {req} of step {step.__name__} is not '
+                        'part of the phase.'.format(**locals())
+                    )
+                reqs.add(req)
+        elif getattr(step, 'independent', False):
+            reqs = set()
+        else:
+            reqs = set(steps[:index])
+        graph[step] = reqs
+
+    # check for cycles
+    finished = set()
+    for step in graph:
+        path = [step]
+        stack = [iter(graph[step])]
+        while stack:
+            for req in stack[-1]:
+                if req in path:
+                    raise ValueError(
+                        'Cyclic dependency of steps: {}'.format(
+                            ' -> '.join(i.__name__ for i in path + [req])
+                        )
+                    )
+                if req not in finished:
+                    path.append(req)
+                    stack.append(iter(graph[req]))
+                    break
+            else:
+                finished.add(path.pop())
+                stack.pop()
+    return graph
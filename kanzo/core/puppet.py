@@ -4,11 +4,15 @@ from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
 import collections
+import collections.abc
 import jinja2
+import jinja2.meta
 import logging
+import mmap
 import os
 import re
 import tempfile
+import types
 import yaml
 
 from ..conf import project, Config
@@ -18,116 +22,499 @@ LOG = logging.getLogger('kanzo.backend')
 
 
 #---------------------------- log handling ------------------------------------
+LogError = collections.namedtuple('LogError', ['lineno', 'line', 'message'])
+
+
+class LogResult(object):
+    """Result of Puppet log validation."""
+    def __init__(self, path=None):
+        self.path = path
+        self.lines = 0
+        self.errors = []
+
+    @property
+    def failed(self):
+        return bool(self.errors)
+
+    def raise_for_errors(self):
+        """Raises RuntimeError containing all found errors if there is any."""
+        if self.errors:
+            raise RuntimeError(
+                '\n'.join([error.message for error in self.errors])
+            )
+
+
+_named_group = re.compile(r'\(\?P<\w+>')
+# numbered or named backreference which is not escaped
+_backreference = re.compile(r'(?<!\\)(?:\\\\)*\\(?:[1-9]|g<)|\(\?P=')
+def _compile_rules(ignore, surrogates):
+    """Compiles ignore and surrogate rules into single pattern. Each rule
+    is wrapped in named lookahead, so the first matching rule in given order
+    wins no matter where in the line it matched. Returns None if rules
+    cannot be combined (for example they use backreferences).
+    """
+    branches = []
+    for prefix, patterns in (('ignore', ignore), ('surrogate', surrogates)):
+        for index, pattern in enumerate(patterns):
+            if _backreference.search(pattern):
+                # group numbers change in combined pattern
+                LOG.debug('Puppet log rule {pattern} uses backreference, '
+                          'rules will be evaluated one by one.'.format(
+                              **locals()))
+                return None
+            # inner group names would clash across rules
+            pattern = _named_group.sub('(?:', pattern)
+            branches.append(
+                '(?=.*?(?P<{prefix}{index}>{pattern}))'.format(**locals())
+            )
+    if not branches:
+        return None
+    try:
+        return re.compile('^(?:{})'.format('|'.join(branches)))
+    except re.error:
+        LOG.debug('Failed to combine Puppet log rules, rules will be '
+                  'evaluated one by one.')
+        return None
+
+
 class LogChecker(object):
-    color = re.compile('\x1b.*?\d\dm')
+    """Validates Puppet log. Log can be fed by chunks while it grows
+    or validated at once by calling classmethod validate.
+    """
+    color = re.compile('\x1b\[[\d;]*m')
     errors = re.compile('|'.join(project.PUPPET_ERRORS))
+    # error patterns without line anchors, which are used to find candidate
+    # lines in not yet preprocessed text
+    prefilter = re.compile(
+        '|'.join([i.lstrip('^') for i in project.PUPPET_ERRORS])
+    )
+    prefilter_bytes = re.compile(prefilter.pattern.encode('utf-8'))
     ignore = [re.compile(i)
               for i in project.PUPPET_ERROR_IGNORE]
     surrogates = [(re.compile(i[0]), i[1])
                   for i in project.PUPPET_ERROR_SURROGATES]
+    rules = _compile_rules(
+        project.PUPPET_ERROR_IGNORE,
+        [i[0] for i in project.PUPPET_ERROR_SURROGATES]
+    )
+
+    def __init__(self, path=None):
+        self._buffer = ''
+        self.result = LogResult(path)
 
     def _preproces(self, line):
         return self.color.sub('', line.strip())  # remove colors
 
-    def _check_ignore(self, line):
-        skip = False
-        for ign in self.ignore:
+    def _match_rule(self, line):
+        if self.rules is not None:
+            match = self.rules.match(line)
+            return match.lastgroup if match else None
+        for index, ign in enumerate(self.ignore):
             if ign.search(line):
-                LOG.debug('Ignoring expected Puppet: %s' % line)
-                skip = True
+                return 'ignore{}'.format(index)
+        for index, (regex, surrogate) in enumerate(self.surrogates):
+            if regex.search(line):
+                return 'surrogate{}'.format(index)
+        return None
+
+    def _surrogate(self, index, line):
+        regex, surrogate = self.surrogates[index]
+        match = regex.search(line)
+        args = {}
+        num = 1
+        while True:
+            try:
+                args['arg%d' % num] = match.group(num)
+                num += 1
+            except IndexError:
                 break
-        return skip
+        return surrogate % args
 
-    def _check_surrogates(self, line):
-        for regex, surrogate in self.surrogates:
-            match = regex.search(line)
+    def check_line(self, line):
+        """Returns error message if given log line contains an error,
+        otherwise returns None.
+        """
+        line = self._preproces(line)
+        if self.errors.search(line) is None:
+            return None
+        rule = self._match_rule(line)
+        if rule is None:
+            return line
+        if rule.startswith('ignore'):
+            LOG.debug('Ignoring expected Puppet: %s' % line)
+            return None
+        return self._surrogate(int(rule[len('surrogate'):]), line)
+
+    def _scan(self, text):
+        """Checks only lines containing candidate for error in given text,
+        which has to consist of complete lines.
+        """
+        found = []
+        lineno = self.result.lines
+        position = 0
+        while True:
+            match = self.prefilter.search(text, position)
             if match is None:
-                continue
-
-            args = {}
-            num = 1
-            while True:
-                try:
-                    args['arg%d' % num] = match.group(num)
-                    num += 1
-                except IndexError:
-                    break
-            return surrogate % args
-        return line
-
-    def validate(self, path):
+                break
+            start = text.rfind('\n', 0, match.start()) + 1
+            end = text.find('\n', match.end())
+            end = len(text) if end < 0 else end
+            lineno += text.count('\n', position, start)
+            line = text[start:end]
+            message = self.check_line(line)
+            if message is not None:
+                found.append(LogError(lineno + 1, line, message))
+            position = end
+        self.result.lines += text.count('\n')
+        self.result.errors.extend(found)
+        return found
+
+    def feed(self, chunk):
+        """Checks complete lines of given log chunk, incomplete trailing
+        line is kept until next chunk comes. Returns list of errors found
+        in the chunk.
+        """
+        text = self._buffer + chunk
+        end = text.rfind('\n') + 1
+        self._buffer = text[end:]
+        return self._scan(text[:end])
+
+    def close(self):
+        """Checks rest of the fed log and returns validation result."""
+        if self._buffer:
+            self._scan(self._buffer + '\n')
+            self._buffer = ''
+        return self.result
+
+    @classmethod
+    def scan(cls, path, window=16 * 1024 * 1024):
+        """Scans given Puppet log file without reading it line by line.
+        File is memory-mapped and error prefilter runs over raw bytes,
+        so only candidate lines are decoded and evaluated. Returns validation
+        result.
+        """
+        checker = cls(path)
+        result = checker.result
+
+        def count_lines(mapped, start, end):
+            count = 0
+            for pos in range(start, end, window):
+                count += mapped[pos:min(pos + window, end)].count(b'\n')
+            return count
+
+        with open(path, 'rb') as logfile:
+            if not os.fstat(logfile.fileno()).st_size:
+                return result
+            mapped = mmap.mmap(logfile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                position = 0
+                while True:
+                    match = cls.prefilter_bytes.search(mapped, position)
+                    if match is None:
+                        break
+                    start = mapped.rfind(b'\n', 0, match.start()) + 1
+                    end = mapped.find(b'\n', match.end())
+                    end = len(mapped) if end < 0 else end
+                    result.lines += count_lines(mapped, position, start)
+                    line = mapped[start:end].decode('utf-8', 'replace')
+                    message = checker.check_line(line)
+                    if message is not None:
+                        result.errors.append(
+                            LogError(result.lines + 1, line, message)
+                        )
+                    position = end
+                result.lines += count_lines(mapped, position, len(mapped))
+                if not mapped[-1:] == b'\n':
+                    result.lines += 1
+            finally:
+                mapped.close()
+        return result
+
+    @classmethod
+    def validate(cls, path, chunk_size=1024 * 1024):
         """Check given Puppet log file for errors and raise RuntimeError
-        if there is any error.
+        containing all errors if there is any. Returns validation result.
         """
+        checker = cls(path)
         with open(path) as logfile:
-            for line in logfile:
-                line = self._preproces(line)
-                if self.errors.search(line) is None:
-                    continue
-                if self._check_ignore(line):
-                    continue
-                raise RuntimeError(self._check_surrogates(line))
+            for chunk in iter(lambda: logfile.read(chunk_size), ''):
+                checker.feed(chunk)
+        result = checker.close()
+        result.raise_for_errors()
+        return result
+
+
+def scan_log(path):
+    """Scans given Puppet log file and returns validation result. Suitable
+    for running in process pool.
+    """
+    return LogChecker.scan(path)
+
+
+#--------------------------- report handling ---------------------------------
+class _ReportLoader(yaml.SafeLoader):
+    """YAML loader for Puppet state files, which ignores Ruby object tags."""
+
+
+def _construct_ruby_object(loader, suffix, node):
+    if isinstance(node, yaml.MappingNode):
+        return loader.construct_mapping(node, deep=True)
+    if isinstance(node, yaml.SequenceNode):
+        return loader.construct_sequence(node, deep=True)
+    return loader.construct_scalar(node)
+_ReportLoader.add_multi_constructor('!ruby/', _construct_ruby_object)
+
+
+def _load_state_file(path):
+    if not path or not os.path.isfile(path):
+        return {}
+    with open(path) as statefile:
+        return yaml.load(statefile, Loader=_ReportLoader) or {}
+
+
+# keys of time section of Puppet run summary which are not resource types
+_RUN_PHASES = frozenset([
+    'catalog_application', 'config_retrieval', 'convert_catalog',
+    'fact_generation', 'node_retrieval', 'plugin_sync', 'startup_time',
+    'transaction_evaluation',
+])
+
+
+def parse_run_report(summary_path=None, report_path=None, slowest=None):
+    """Parses Puppet last run summary and last run report files and returns
+    timing metrics of the run as dictionary containing keys 'total' (seconds),
+    'types' (dict of seconds spent per resource type), 'phases' (dict
+    of seconds spent in phases of the run, eg. config_retrieval) and 'slowest'
+    (list of [resource, seconds] pairs sorted from the slowest resource).
+    """
+    slowest = project.PUPPET_METRICS_SLOWEST if slowest is None else slowest
+    summary = _load_state_file(summary_path)
+    report = _load_state_file(report_path)
+
+    times = dict(summary.get('time') or {})
+    total = times.pop('total', None)
+    times.pop('last_run', None)
+    phases = dict(
+        (key, float(times.pop(key))) for key in list(times)
+        if key in _RUN_PHASES
+    )
+
+    resources = []
+    for resource, status in (report.get('resource_statuses') or {}).items():
+        seconds = float((status or {}).get('evaluation_time') or 0)
+        resources.append([resource, seconds])
+        if not summary:
+            # summary is missing, so we have to count times from report
+            rtype = resource.split('[', 1)[0].lower().replace('::', '_')
+            times[rtype] = times.get(rtype, 0.0) + seconds
+    resources.sort(key=lambda i: i[1], reverse=True)
+    if total is None:
+        total = sum(times.values()) + sum(phases.values())
+    return {
+        'total': float(total),
+        'types': dict((k, float(v)) for k, v in times.items()),
+        'phases': phases,
+        'slowest': resources[:slowest],
+    }
 
 
 #--------------------------- Hiera handling -----------------------------------
 class HieraYAMLLibrary(object):
-    """Holds content of Hiera YAML files."""
+    """Holds content of Hiera YAML files.
+
+    Content of each file is layered. Common layer is shared by all hosts,
+    role and host layers are sparse overlays holding only overridden keys.
+    Per-host views are chained over shared layers, so no data is copied
+    until the host build is rendered and even then only keys differing
+    from lower layers are written.
+    """
     def __init__(self):
         self._content = {}
+        self._roles = {}
+        self._hosts = {}
+        self._host_roles = {}
+
+    def _layer(self, name, host=None, role=None):
+        if host and role:
+            raise ValueError('Hiera overlay can be either host or role '
+                             'specific, not both.')
+        common = self._content.setdefault(name, {})
+        if host:
+            return self._hosts.setdefault(name, {}).setdefault(host, {})
+        if role:
+            return self._roles.setdefault(name, {}).setdefault(role, {})
+        return common
+
+    def _lower_layers(self, name, host):
+        layers = []
+        roles = self._roles.get(name, {})
+        # later assigned roles take precedence
+        for role in reversed(self._host_roles.get(host, [])):
+            if role in roles:
+                layers.append(roles[role])
+        layers.append(self._content.get(name, {}))
+        return layers
+
+    def set(self, name, key, value, host=None, role=None):
+        """Adds hiera setting (key, value) to file 'name'. Setting is stored
+        to host or role overlay if host or role is given.
+        """
+        self._layer(name, host=host, role=role)[key] = value
+
+    def get(self, name, key, host=None):
+        """Returns hiera setting (key) in file 'name' as seen by given
+        host.
+        """
+        return self.view(name, host=host)[key]
+
+    def set_dict(self, name, content, host=None, role=None):
+        """Adds hiera settings (content) dictonary to file 'name'. Settings
+        are stored to host or role overlay if host or role is given.
+        """
+        self._layer(name, host=host, role=role).update(content)
 
-    def set(self, name, key, value):
-        """Adds hiera setting (key, value) to file 'name'."""
-        self._content.setdefault(name, {})[key] = value
+    def assign_role(self, host, role):
+        """Assigns role to given host. Role overlays are applied in order
+        of assignment, so later assigned roles override former ones.
+        """
+        roles = self._host_roles.setdefault(host, [])
+        if role not in roles:
+            roles.append(role)
 
-    def get(self, name, key):
-        """Returns hiera setting (key) in file 'name'."""
-        self._content[name][key]
+    def view(self, name, host=None):
+        """Returns read-only view of file 'name' content merged from all
+        layers relevant for given host. Layers are not copied.
+        """
+        layers = self._lower_layers(name, host)
+        if host:
+            layers.insert(0, self._hosts.get(name, {}).get(host, {}))
+        return collections.ChainMap(
+            *[types.MappingProxyType(i) for i in layers]
+        )
 
-    def set_dict(self, name, content):
-        """Adds hiera settings (content) dictonary to file 'name'."""
-        self._content.setdefault(name, {}).update(content)
+    def overlays(self, name, host):
+        """Returns list of (layer, content) tuples of overlays of file 'name'
+        for given host. Overlays contain only keys which values differ
+        from values in lower layers.
+        """
+        result = []
+        common = self._content.get(name, {})
+        lower = self._lower_layers(name, host)
+        roles = collections.ChainMap(*lower[:-1])
+        diff = dict(
+            (k, v) for k, v in roles.items()
+            if k not in common or common[k] != v
+        )
+        if diff:
+            result.append(('roles', diff))
+        lower = collections.ChainMap(*lower)
+        overlay = self._hosts.get(name, {}).get(host, {})
+        diff = dict(
+            (k, v) for k, v in overlay.items()
+            if k not in lower or lower[k] != v
+        )
+        if diff:
+            result.append(('host', diff))
+        return result
 
-    def dump(self, name):
-        """Returns hiera file content"""
+    def _dump(self, content):
         return yaml.dump(
-            self._content[name],
+            content,
             explicit_start=True,
             default_flow_style=False
         )
 
-    def render(self, name, tmpdir=None):
-        """Write hiera file to given temporary directory."""
+    def dump(self, name):
+        """Returns hiera file content"""
+        return self._dump(self._content[name])
+
+    def render(self, name, tmpdir=None, host=None):
+        """Write hiera file to given temporary directory. If host is given
+        also host's overlays are written to subdirectory 'name'. Returns
+        path to the file of common layer.
+        """
         path = os.path.join(tmpdir, '{}.yaml'.format(name))
-        with open(path, 'w') as manifest:
-            manifest.write(self.dump(name))
+        with open(path, 'w') as hierafile:
+            hierafile.write(self._dump(self._content.get(name, {})))
+        if host is None:
+            return path
+        overlays = self.overlays(name, host)
+        if overlays:
+            os.makedirs(os.path.join(tmpdir, name), exist_ok=True)
+        for layer, content in overlays:
+            layerpath = os.path.join(tmpdir, name, '{}.yaml'.format(layer))
+            with open(layerpath, 'w') as hierafile:
+                hierafile.write(self._dump(content))
         return path
 
 
 _hieralib = HieraYAMLLibrary()
-def update_hiera(name, content):
+def update_hiera(name, content, host=None, role=None):
     """This function should be used to dynamicaly insert configuration
-    in Hiera YAML files.
+    in Hiera YAML files. Content is stored to host or role overlay
+    if host or role is given.
     """
-    _hieralib.set_dict(name, content)
+    _hieralib.set_dict(name, content, host=host, role=role)
 
 
-def update_hiera_single(name, variable, value):
+def update_hiera_single(name, variable, value, host=None, role=None):
     """This function should be used to dynamicaly insert configuration
-    in Hiera YAML files.
+    in Hiera YAML files. Value is stored to host or role overlay
+    if host or role is given.
+    """
+    _hieralib.set(name, variable, value, host=host, role=role)
+
+
+def assign_hiera_role(host, role):
+    """Assigns role to host, so that role's Hiera overlays are used
+    on the host.
     """
-    _hieralib.set(name, variable, value)
+    _hieralib.assign_role(host, role)
 
 
-def render_hiera(name, tmpdir=None):
-    return _hieralib.render(name, tmpdir=tmpdir)
+def render_hiera(name, tmpdir=None, host=None):
+    return _hieralib.render(name, tmpdir=tmpdir, host=host)
 
 
-def render_whole_hiera(tmpdir=None):
+def render_whole_hiera(tmpdir=None, host=None):
     for name in _hieralib._content.keys():
-        yield name, render_hiera(name, tmpdir)
+        yield name, render_hiera(name, tmpdir, host=host)
+
+
+def export_hiera():
+    """Returns picklable content of all Hiera YAML files."""
+    return dict(_hieralib.__dict__)
+
+
+def import_hiera(content):
+    """Replaces content of all Hiera YAML files with content exported
+    by export_hiera (for example in other process).
+    """
+    _hieralib.__dict__.update(content)
 
 
 #------------------------------ Manifest handling -----------------------------
+class _TrackedMapping(collections.abc.Mapping):
+    """Read-only view of given mapping, which records keys read from it."""
+    def __init__(self, mapping, accessed):
+        self._mapping = mapping
+        self._accessed = accessed
+
+    def __getitem__(self, key):
+        value = self._mapping[key]
+        self._accessed.add(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self._mapping
+
+    def __iter__(self):
+        return iter(self._mapping.keys())
+
+    def __len__(self):
+        return len(self._mapping.keys())
+
+
 class ManifestLibrary(object):
     """Objects of this class are used to glue single manifest template
     from small manifest templates. Resulting manifest template can be rendered
@@ -140,6 +527,9 @@ class ManifestLibrary(object):
         if not os.path.isdir(self.TMP_FRAGMENTS):
             os.makedirs(self.TMP_FRAGMENTS)
         self._manifests = {}
+        self._consumed = {}
+        # names of undeclared variables referenced by each template
+        self._references = {}
         template_dirs = project.PUPPET_MANIFEST_TEMPLATE_DIRS
         template_dirs.append(self.TMP_FRAGMENTS)
         loader = jinja2.FileSystemLoader(searchpath=template_dirs)
@@ -162,15 +552,44 @@ class ManifestLibrary(object):
     def dump(self, name, config=None):
         """Concatenates fragments of manifests, renders the resulting template
         with fragments' context and given config and returns rendered content.
+        Config parameters are accessible in templates directly and via
+        variable 'config'. Keys of config parameters read by templates are
+        recorded (see consumed).
         """
+        config = config or {}
+        consumed = self._consumed[name] = set()
+        tracked = _TrackedMapping(config, consumed)
         content = ''
         for path, context, fragment_hiera in self._manifests[name]:
-            context = context or {}
-            context.update(config)
             template = self._env.get_template(path)
-            content += template.render(**context)
+            # config parameters take precedence over fragment's context
+            variables = collections.ChainMap(
+                config, {'config': tracked}, context or {}
+            )
+            content += template.render(variables)
+            # parameters read directly (not via 'config' variable)
+            consumed.update(
+                i for i in self._referenced(path) if i in config
+            )
         return content
 
+    def _referenced(self, path):
+        """Returns names of undeclared variables referenced by template
+        given by path.
+        """
+        if path not in self._references:
+            source = self._env.loader.get_source(self._env, path)[0]
+            self._references[path] = jinja2.meta.find_undeclared_variables(
+                self._env.parse(source)
+            )
+        return self._references[path]
+
+    def consumed(self, name):
+        """Returns keys of config parameters read by the last render
+        of given manifest.
+        """
+        return frozenset(self._consumed.get(name, ()))
+
     def render(self, name, tmpdir=None, config=None):
         """Renders manifest from all fragments and saves it to given temporary
         directory."""
@@ -210,6 +629,11 @@ def render_manifest(name, tmpdir=None, config=None):
     return _manifestlib.render(name, tmpdir=tmpdir, config=config)
 
 
+def get_consumed_keys(name):
+    """Returns keys of config parameters consumed by given manifest."""
+    return _manifestlib.consumed(name)
+
+
 def render_all_manifests(tmpdir=None, config=None):
     for name in _manifestlib._manifests.keys():
         yield name, render_manifest(name, tmpdir=tmpdir, config=config)
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+"""Sharded mode of Controller. Hosts are partitioned across worker processes,
+each worker owns drones (and so SSH connections) of its hosts. Controller
+keeps scheduling in parent process and talks to drones via proxies.
+"""
+
+import gevent
+import gevent.hub
+import gevent.monkey
+import gevent.socket
+import greenlet
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.reduction
+import os
+import pickle
+import socket
+import traceback
+
+from .. import utils
+
+from . import drones
+from . import puppet
+
+
+LOG = logging.getLogger('kanzo.backend')
+
+
+# functions callable in shard worker without drone
+_WORKER_FUNCTIONS = {
+    'import_hiera': puppet.import_hiera,
+}
+
+
+# seconds between checks whether worker process is alive while waiting
+# for its response
+_ALIVE_CHECK_INTERVAL = 1
+
+# Connection.poll is patched by gevent to switch greenlets, so another
+# greenlet could start reading the same message in the meantime
+_select = gevent.monkey.get_original('select', 'select')
+
+
+class _Sender(object):
+    """Sends messages to given connection from dedicated OS thread, so that
+    greenlets sending (possibly large) messages do not block whole process
+    on full pipe while the other side is sending to us too. Messages are
+    pickled by caller, so pickling errors are raised to it.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._queue = gevent.monkey.get_original('queue', 'SimpleQueue')()
+        self._finished = gevent.monkey.get_original(
+            '_thread', 'allocate_lock'
+        )()
+        self._finished.acquire()
+        gevent.monkey.get_original('_thread', 'start_new_thread')(
+            self._run, ()
+        )
+
+    def _run(self):
+        try:
+            while True:
+                data = self._queue.get()
+                if data is None:
+                    break
+                try:
+                    self._conn.send_bytes(data)
+                except (OSError, EOFError):
+                    # the other side is gone, which is detected by receiver
+                    break
+        finally:
+            self._finished.release()
+
+    def send(self, obj):
+        """Pickles given object and queues it for sending."""
+        self._queue.put(multiprocessing.reduction.ForkingPickler.dumps(obj))
+
+    def close(self, timeout=10):
+        """Sends all queued messages and stops sending thread."""
+        self._queue.put(None)
+        if self._finished.acquire(timeout=timeout):
+            self._finished.release()
+
+
+def _serve(conn, hosts, config, drone_kwargs):
+    """Main function of shard worker process. Handles requests from parent
+    process until None is received.
+    """
+    utils.pools.init_worker()
+    sender = _Sender(conn)
+    messages = {}
+    shard_drones = {}
+
+    def report(*args, **kwargs):
+        sender.send(('report', None, (args, kwargs), None))
+
+    def forward(event):
+        sender.send(('event', None, event, None))
+    utils.events.subscribe(forward)
+
+    for host in hosts:
+        messages[host] = []
+        shard_drones[host] = drones.Drone(
+            host, config, messages[host], reporter=report, **drone_kwargs
+        )
+
+    def handle(request_id, host, method, args, kwargs, context):
+        try:
+            with utils.events.context(**context):
+                if host is None:
+                    result = _WORKER_FUNCTIONS[method](*args, **kwargs)
+                else:
+                    result = getattr(shard_drones[host], method)
+                    if callable(result):
+                        result = result(*args, **kwargs)
+            response = ['result', request_id, result, None]
+        except Exception as ex:
+            LOG.debug(traceback.format_exc())
+            response = ['error', request_id, ex, None]
+        if host is not None:
+            # pass host's state changed by the request to parent
+            response[3] = {
+                'info': shard_drones[host].info,
+                'messages': list(messages[host]),
+            }
+            del messages[host][:]
+        try:
+            sender.send(tuple(response))
+        except (pickle.PicklingError, TypeError, AttributeError) as ex:
+            response[0:3] = ['error', request_id, RuntimeError(
+                'Failed to pass result of {method} to controller: '
+                '{ex}'.format(**locals())
+            )]
+            sender.send(tuple(response))
+
+    running = []
+    while True:
+        gevent.socket.wait_read(conn.fileno())
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        running = [i for i in running if not i.dead]
+        running.append(gevent.spawn(handle, *request))
+    gevent.joinall(running)
+    utils.events.unsubscribe(forward)
+    sender.close()
+    conn.close()
+
+
+class Shard(object):
+    """Parent's end of shard worker process."""
+
+    def __init__(self, index, hosts, config, reporter=None,
+                 drone_kwargs=None):
+        self.hosts = hosts
+        self._reporter = reporter
+        self._results = {}
+        self._counter = itertools.count()
+        self._hiera_imported = False
+        context = multiprocessing.get_context('fork')
+        self._conn, child_conn = context.Pipe()
+        # pipe is created from gevent sockets, which are non-blocking, but
+        # messages are sent from dedicated threads (see _Sender) and received
+        # only when available, so both ends can block
+        for conn in (self._conn, child_conn):
+            os.set_blocking(conn.fileno(), True)
+        self._process = context.Process(
+            target=_serve,
+            args=(child_conn, hosts, config, drone_kwargs or {}),
+            name='kanzo-shard-{}'.format(index),
+            daemon=True,
+        )
+        self._process.start()
+        child_conn.close()
+        self._sender = _Sender(self._conn)
+        LOG.debug(
+            'Started shard {index} (pid {self._process.pid}) for hosts: '
+            '{hosts}'.format(**locals())
+        )
+
+    @property
+    def pid(self):
+        return self._process.pid
+
+    def _dispatch(self):
+        """Processes all messages received from worker."""
+        while _select([self._conn], [], [], 0)[0]:
+            try:
+                kind, request_id, payload, extra = self._conn.recv()
+            except EOFError:
+                # worker is gone, caller checks whether it is alive
+                break
+            if kind == 'report':
+                if self._reporter:
+                    args, kwargs = payload
+                    self._reporter(*args, **kwargs)
+                continue
+            if kind == 'event':
+                utils.events.publish(payload)
+                continue
+            self._results[request_id] = (kind, payload, extra)
+
+    def call(self, host, method, *args, **kwargs):
+        """Calls given method of drone of given host (or worker function
+        if host is None) in worker process. Returns tuple (kind, result,
+        extra), where kind is 'result' or 'error'. Current event context
+        is passed to the worker.
+        """
+        request_id = next(self._counter)
+        self._sender.send(
+            (request_id, host, method, args, kwargs, utils.events.current())
+        )
+        while True:
+            self._dispatch()
+            if request_id in self._results:
+                return self._results.pop(request_id)
+            if not self._process.is_alive():
+                raise RuntimeError(
+                    'Shard worker of hosts {self.hosts} died.'.format(
+                        **locals()
+                    )
+                )
+            self._wait()
+
+    def _wait(self):
+        """Waits until there is a message from worker. When called from
+        greenlet run by controller (see kanzo.core.engines.GreenletEngine)
+        control is switched to parent greenlet instead.
+        """
+        parent = greenlet.getcurrent().parent
+        if parent is not None and not isinstance(parent, gevent.hub.Hub):
+            utils.pools.cooperate()
+            return
+        try:
+            gevent.socket.wait_read(
+                self._conn.fileno(), timeout=_ALIVE_CHECK_INTERVAL
+            )
+        except socket.timeout:
+            pass
+
+    def import_hiera(self):
+        """Passes content of Hiera files to worker. Content is passed only
+        once, as Hiera files are complete after deployment planning.
+        """
+        if self._hiera_imported:
+            return
+        self._hiera_imported = True
+        kind, result, extra = self.call(
+            None, 'import_hiera', puppet.export_hiera()
+        )
+        if kind == 'error':
+            raise result
+
+    def close(self, timeout=10):
+        """Stops worker process."""
+        if not self._process.is_alive():
+            self._sender.close(0)
+            return
+        self._sender.send(None)
+        self._sender.close(timeout)
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._conn.close()
+
+
+class DroneProxy(object):
+    """Proxy of drone living in shard worker process. Plugin steps run
+    via proxy have to be picklable.
+    """
+
+    def __init__(self, shard, host, config, messages):
+        self.host = host
+        self.info = {}
+        self._shard = shard
+        self._config = config
+        self._messages = messages
+        self._local_builddir = self._call('_local_builddir')
+
+    def _call(self, method, *args, **kwargs):
+        kind, result, extra = self._shard.call(
+            self.host, method, *args, **kwargs
+        )
+        # keep the same info object, controller holds reference to it
+        self.info.clear()
+        self.info.update(extra['info'])
+        self._messages.extend(extra['messages'])
+        if kind == 'error':
+            raise result
+        return result
+
+    @property
+    def metrics(self):
+        return self._call('metrics')
+
+    def run_step(self, step):
+        return self._call('run_step', step)
+
+    def init_host(self):
+        return self._call('init_host')
+
+    def discover(self):
+        self._call('discover')
+        return self.info
+
+    def configure(self):
+        return self._call('configure')
+
+    def add_module(self, path):
+        return self._call('add_module', path)
+
+    def add_resource(self, path):
+        return self._call('add_resource', path)
+
+    def add_manifest(self, name):
+        # manifests are rendered in parent, where deployment is planned
+        path = puppet.render_manifest(
+            name,
+            tmpdir=os.path.join(self._local_builddir, 'manifests'),
+            config=self._config
+        )
+        return self._call('add_manifest', name, path=path)
+
+    def add_hiera(self, name):
+        return self._call('add_hiera', name)
+
+    def make_build(self):
+        self._shard.import_hiera()
+        return self._call('make_build')
+
+    def deploy(self, name, timeout=None, debug=False):
+        return self._call('deploy', name, timeout=timeout, debug=debug)
+
+    def clean(self):
+        return self._call('clean')
+
+
+def start_shards(hosts, count, config, reporter=None, drone_kwargs=None):
+    """Partitions given hosts to given count of shards and starts worker
+    process for each of them. Returns list of Shard objects.
+    """
+    hosts = sorted(hosts)
+    if not hosts:
+        return []
+    count = min(count, len(hosts))
+    return [
+        Shard(
+            index, hosts[index::count], config, reporter=reporter,
+            drone_kwargs=drone_kwargs
+        )
+        for index in range(count)
+    ]
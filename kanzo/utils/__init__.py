@@ -6,6 +6,12 @@ from ..conf import project
 
 from . import config
 from . import decorators
+from . import events
+from . import health
+from . import metrics
+from . import pools
+from . import profiling
+from . import sessions
 from . import shell
 from . import shortcuts
 from . import strings
@@ -5,11 +5,13 @@ HOST_SET = set()
 
 def iter_hosts(config):
     """Iterates all host parameters and their values."""
-    for key, value in config.items():
+    # only host parameters are accessed, so that lazily validated config
+    # does not validate all parameters
+    for key in config:
         if key.endswith('host'):
-            yield key, value
+            yield key, config[key]
         if key.endswith('hosts') and config.meta(key).get('is_multi', False):
-            for i in value:
+            for i in config[key]:
                 yield key, i.strip()
 
 
@@ -3,16 +3,38 @@
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
+import asyncio
+import functools
+import random
 import time
 
 
-def retry(count=1, delay=0, retry_on=Exception):
+def backoff_delay(attempt, delay, max_delay=None, jitter=0, backoff=2):
+    """Returns delay before given retry attempt (starting with 0). Delay
+    grows exponentially by factor backoff up to max_delay and given fraction
+    of it (jitter) is randomized, so that retries of many callers
+    do not synchronize.
+    """
+    value = delay * backoff ** attempt
+    if max_delay is not None:
+        value = min(value, max_delay)
+    return random.uniform(value * (1 - jitter), value)
+
+
+def retry(count=1, delay=0, retry_on=Exception, backoff=1, max_delay=None,
+          jitter=0):
     """Decorator which tries to run specified callable if the previous
     run ended by given exception. Retry count and delays can be also
-    specified.
+    specified. Delay is multiplied by backoff after each retry up to
+    max_delay and randomized by given fraction (jitter, see backoff_delay).
     """
     if count < 0 or delay < 0:
         raise ValueError('Count and delay has to be positive number.')
+    if backoff < 1 or not 0 <= jitter <= 1:
+        raise ValueError(
+            'Backoff has to be at least 1 and jitter has to be between 0 '
+            'and 1.'
+        )
 
     def decorator(func):
         def wrapper(*args, **kwargs):
@@ -24,8 +46,77 @@ def retry(count=1, delay=0, retry_on=Exception):
                     if tried >= count:
                         raise
                     if delay:
-                        time.sleep(delay)
+                        time.sleep(backoff_delay(
+                            tried, delay, max_delay=max_delay, jitter=jitter,
+                            backoff=backoff
+                        ))
                     tried += 1
         wrapper.__name__ = func.__name__
         return wrapper
     return decorator
+
+
+EXECUTION_CLASSES = ('io', 'cpu', 'blocking')
+
+
+def execution(kind):
+    """Decorator which sets execution class of plugin step. Steps of class
+    'io' (default) run in greenlet, steps of class 'blocking' run in thread
+    pool and steps of class 'cpu' run in process pool. Commands of 'blocking'
+    steps are run in controller's thread. Steps of class 'cpu' have to be
+    picklable, their changes of info and messages are passed back
+    to controller and their shell connects to host only when the step runs
+    a command.
+    """
+    if kind not in EXECUTION_CLASSES:
+        raise ValueError(
+            'Unknown execution class {kind}. Valid classes are: '
+            '{classes}'.format(kind=kind, classes=', '.join(EXECUTION_CLASSES))
+        )
+
+    def decorator(func):
+        func.execution = kind
+        return func
+    return decorator
+
+
+def requires(*steps):
+    """Decorator which sets prerequisites of plugin step. Prerequisites can
+    be given as steps or step names and have to be steps of the same phase.
+    Step is then started on host as soon as all prerequisites are finished
+    on that host (undecorated steps wait for preceding steps on all hosts).
+    """
+    def decorator(func):
+        func.requires = steps
+        return func
+    return decorator
+
+
+def independent(func):
+    """Decorator which marks plugin step as independent on steps preceding
+    it, so it can run concurrently with them on each host.
+    """
+    func.independent = True
+    return func
+
+
+def barrier(func):
+    """Decorator which marks plugin step as fleet-wide barrier. Step is then
+    started on any host only after its prerequisites are finished on all
+    hosts.
+    """
+    func.barrier = True
+    return func
+
+
+def asynchronous(func):
+    """Returns coroutine function which runs given function in default
+    executor of running event loop.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(func, *args, **kwargs)
+        )
+    return wrapper
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import time
+
+
+LOG = logging.getLogger('kanzo.backend')
+
+
+# Events are dictionaries containing at least keys 'type', 'name', 'start'
+# and 'end' (time.monotonic() values) and 'pid'. Depending on type they can
+# contain 'host', 'phase', 'step', 'marker', 'manifest', 'status', 'rc',
+# 'bytes' and 'direction'. Event types:
+#   run, phase, step - controller units (step without host is whole step)
+#   task - internal controller task on host (Puppet installation)
+#   marker - deployment of marker on all its hosts
+#   apply - Puppet run of manifest on host
+#   ssh - command executed on host
+#   transfer - transfer of files to/from host
+_subscribers = []
+_context = contextvars.ContextVar('kanzo_event_context', default={})
+
+
+def subscribe(callback):
+    """Registers callback which is called with each emitted event."""
+    if callback not in _subscribers:
+        _subscribers.append(callback)
+
+
+def unsubscribe(callback):
+    """Unregisters given event callback."""
+    if callback in _subscribers:
+        _subscribers.remove(callback)
+
+
+def unsubscribe_all():
+    """Unregisters all event callbacks."""
+    del _subscribers[:]
+
+
+def enabled():
+    """Returns True if there is anybody listening for events."""
+    return bool(_subscribers)
+
+
+def current():
+    """Returns fields of current event context."""
+    return dict(_context.get())
+
+
+@contextlib.contextmanager
+def context(**fields):
+    """Context manager adding given fields to all events emitted within
+    the context (in the same greenlet or thread).
+    """
+    token = _context.set(dict(_context.get(), **fields))
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def bind(func, **fields):
+    """Returns callable running given func in current event context extended
+    by given fields. Useful for passing context to other greenlets.
+    """
+    fields = dict(_context.get(), **fields)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with context(**fields):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def publish(event):
+    """Passes given event to all subscribers."""
+    for callback in list(_subscribers):
+        try:
+            callback(event)
+        except Exception:
+            LOG.exception('Event callback {} failed.'.format(callback))
+
+
+def emit(kind, name, start=None, end=None, **fields):
+    """Emits event of given type and name to all subscribers."""
+    if not _subscribers:
+        return
+    now = time.monotonic()
+    event = dict(_context.get())
+    event.update(fields)
+    event.update(
+        type=kind, name=name, pid=os.getpid(),
+        start=now if start is None else start,
+        end=now if end is None else end,
+    )
+    publish(event)
+
+
+@contextlib.contextmanager
+def span(kind, name, **fields):
+    """Context manager emitting event of given type and name covering
+    the context. Yields dictionary to which additional event fields can be
+    added. Event status is 'error' if the context raised exception.
+    """
+    start = time.monotonic()
+    status = 'ok'
+    try:
+        yield fields
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        if _subscribers:
+            fields.setdefault('status', status)
+            emit(kind, name, start=start, end=time.monotonic(), **fields)
+
+
+# event types rendered as spans in trace, other events are rendered
+# as instant events
+TRACE_SPANS = (
+    'run', 'phase', 'step', 'task', 'marker', 'build', 'apply', 'ssh',
+    'transfer',
+)
+
+
+def chrome_trace(events):
+    """Returns dictionary in Chrome Trace Event Format (loadable by Perfetto
+    or chrome://tracing) for given list of events. Events of each host are
+    placed on separate track, controller's events without host on the first
+    track. Dependencies of markers are rendered as flow arrows from the last
+    finished Puppet run of prerequisite marker to Puppet runs of dependent
+    marker.
+    """
+    events = sorted(events, key=lambda i: (i['start'], -i['end']))
+    origin = events[0]['start'] if events else 0
+    hosts = sorted(set(i['host'] for i in events if i.get('host')))
+    tracks = dict((host, index + 1) for index, host in enumerate(hosts))
+
+    def usec(value):
+        return round((value - origin) * 1000000, 3)
+
+    result = [
+        {'ph': 'M', 'pid': 1, 'tid': 0, 'name': 'process_name',
+         'args': {'name': 'kanzo'}},
+        {'ph': 'M', 'pid': 1, 'tid': 0, 'name': 'thread_name',
+         'args': {'name': 'controller'}},
+    ]
+    for host, tid in sorted(tracks.items(), key=lambda i: i[1]):
+        result.append({'ph': 'M', 'pid': 1, 'tid': tid, 'name': 'thread_name',
+                       'args': {'name': host}})
+        result.append({'ph': 'M', 'pid': 1, 'tid': tid,
+                       'name': 'thread_sort_index',
+                       'args': {'sort_index': tid}})
+
+    slices = {}
+    for event in events:
+        args = dict(
+            (key, value) for key, value in event.items()
+            if key not in ('type', 'name', 'start', 'end')
+        )
+        item = {
+            'name': event['name'], 'cat': event['type'], 'pid': 1,
+            'tid': tracks.get(event.get('host'), 0),
+            'ts': usec(event['start']), 'args': args,
+        }
+        if event['type'] in TRACE_SPANS:
+            item.update(ph='X', dur=usec(event['end']) - item['ts'])
+            key = (event['type'], event.get('marker') or event['name'])
+            slices.setdefault(key, []).append(item)
+        else:
+            item.update(ph='i', s='t')
+        result.append(item)
+
+    # flow arrows of marker dependencies
+    flow_id = 0
+    markers = [
+        i for key, items in slices.items() if key[0] == 'marker'
+        for i in items
+    ]
+    for marker in markers:
+        for prereq in marker['args'].get('requires', []):
+            sources = slices.get(('apply', prereq)) or slices.get(
+                ('marker', prereq), []
+            )
+            targets = slices.get(('apply', marker['name'])) or [marker]
+            if not sources:
+                continue
+            source = max(sources, key=lambda i: i['ts'] + i['dur'])
+            for target in targets:
+                flow_id += 1
+                result.append({
+                    'ph': 's', 'id': flow_id, 'pid': 1,
+                    'tid': source['tid'], 'name': 'requires', 'cat': 'marker',
+                    # flow has to start inside of the source slice
+                    'ts': max(source['ts'], source['ts'] + source['dur'] - 1),
+                })
+                result.append({
+                    'ph': 'f', 'bp': 'e', 'id': flow_id, 'pid': 1,
+                    'tid': target['tid'], 'name': 'requires', 'cat': 'marker',
+                    'ts': target['ts'],
+                })
+    return {'traceEvents': result, 'displayTimeUnit': 'ms'}
+
+
+class RunSummary(object):
+    """Event subscriber aggregating events to per-run summary."""
+
+    def __init__(self):
+        self.started = time.time()
+        self._start = time.monotonic()
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def summary(self):
+        """Returns dictionary with durations of phases, steps (total and per
+        host), markers and Puppet runs and with SSH command counts, SSH time
+        and transferred bytes per host.
+        """
+        end = max([i['end'] for i in self.events] or [self._start])
+        result = {
+            'started': self.started,
+            'duration': end - self._start,
+            'phases': collections.OrderedDict(),
+            'steps': collections.OrderedDict(),
+            'markers': collections.OrderedDict(),
+            'hosts': {},
+        }
+        for event in sorted(self.events, key=lambda i: i['start']):
+            duration = event['end'] - event['start']
+            kind, name = event['type'], event['name']
+            host = event.get('host')
+            if host:
+                stats = result['hosts'].setdefault(host, {
+                    'ssh_commands': 0, 'ssh_time': 0.0, 'bytes_sent': 0,
+                    'bytes_received': 0, 'transfer_time': 0.0,
+                    'apply_time': 0.0, 'step_time': 0.0,
+                })
+            if kind == 'phase':
+                result['phases'][name] = duration
+            elif kind == 'step' and host:
+                step = result['steps'].setdefault(
+                    name, {'duration': 0.0, 'hosts': {}}
+                )
+                step['hosts'][host] = duration
+                stats['step_time'] += duration
+            elif kind == 'step':
+                step = result['steps'].setdefault(
+                    name, {'duration': 0.0, 'hosts': {}}
+                )
+                step['duration'] = duration
+            elif kind == 'marker':
+                result['markers'][name] = {
+                    'duration': duration,
+                    'hosts': event.get('hosts', []),
+                    'status': event.get('status'),
+                }
+            elif kind == 'apply' and host:
+                stats['apply_time'] += duration
+            elif kind == 'ssh' and host:
+                stats['ssh_commands'] += 1
+                stats['ssh_time'] += duration
+            elif kind == 'transfer' and host:
+                direction = event.get('direction', 'send')
+                key = 'bytes_sent' if direction == 'send' else 'bytes_received'
+                stats[key] += event.get('bytes', 0)
+                stats['transfer_time'] += duration
+        # steps run on hosts last from the first start to the last end
+        for name, step in result['steps'].items():
+            spans = [
+                i for i in self.events
+                if i['type'] == 'step' and i['name'] == name and i.get('host')
+            ]
+            if spans and not step['duration']:
+                step['duration'] = (
+                    max(i['end'] for i in spans) -
+                    min(i['start'] for i in spans)
+                )
+        return result
+
+    def save(self, path):
+        """Saves summary to given JSON file."""
+        _dump(self.summary(), path, indent=2)
+        LOG.debug('Saved run summary to {path}.'.format(**locals()))
+        return path
+
+    def save_trace(self, path):
+        """Saves collected events to given file in Chrome Trace Event
+        Format (see chrome_trace).
+        """
+        _dump(chrome_trace(self.events), path)
+        LOG.debug('Saved run trace to {path}.'.format(**locals()))
+        return path
+
+
+def _dump(data, path, **kwargs):
+    """Atomically writes given data to given JSON file."""
+    tmppath = '{}.tmp'.format(path)
+    with open(tmppath, 'w') as json_file:
+        json.dump(data, json_file, **kwargs)
+    os.rename(tmppath, path)
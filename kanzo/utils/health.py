@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""Per-host health of SSH operations. Consecutive failures of operations
+on host open host's circuit breaker, so that further operations fail fast
+with HostDown instead of going through full retry cycle. When cool-down
+passes, single probing operation is let through (half-open state) and its
+result either closes the breaker or opens it again. Other operations fail
+with HostDown until the probe finishes.
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import greenlet
+import logging
+import os
+import time
+
+from ..conf import project
+from . import events
+
+
+LOG = logging.getLogger('kanzo.backend')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class HostDown(RuntimeError):
+    """Raised when operation is attempted on host marked down."""
+
+
+class HostHealth(object):
+    """Circuit breaker of single host. Breaker opens after threshold
+    consecutive failures (default is project's HOST_FAILURE_THRESHOLD)
+    and stays open for cooldown seconds (default is project's
+    HOST_DOWN_COOLDOWN).
+    """
+
+    def __init__(self, host, threshold=None, cooldown=None):
+        self.host = host
+        self.threshold = threshold or project.HOST_FAILURE_THRESHOLD
+        if cooldown is None:
+            cooldown = project.HOST_DOWN_COOLDOWN
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self._opened = None
+        # greenlet running probing operation in half-open state
+        self._probe = None
+
+    @property
+    def down(self):
+        return (
+            self.state == OPEN and
+            time.monotonic() - self._opened < self.cooldown
+        )
+
+    def check(self, probe=True):
+        """Raises HostDown if host is marked down or if other operation
+        is probing the host. Caller becomes the probe when cool-down passed,
+        unless probe is False (eg. when caller only fails fast before
+        handing work over to other tasks, which run the actual operations).
+        """
+        if self.state == CLOSED:
+            return
+        if self.state == HALF_OPEN:
+            if self._probe is greenlet.getcurrent():
+                return
+            # probe which did not report result in cool-down is abandoned
+            if (self._probe is None or
+                    time.monotonic() - self._opened >= self.cooldown):
+                if probe:
+                    self._start_probe()
+                return
+            raise HostDown(
+                'Host {self.host} is being probed after {self.failures} '
+                'consecutive failures.'.format(**locals())
+            )
+        if not self.down:
+            if probe:
+                self._set_state(HALF_OPEN)
+                self._start_probe()
+            return
+        raise HostDown(
+            'Host {self.host} is marked down after {self.failures} '
+            'consecutive failures.'.format(**locals())
+        )
+
+    def _start_probe(self):
+        self._probe = greenlet.getcurrent()
+        self._opened = time.monotonic()
+
+    def release(self):
+        """Lets other operation probe the host if current greenlet
+        is the probe, which finished without reporting its result.
+        """
+        if self._probe is greenlet.getcurrent():
+            self._probe = None
+
+    def success(self):
+        self.failures = 0
+        self._probe = None
+        if self.state != CLOSED:
+            self._set_state(CLOSED)
+
+    def failure(self):
+        self.failures += 1
+        self._probe = None
+        if (self.state == HALF_OPEN or
+                (self.state == CLOSED and self.failures >= self.threshold)):
+            self._opened = time.monotonic()
+            self._set_state(OPEN)
+
+    def apply(self, state, failures):
+        """Sets given state and failures count reported by other process
+        (eg. shard worker owning host's connections) without emitting
+        health event again.
+        """
+        if state != self.state:
+            self._opened = time.monotonic()
+            self._probe = None
+        self.state = state
+        self.failures = failures
+
+    def _set_state(self, state):
+        log = LOG.warning if state == OPEN else LOG.info
+        log(
+            'Circuit breaker of host {self.host} changed from {self.state} '
+            'to {state} ({self.failures} consecutive failures).'.format(
+                **locals()
+            )
+        )
+        self.state = state
+        events.emit(
+            'health', state, host=self.host, failures=self.failures
+        )
+
+
+_hosts = {}
+def get(host):
+    """Returns HostHealth object of given host."""
+    if host not in _hosts:
+        _hosts[host] = HostHealth(host)
+    return _hosts[host]
+
+
+def check(host, probe=True):
+    """Raises HostDown if given host is marked down (see HostHealth.check)."""
+    get(host).check(probe=probe)
+
+
+def reset():
+    """Forgets health of all hosts."""
+    _hosts.clear()
+
+
+def track(event):
+    """Event callback applying health changes of hosts reported by other
+    processes (see kanzo.core.sharding) to hosts' health in this process.
+    """
+    if event['type'] == 'health' and event['pid'] != os.getpid():
+        get(event['host']).apply(event['name'], event['failures'])
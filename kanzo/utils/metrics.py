@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+"""Metrics registry rendered in Prometheus text format, which is written
+to node_exporter textfile collector directory. No network listener is used.
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import collections
+import gc
+import gevent
+import greenlet
+import logging
+import math
+import os
+
+
+LOG = logging.getLogger('kanzo.backend')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(
+            key,
+            str(value).replace('\\', '\\\\').replace('"', '\\"')
+                      .replace('\n', '\\n')
+        )
+        for key, value in labels
+    ))
+
+
+class Metric(object):
+    """Base class of metrics. Values are stored per label set."""
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                'Metric {self.name} requires labels {self.labelnames}, '
+                'got {}.'.format(sorted(labels), **locals())
+            )
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self):
+        """Returns list of tuples (name, labels, value)."""
+        return [
+            (self.name, key, value)
+            for key, value in sorted(self._values.items())
+        ]
+
+    def render(self):
+        lines = [
+            '# HELP {self.name} {self.documentation}'.format(**locals()),
+            '# TYPE {self.name} {self.kind}'.format(**locals()),
+        ]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(
+                name, _format_labels(labels), _format_value(value)
+            ))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError('Counter can only be increased.')
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=()):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+        self._values[key] = (counts, total + value)
+
+    def get(self, **labels):
+        """Returns tuple (count, sum) of observed values."""
+        counts, total = self._values.get(
+            self._key(labels), ([0] * len(self.buckets), 0.0)
+        )
+        return counts[-1], total
+
+    def samples(self):
+        result = []
+        for key, (counts, total) in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, counts):
+                labels = key + (('le', _format_value(bound)),)
+                result.append(('{}_bucket'.format(self.name), labels, count))
+            result.append(('{}_sum'.format(self.name), key, total))
+            result.append(('{}_count'.format(self.name), key, counts[-1]))
+        return result
+
+
+class Registry(object):
+    """Collection of metrics."""
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(
+                'Metric {metric.name} is already registered.'.format(
+                    **locals()
+                )
+            )
+        self._metrics[metric.name] = metric
+        return metric
+
+    def __getitem__(self, name):
+        return self._metrics[name]
+
+    def render(self):
+        """Returns metrics in Prometheus text exposition format."""
+        return ''.join(
+            '{}\n'.format(metric.render())
+            for metric in self._metrics.values()
+        )
+
+    def write(self, path):
+        """Atomically writes metrics to given textfile."""
+        tmppath = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmppath, 'w') as textfile:
+            textfile.write(self.render())
+        os.rename(tmppath, path)
+
+
+# buckets of histograms
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+THROUGHPUT_BUCKETS = tuple(2 ** i for i in range(10, 31, 2))
+
+
+class MetricsExporter(object):
+    """Event subscriber (see kanzo.utils.events) maintaining run metrics.
+    Metrics are periodically written to given textfile while the exporter
+    is started.
+    """
+
+    def __init__(self, path, interval=15):
+        self.path = path
+        self.interval = interval
+        self._writer = None
+        self.registry = registry = Registry()
+        self.ssh_latency = registry.register(Histogram(
+            'kanzo_ssh_command_duration_seconds',
+            'Duration of commands executed on hosts over SSH.',
+            buckets=LATENCY_BUCKETS,
+        ))
+        self.ssh_failures = registry.register(Counter(
+            'kanzo_ssh_command_failures_total',
+            'Count of SSH commands which returned non-zero return code.',
+        ))
+        self.reconnects = registry.register(Counter(
+            'kanzo_ssh_reconnects_total',
+            'Count of SSH reconnections caused by failed commands.',
+        ))
+        self.transfer_bytes = registry.register(Counter(
+            'kanzo_transfer_bytes_total',
+            'Bytes transferred to/from hosts.', ('direction',),
+        ))
+        self.transfer_throughput = registry.register(Histogram(
+            'kanzo_transfer_throughput_bytes_per_second',
+            'Throughput of transfers to/from hosts.', ('direction',),
+            buckets=THROUGHPUT_BUCKETS,
+        ))
+        self.apply_duration = registry.register(Histogram(
+            'kanzo_puppet_apply_duration_seconds',
+            'Duration of Puppet runs on hosts.',
+            buckets=DURATION_BUCKETS,
+        ))
+        self.step_duration = registry.register(Histogram(
+            'kanzo_step_duration_seconds',
+            'Duration of plugin steps on hosts.', ('phase',),
+            buckets=LATENCY_BUCKETS + DURATION_BUCKETS[3:],
+        ))
+        self.markers = registry.register(Gauge(
+            'kanzo_markers', 'Count of deployment markers in given state.',
+            ('state',),
+        ))
+        self.hosts_down = registry.register(Gauge(
+            'kanzo_host_down', 'Whether host is marked down (1) or not (0).',
+            ('host',),
+        ))
+        self.greenlets = registry.register(Gauge(
+            'kanzo_greenlets', 'Count of live greenlets in controller.',
+        ))
+
+    def __call__(self, event):
+        kind = event['type']
+        duration = event['end'] - event['start']
+        if kind == 'ssh':
+            self.ssh_latency.observe(duration)
+            if event.get('rc'):
+                self.ssh_failures.inc()
+        elif kind == 'reconnect':
+            self.reconnects.inc()
+        elif kind == 'transfer':
+            direction = event.get('direction', 'send')
+            size = event.get('bytes', 0)
+            self.transfer_bytes.inc(size, direction=direction)
+            if duration > 0:
+                self.transfer_throughput.observe(
+                    size / duration, direction=direction
+                )
+        elif kind == 'apply':
+            self.apply_duration.observe(duration)
+        elif kind == 'step' and event.get('host'):
+            self.step_duration.observe(
+                duration, phase=event.get('phase', '')
+            )
+        elif kind == 'health':
+            self.hosts_down.set(
+                int(event['name'] == 'open'), host=event.get('host', '')
+            )
+        elif kind == 'queue':
+            for state in ('ready', 'in_progress', 'waiting', 'finished'):
+                if state in event:
+                    self.markers.set(event[state], state=state)
+
+    def write(self):
+        """Writes current metrics to textfile."""
+        # counting greenlets requires walking the heap, so it's done only
+        # when metrics are written
+        self.greenlets.set(sum(
+            1 for obj in gc.get_objects()
+            if isinstance(obj, greenlet.greenlet) and obj and not obj.dead
+        ))
+        try:
+            self.registry.write(self.path)
+        except OSError as ex:
+            LOG.warning(
+                'Failed to write metrics to {self.path}: {ex}'.format(
+                    **locals()
+                )
+            )
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.write()
+
+    def start(self):
+        """Starts periodic writing of metrics."""
+        if self._writer is None:
+            self._writer = gevent.spawn(self._run)
+
+    def stop(self):
+        """Stops periodic writing and writes final metrics."""
+        if self._writer is not None:
+            self._writer.kill()
+            self._writer = None
+        self.write()
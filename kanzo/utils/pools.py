@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import concurrent.futures
+import gevent
+import gevent.hub
+import gevent.monkey
+import gevent.threadpool
+import greenlet
+import logging
+import time
+
+from ..conf import project
+
+
+LOG = logging.getLogger('kanzo.backend')
+
+
+def init_worker():
+    """Drops SSH connections, host health and event callbacks inherited
+    from parent process, so that worker processes do not share sockets
+    with it.
+    """
+    from . import events
+    from . import health
+    from . import shell
+    shell.RemoteShell._connections = {}
+    health.reset()
+    events.unsubscribe_all()
+
+
+_pools = {}
+def get_pool(kind='process'):
+    """Returns shared pool of given kind ('process' or 'thread'). Pool
+    is created on first use. Thread pool uses real OS threads even when
+    threading is monkey-patched by gevent.
+    """
+    if kind not in _pools:
+        if kind == 'process':
+            size = project.PROCESS_POOL_SIZE
+            _pools[kind] = concurrent.futures.ProcessPoolExecutor(
+                size, initializer=init_worker
+            )
+        elif kind == 'thread':
+            size = project.THREAD_POOL_SIZE
+            _pools[kind] = gevent.threadpool.ThreadPoolExecutor(size)
+        else:
+            raise ValueError('Unknown pool type: {}'.format(kind))
+        LOG.debug('Created {kind} pool of size {size}.'.format(**locals()))
+    return _pools[kind]
+
+
+def cooperate(interval=0):
+    """Lets other tasks run. When called from greenlet run by controller
+    (see kanzo.core.engines.GreenletEngine) control is switched to parent
+    greenlet, otherwise current thread (or gevent greenlet) sleeps for given
+    interval.
+    """
+    parent = greenlet.getcurrent().parent
+    if parent is None or isinstance(parent, gevent.hub.Hub):
+        time.sleep(interval)
+    else:
+        parent.switch()
+
+
+def pause(interval):
+    """Waits for given interval (s) and lets other tasks run meanwhile
+    (see cooperate), so that waiting greenlet run by controller does not
+    block the others.
+    """
+    until = time.monotonic() + interval
+    left = interval
+    while left > 0:
+        cooperate(left)
+        left = until - time.monotonic()
+
+
+def wait_for(future, interval=0.1):
+    """Waits for given future and returns its result. When called from child
+    greenlet control is switched to parent greenlet until the future is done,
+    so that other greenlets are not blocked.
+    """
+    while not future.done():
+        # let gevent hub (if used) process pools' management tasks
+        time.sleep(0)
+        cooperate(interval)
+    return future.result()
+
+
+def run_in_hub(hub, func, *args, **kwargs):
+    """Runs given callable in new greenlet of given gevent hub, ie. in thread
+    owning the hub, and waits for its result. Pool threads use it to call
+    objects bound to controller's hub (eg. RemoteShell and its SSH
+    connection).
+    """
+    done = gevent.monkey.get_original('_thread', 'allocate_lock')()
+    done.acquire()
+    result = {}
+
+    def run():
+        try:
+            result['value'] = func(*args, **kwargs)
+        except BaseException as ex:
+            result['error'] = ex
+        finally:
+            done.release()
+
+    hub.loop.run_callback_threadsafe(gevent.spawn, run)
+    done.acquire()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+def close_pools(wait=True):
+    """Shuts down all created pools."""
+    for kind in list(_pools.keys()):
+        _pools.pop(kind).shutdown(wait=wait)
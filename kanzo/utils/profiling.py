@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""Profiling of controller runs. Profilers are aware of greenlet switches,
+so time spent in other greenlets is not attributed to the switching one.
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import contextlib
+import cProfile
+import greenlet
+import logging
+import os
+import pstats
+import sys
+
+from ..conf import project
+
+
+LOG = logging.getLogger('kanzo.backend')
+
+
+class GreenletProfiler(object):
+    """cProfile based profiler keeping separate profile for each greenlet.
+    Profiles are switched together with greenlets and merged at the end.
+    """
+
+    def __init__(self):
+        self._profiles = {}
+        self._previous = None
+
+    def _get(self, glet):
+        profile = self._profiles.get(glet)
+        if profile is None:
+            profile = self._profiles[glet] = cProfile.Profile()
+        return profile
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            origin, target = args
+            self._get(origin).disable()
+            self._get(target).enable()
+        if self._previous is not None:
+            self._previous(event, args)
+
+    def start(self):
+        self._previous = greenlet.settrace(self._trace)
+        self._get(greenlet.getcurrent()).enable()
+
+    def stop(self):
+        self._get(greenlet.getcurrent()).disable()
+        greenlet.settrace(self._previous)
+        self._previous = None
+
+    def save(self, path):
+        """Saves merged profiles to given pstats file. Returns pstats.Stats
+        object or None if nothing was profiled.
+        """
+        stats = None
+        for profile in self._profiles.values():
+            if not profile.getstats():
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        self._profiles = {}
+        if stats is not None:
+            stats.dump_stats(path)
+        return stats
+
+
+class YappiProfiler(object):
+    """Profiler using yappi with greenlet context backend."""
+
+    def __init__(self):
+        import yappi
+        self._yappi = yappi
+
+    def start(self):
+        self._yappi.clear_stats()
+        self._yappi.set_context_backend('greenlet')
+        self._yappi.set_clock_type('wall')
+        self._yappi.start()
+
+    def stop(self):
+        self._yappi.stop()
+
+    def save(self, path):
+        stats = self._yappi.get_func_stats()
+        if stats.empty():
+            return None
+        stats.save(path, type='pstat')
+        return pstats.Stats(path)
+
+
+PROFILERS = {
+    'cprofile': GreenletProfiler,
+    'yappi': YappiProfiler,
+}
+
+
+def get_profiler(backend=None):
+    """Returns profiler object of given backend ('cprofile' or 'yappi').
+    If backend is None or True, yappi is used if it is installed, cProfile
+    otherwise.
+    """
+    if backend in (None, True):
+        try:
+            import yappi
+            backend = 'yappi'
+        except ImportError:
+            backend = 'cprofile'
+    if backend not in PROFILERS:
+        raise ValueError('Unknown profiler: {}'.format(backend))
+    return PROFILERS[backend]()
+
+
+@contextlib.contextmanager
+def profiled(name, directory, backend=None, top=None, stream=None):
+    """Context manager profiling the code run within it. Profile is saved
+    to file profile-<name>.pstats in given directory and top functions
+    by own time are printed to stream (stdout by default).
+    """
+    top = project.PROFILE_TOP if top is None else top
+    stream = stream or sys.stdout
+    profiler = get_profiler(backend)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    path = os.path.join(directory, 'profile-{}.pstats'.format(name))
+    profiler.start()
+    try:
+        yield path
+    finally:
+        profiler.stop()
+        stats = profiler.save(path)
+        if stats is not None:
+            LOG.debug(
+                'Saved profile of {name} to {path}.'.format(**locals())
+            )
+            if top:
+                stream.write(
+                    'Profile of {name} saved to {path}\n'.format(**locals())
+                )
+                stats.stream = stream
+                stats.sort_stats(project.PROFILE_SORT).print_stats(top)
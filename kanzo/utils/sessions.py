@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""Recording and replaying of remote sessions. SessionRecorder records
+commands, scripts and transfers run by RemoteShell and transfer classes
+together with their timing and results to session file (JSON lines).
+ReplayShell and ReplayTransfer serve recorded results with original
+or scaled timing instead of connecting to hosts, so that recorded
+deployment can be replayed locally against changed Kanzo version.
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import base64
+import collections
+import contextlib
+import json
+import logging
+import os
+import re
+import time
+
+from ..conf import project
+from . import events
+from . import shell
+from .decorators import asynchronous
+from .strings import mask_string
+
+
+LOG = logging.getLogger('kanzo.backend')
+
+
+def normalize(command):
+    """Replaces volatile parts of given command (see project's
+    SESSION_VOLATILE_PATTERNS), so that commands of different runs match.
+    """
+    for pattern, replacement in project.SESSION_VOLATILE_PATTERNS:
+        command = re.sub(pattern, replacement, command)
+    return command
+
+
+def transfer_key(source, destination, sourcetype):
+    return '{sourcetype} {source} {destination}'.format(**locals())
+
+
+class SessionRecorder(object):
+    """Appends records of remote operations to given session file."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._fd = os.open(
+            path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600
+        )
+
+    def _write(self, record):
+        # whole record is written by single write to file opened in append
+        # mode, so records written from pool threads are not interleaved
+        line = '{}\n'.format(json.dumps(record, sort_keys=True))
+        os.write(self._fd, line.encode('utf-8'))
+
+    def record(self, host, kind, command, start, rc=0, stdout='', stderr=''):
+        """Records command or script ('execute' or 'script' kind) which
+        started at given time.
+        """
+        self._write({
+            'host': host,
+            'kind': kind,
+            'command': command,
+            'start': start,
+            'duration': time.time() - start,
+            'rc': rc,
+            'stdout': stdout,
+            'stderr': stderr,
+        })
+
+    def record_transfer(self, host, source, destination, sourcetype, start,
+                        tarball):
+        """Records transfer of given tarball which started at given time.
+        Content of tarballs received from host is recorded too.
+        """
+        record = {
+            'host': host,
+            'kind': 'transfer',
+            'command': transfer_key(source, destination, sourcetype),
+            'start': start,
+            'duration': time.time() - start,
+            'bytes': os.path.getsize(tarball),
+        }
+        if sourcetype == 'remote':
+            with open(tarball, 'rb') as data:
+                record['data'] = base64.b64encode(data.read()).decode('ascii')
+        self._write(record)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class Session(object):
+    """Session loaded from session file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._records = collections.defaultdict(list)
+        self._cursors = collections.Counter()
+        with open(path) as session_file:
+            for line in session_file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                key = (
+                    record['host'], record['kind'],
+                    normalize(record['command'])
+                )
+                self._records[key].append(record)
+
+    def match(self, host, kind, command):
+        """Returns next recorded result of given operation on given host.
+        Results of repeated operation (eg. polling) are returned in recorded
+        order and the last one is returned when they are exhausted. Returns
+        None if operation was not recorded.
+        """
+        key = (host, kind, normalize(command))
+        records = self._records.get(key)
+        if not records:
+            return None
+        index = min(self._cursors[key], len(records) - 1)
+        self._cursors[key] += 1
+        return records[index]
+
+
+class ReplayShell(shell.RemoteShell):
+    """Replacement of RemoteShell serving results of commands and scripts
+    from recorded session instead of running them on host. Recorded
+    durations are multiplied by time_scale (0 disables delays). Commands
+    missing in session succeed with empty output.
+    """
+    session = None
+    time_scale = 1.0
+    recorder = None
+
+    def __init__(self, host):
+        self.host = host
+
+    def reconnect(self):
+        pass
+
+    def replay(self, kind, command, timeout=None):
+        """Returns recorded result of given operation after its recorded
+        (scaled) duration or None if the operation was not recorded.
+        Raises ExecutionTimeout if the duration exceeds given timeout.
+        """
+        record = None
+        if self.session is not None:
+            record = self.session.match(self.host, kind, command)
+        if record is None:
+            LOG.warning(
+                '[{self.host}] Operation {kind} was not recorded in session: '
+                '{command}'.format(**locals())
+            )
+            return None
+        duration = record['duration'] * self.time_scale
+        if timeout and duration > timeout:
+            time.sleep(timeout)
+            raise shell.ExecutionTimeout(
+                '[{self.host}] Replayed {kind} did not finish in {timeout}s:'
+                '\n{command}'.format(**locals())
+            )
+        if duration:
+            time.sleep(duration)
+        return record
+
+    def _run(self, kind, command, can_fail, mask_list, log,
+             output_limit=None, line_callback=None, timeout=None,
+             decode=True):
+        mask_list = mask_list or []
+        repl_list = [("'", "'\\''")]
+        masked = mask_string(command, mask_list, repl_list)
+        if log:
+            LOG.info(
+                '[{self.host}] Replaying {kind}: {masked}'.format(**locals())
+            )
+        with events.span('ssh', kind, host=self.host) as event:
+            if timeout is None:
+                timeout = project.SHELL_COMMAND_TIMEOUT
+            record = self.replay(kind, masked, timeout=timeout) or {}
+            rc = record.get('rc', 0)
+            event['rc'] = rc
+        if output_limit is None:
+            output_limit = project.SHELL_OUTPUT_LIMIT
+        outputs = []
+        for name in ('stdout', 'stderr'):
+            output = shell.OutputBuffer(
+                name, limit=output_limit, callback=line_callback
+            )
+            output.feed(record.get(name, '').encode('utf-8'))
+            outputs.append(output.close(decode=decode))
+        stdout, stderr = outputs
+        if rc and can_fail:
+            raise RuntimeError(
+                '[{self.host}] Failed to run {kind}:'
+                '\n{masked}\nstdout:\n{stdout}\n'
+                'stderr:\n{stderr}'.format(**locals())
+            )
+        return rc, stdout, stderr
+
+    def execute(self, cmd, can_fail=True, mask_list=None, log=True,
+                output_limit=None, line_callback=None, timeout=None,
+                decode=True):
+        return self._run(
+            'execute', cmd, can_fail, mask_list, log,
+            output_limit=output_limit, line_callback=line_callback,
+            timeout=timeout, decode=decode
+        )
+
+    def run_script(self, script, can_fail=True, mask_list=None,
+                   log=False, description=None, timeout=None):
+        return self._run(
+            'script', '\n'.join(script), can_fail, mask_list, log,
+            timeout=timeout
+        )
+
+    execute_async = asynchronous(execute)
+    run_script_async = asynchronous(run_script)
+
+
+class ReplayTransfer(shell.BaseTransfer):
+    """Replacement of transfer classes serving recorded transfers.
+    Tarballs received from hosts are restored from session.
+    """
+
+    def _transfer(self, source, destination, sourcetype, timeout=None):
+        record = self._shell.replay(
+            'transfer', transfer_key(source, destination, sourcetype),
+            timeout=timeout
+        )
+        if sourcetype != 'remote':
+            return
+        if record is None:
+            host = self._shell.host
+            raise OSError(
+                'Transfer of {source} from host {host} was not '
+                'recorded.'.format(**locals())
+            )
+        path = os.path.join(destination, os.path.basename(source))
+        with open(path, 'wb') as tarball:
+            tarball.write(base64.b64decode(record['data']))
+
+
+@contextlib.contextmanager
+def recording(path):
+    """Context manager recording remote operations run within it to given
+    session file.
+    """
+    recorder = SessionRecorder(path)
+    orig = shell.RemoteShell.recorder
+    shell.RemoteShell.recorder = recorder
+    LOG.debug('Recording remote session to {path}.'.format(**locals()))
+    try:
+        yield recorder
+    finally:
+        shell.RemoteShell.recorder = orig
+        recorder.close()
+
+
+@contextlib.contextmanager
+def replaying(path, time_scale=None):
+    """Context manager replacing RemoteShell and transfer classes by ones
+    replaying session from given file. Recorded durations are multiplied
+    by time_scale (default is project's SESSION_REPLAY_TIME_SCALE).
+    """
+    session = Session(path)
+    if time_scale is None:
+        time_scale = project.SESSION_REPLAY_TIME_SCALE
+    orig = (shell.RemoteShell, shell.SFTPTransfer, shell.SCPTransfer)
+    ReplayShell.session, ReplayShell.time_scale = session, time_scale
+    shell.RemoteShell = ReplayShell
+    shell.SFTPTransfer = shell.SCPTransfer = ReplayTransfer
+    LOG.debug('Replaying remote session from {path}.'.format(**locals()))
+    try:
+        yield session
+    finally:
+        shell.RemoteShell, shell.SFTPTransfer, shell.SCPTransfer = orig
+        ReplayShell.session = None
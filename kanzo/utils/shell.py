@@ -4,31 +4,76 @@ from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
 import base64
+import codecs
 import logging
 import os
 import paramiko
 import pipes
 import re
+import select
+import socket
 import stat
 import subprocess
 import sys
 import tarfile
+import tempfile
+import time
 import uuid
 
 from ..conf import project
+from . import events
+from . import health
+from . import pools
+from .decorators import asynchronous, backoff_delay
 from .strings import mask_string
 
 
 OUTFMT = '---- {type} ----\n{content}'
+TRUNCATED = '\n[... {dropped} bytes of output dropped ...]\n'
+# size of chunks read from SSH channel
+CHUNK_SIZE = 32768
+# commands run with timeout are wrapped, so that their process group can be
+# killed when the timeout is reached (sshd runs each command in new session)
+PIDFILE = '/tmp/kanzo-{}.pid'
+TIMEOUT_WRAPPER = (
+    'echo $$ > {pidfile}\n(\n{cmd}\n)\nrc=$?\nrm -f {pidfile}\nexit $rc'
+)
+CANCEL_COMMAND = (
+    'pid=$(cat {pidfile} 2>/dev/null) && kill -TERM -- -$pid; rm -f {pidfile}'
+)
 LOG = logging.getLogger('kanzo.backend')
 
 
+class ExecutionTimeout(RuntimeError):
+    """Raised when command or transfer does not finish in given time."""
+
+
+def get_deadline(timeout):
+    """Returns deadline (time.monotonic based) of given timeout or None
+    if timeout is not set.
+    """
+    return time.monotonic() + timeout if timeout else None
+
+
+def remaining(deadline):
+    """Returns seconds remaining to given deadline or None if deadline
+    is None. Raises ExecutionTimeout if the deadline has passed.
+    """
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise ExecutionTimeout('Deadline has passed.')
+    return left
+
+
 def execute(cmd, workdir=None, can_fail=True, mask_list=None,
-            use_shell=False, log=True):
+            use_shell=False, log=True, timeout=None):
     """
     Runs shell command cmd. If can_fail is set to True RuntimeError is raised
     if command returned non-zero return code. Otherwise returns return code
-    and content of stdout.
+    and content of stdout. If command does not finish in given timeout
+    it is killed and ExecutionTimeout is raised.
     """
     mask_list = mask_list or []
     repl_list = [("'", "'\\''")]
@@ -43,7 +88,14 @@ def execute(cmd, workdir=None, can_fail=True, mask_list=None,
 
     proc = subprocess.Popen(cmd, cwd=workdir, shell=use_shell, close_fds=True,
                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = proc.communicate()
+    try:
+        out, err = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise ExecutionTimeout(
+            'Command did not finish in {timeout}s: {masked}'.format(**locals())
+        )
 
     if log:
         for tp, ot in (('stdout', out), ('stderr', err)):
@@ -57,6 +109,66 @@ def execute(cmd, workdir=None, can_fail=True, mask_list=None,
     return proc.returncode, out, err
 
 
+class OutputBuffer(object):
+    """Buffer of command output stream. Content is kept in memory up to
+    memory_limit bytes (default is project's SHELL_OUTPUT_MEMORY_LIMIT)
+    and spilled to temporary file above it. When content exceeds limit
+    bytes, only its first and last half of limit bytes are kept (limit None
+    or 0 means unlimited). If callback
+    is given, it is called with stream name and each line of output as soon
+    as the line is read.
+    """
+
+    def __init__(self, name, limit=None, callback=None, memory_limit=None):
+        self.name = name
+        self.limit = limit
+        self.size = 0
+        self.dropped = 0
+        self._callback = callback
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._line = ''
+        self._tail = bytearray()
+        if memory_limit is None:
+            memory_limit = project.SHELL_OUTPUT_MEMORY_LIMIT
+        self._file = tempfile.SpooledTemporaryFile(max_size=memory_limit)
+
+    def feed(self, data):
+        self.size += len(data)
+        kept = data
+        if self.limit:
+            head = self.limit - self.limit // 2
+            kept = data[:max(0, head - self._file.tell())]
+            self._tail += data[len(kept):]
+            excess = len(self._tail) - self.limit // 2
+            if excess > 0:
+                del self._tail[:excess]
+                self.dropped += excess
+        if kept:
+            self._file.write(kept)
+        if self._callback:
+            lines = (self._line + self._decoder.decode(data)).split('\n')
+            self._line = lines.pop()
+            for line in lines:
+                self._callback(self.name, '{}\n'.format(line))
+
+    def close(self, decode=True):
+        """Passes last unfinished line to callback and returns content
+        (bytes if decode is False).
+        """
+        if self._callback:
+            line = self._line + self._decoder.decode(b'', final=True)
+            self._line = ''
+            if line:
+                self._callback(self.name, line)
+        self._file.seek(0)
+        content = self._file.read()
+        self._file.close()
+        if self.dropped:
+            content += TRUNCATED.format(dropped=self.dropped).encode('utf-8')
+        content += self._tail
+        return content.decode('utf-8', 'replace') if decode else content
+
+
 class IgnorePolicy(paramiko.MissingHostKeyPolicy):
     def missing_host_key(self, *args, **kwargs):
         return
@@ -64,6 +176,8 @@ class IgnorePolicy(paramiko.MissingHostKeyPolicy):
 
 class RemoteShell(object):
     _connections = {}
+    # kanzo.utils.sessions.SessionRecorder recording executed commands
+    recorder = None
 
     username = project.DEFAULT_SSH_USER
     sshkey = project.DEFAULT_SSH_PRIVATE_KEY
@@ -71,6 +185,7 @@ class RemoteShell(object):
 
     def __init__(self, host):
         self.host = host
+        health.check(host, probe=False)
         if host in self._connections:
             self._client = self._connections[host]
         else:
@@ -110,7 +225,20 @@ class RemoteShell(object):
         )
 
     def reconnect(self):
-        """Establish connection to host."""
+        """Establish connection to host. Raises HostDown if the host
+        is marked down.
+        """
+        host_health = health.get(self.host)
+        host_health.check()
+        try:
+            self._connect()
+        except RuntimeError:
+            host_health.failure()
+            raise
+        finally:
+            host_health.release()
+
+    def _connect(self):
         self._register()
         LOG.debug('Reconnecting to host {}'.format(self.host))
         # create connection to host
@@ -120,89 +248,216 @@ class RemoteShell(object):
         try:
             clt.connect(self.host, port=self.port, username=self.username,
                         key_filename=self._get_key('private'))
-        except paramiko.SSHException as ex:
+        except (paramiko.SSHException, OSError) as ex:
             raise RuntimeError('Failed to (re)connect to host %s' % self.host)
         self._connections[self.host] = self._client = clt
         # XXX: following should not be required, so commenting for now
         #clt.get_transport().set_keepalive(10)
 
-    def _process_output(self, otype, channel, mlist, rlist, log=True):
-        output = channel.readlines()
+    def _drain(self, channel, stdout, stderr, deadline=None):
+        """Reads stdout and stderr of given channel to given buffers
+        concurrently until remote command closes them, so that neither
+        stream can block the command by filling SSH window. Returns exit
+        status of the command. Raises ExecutionTimeout if the command
+        does not finish till given deadline.
+        """
+        while True:
+            while channel.recv_ready():
+                stdout.feed(channel.recv(CHUNK_SIZE))
+            while channel.recv_stderr_ready():
+                stderr.feed(channel.recv_stderr(CHUNK_SIZE))
+            if channel.eof_received or channel.closed:
+                if not (channel.recv_ready() or channel.recv_stderr_ready()):
+                    break
+                continue
+            # channel is readable when any of streams has data or is closed
+            select.select([channel], [], [], remaining(deadline))
+        if deadline is not None:
+            if not channel.status_event.wait(remaining(deadline)):
+                raise ExecutionTimeout('Exit status was not received.')
+        return channel.recv_exit_status()
+
+    def _cancel(self, pidfile, channel=None):
+        """Closes channel of timed out command and kills command's process
+        group on host.
+        """
+        if channel is not None:
+            channel.close()
+        cmd = CANCEL_COMMAND.format(**locals())
+        LOG.debug(
+            '[{self.host}] Killing timed out command: {cmd}'.format(**locals())
+        )
+        try:
+            chin, chout, cherr = self._client.exec_command(
+                cmd, timeout=project.SHELL_CANCEL_TIMEOUT
+            )
+            chout.channel.status_event.wait(project.SHELL_CANCEL_TIMEOUT)
+            chout.channel.close()
+        except (paramiko.SSHException, OSError) as ex:
+            LOG.warning(
+                '[{self.host}] Failed to kill timed out command: '
+                '{ex}'.format(**locals())
+            )
+
+    def _process_output(self, otype, output, mlist, rlist, log=True,
+                        decode=True):
+        content = output.close(decode=decode)
         if log:
+            text = content if decode else content.decode('utf-8', 'replace')
             LOG.info(
                 OUTFMT.format(
-                    type=otype,
-                    content=mask_string('\n'.join(output), mlist, rlist)
+                    type=otype, content=mask_string(text, mlist, rlist)
                 )
             )
-        return '\n'.join(output)
+        return content
 
-    def execute(self, cmd, can_fail=True, mask_list=None, log=True):
+    def execute(self, cmd, can_fail=True, mask_list=None, log=True,
+                output_limit=None, line_callback=None, timeout=None,
+                decode=True):
         """Executes given command on remote host. Raises RuntimeError if
         command failed and if can_fail is True. Logging executed command,
         content of stdout and content of stderr if log is True. Parameter
         mask_list should contain words which is supposed to be masked
-        in log messages. Returns (return code, content of stdout, content
-        of stderr).
+        in log messages. Of output of each stream exceeding output_limit
+        bytes (default is project's SHELL_OUTPUT_LIMIT, 0 means unlimited)
+        only the first and the last half of output_limit bytes is kept.
+        If given, line_callback is called with stream name ('stdout'
+        or 'stderr') and each line of output while the command runs.
+        If the command does not finish in given timeout (default is
+        project's SHELL_COMMAND_TIMEOUT), its process group is killed
+        on host and ExecutionTimeout is raised. Returns (return code,
+        content of stdout, content of stderr). Content is returned
+        as received (bytes) if decode is False.
         """
+        if output_limit is None:
+            output_limit = project.SHELL_OUTPUT_LIMIT
+        if timeout is None:
+            timeout = project.SHELL_COMMAND_TIMEOUT
         mask_list = mask_list or []
         repl_list = [("'", "'\\''")]
         masked = mask_string(cmd, mask_list, repl_list)
+        deadline = get_deadline(timeout)
+        if deadline is not None:
+            pidfile = PIDFILE.format(uuid.uuid4().hex[:8])
+            cmd = TIMEOUT_WRAPPER.format(**locals())
         if log:
             LOG.info(
                 '[{self.host}] Executing command: {masked}'.format(**locals())
             )
-        retry = project.SHELL_RECONNECT_RETRY or 1
-        while retry:
+        start = time.time()
+        with events.span('ssh', 'execute', host=self.host) as event:
+            host_health = health.get(self.host)
+            retries = project.SHELL_RECONNECT_RETRY or 1
+            attempt = 0
             try:
-                retry -= 1
-                chin, chout, cherr = self._client.exec_command(cmd)
-            except paramiko.SSHException as ex:
-                if log:
-                    LOG.warning(
-                        '[{self.host}] Failed to run command:'
-                        '\n{masked}'.format(**locals())
+                while True:
+                    # fail fast instead of full retry cycle if host is down
+                    host_health.check()
+                    try:
+                        chin, chout, cherr = self._client.exec_command(
+                            cmd, timeout=remaining(deadline)
+                        )
+                        break
+                    except paramiko.SSHException as ex:
+                        attempt += 1
+                        if log:
+                            LOG.warning(
+                                '[{self.host}] Failed to run command:'
+                                '\n{masked}'.format(**locals())
+                            )
+                        if attempt >= retries:
+                            # whole retry cycle counts as single failure
+                            host_health.failure()
+                            trc = str(ex)
+                            msg = (
+                                'No retries left. Following error appeared:'
+                                '\n\n{trc}'.format(**locals())
+                            )
+                            LOG.error(msg)
+                            raise RuntimeError(msg)
+                    delay = backoff_delay(
+                        attempt - 1, project.SHELL_RETRY_DELAY,
+                        max_delay=project.SHELL_RETRY_MAX_DELAY,
+                        jitter=project.SHELL_RETRY_JITTER
                     )
-                if not retry:
-                    trc = str(ex)
-                    msg = (
-                        'No retries left. Following error appeared:\n'
-                        '\n{trc}'.format(**locals())
-                    )
-                    LOG.error(msg)
-                    raise RuntimeError(msg)
-                # in case any error reconnect and try again
-                self.reconnect()
-                LOG.debug(
-                    'Retries left: {retry}. Running command again.'.format(
-                        **locals()
+                    if deadline is not None:
+                        delay = min(delay, remaining(deadline))
+                    LOG.debug(
+                        'Retries left: {}. Running command again in {:.2f}s.'
+                        .format(retries - attempt, delay)
                     )
+                    # other controller's greenlets run while waiting
+                    pools.pause(delay)
+                    # in case any error reconnect and try again
+                    events.emit('reconnect', 'ssh', host=self.host)
+                    try:
+                        self._connect()
+                    except RuntimeError as ex:
+                        # failed reconnect is retried with the command
+                        LOG.warning(
+                            '[{self.host}] {ex}'.format(**locals())
+                        )
+                host_health.success()
+            finally:
+                # probe interrupted before reporting result is given up
+                host_health.release()
+
+            outputs = [
+                OutputBuffer(name, limit=output_limit, callback=line_callback)
+                for name in ('stdout', 'stderr')
+            ]
+            try:
+                rc = self._drain(chout.channel, *outputs, deadline=deadline)
+            except ExecutionTimeout:
+                self._cancel(pidfile, chout.channel)
+                event['rc'] = None
+                for output in outputs:
+                    output.close()
+                msg = (
+                    '[{self.host}] Command did not finish in {timeout}s:'
+                    '\n{masked}'.format(**locals())
                 )
-
-        stdout = self._process_output(
-            'stdout', chout, mask_list, repl_list, log=log
-        )
-        stderr = self._process_output(
-            'stderr', cherr, mask_list, repl_list, log=log
-        )
-        rc = chout.channel.recv_exit_status()
+                LOG.error(msg)
+                raise ExecutionTimeout(msg)
+            stdout, stderr = [
+                self._process_output(
+                    output.name, output, mask_list, repl_list, log=log,
+                    decode=decode
+                )
+                for output in outputs
+            ]
+            event['rc'] = rc
+        if (self.recorder or (rc and can_fail)) and not decode:
+            text = [i.decode('utf-8', 'replace') for i in (stdout, stderr)]
+        else:
+            text = [stdout, stderr]
+        if self.recorder:
+            self.recorder.record(
+                self.host, 'execute', masked, start, rc=rc,
+                stdout=mask_string(text[0], mask_list, repl_list),
+                stderr=mask_string(text[1], mask_list, repl_list),
+            )
         if rc and can_fail:
             raise RuntimeError(
                 '[{self.host}] Failed to run command:'
-                '\n{masked}\nstdout:\n{stdout}\n'
-                'stderr:\n{stderr}'.format(**locals())
+                '\n{masked}\nstdout:\n{text[0]}\n'
+                'stderr:\n{text[1]}'.format(**locals())
             )
         return rc, stdout, stderr
 
     def run_script(self, script, can_fail=True, mask_list=None,
-                   log=False, description=None):
+                   log=False, description=None, timeout=None):
         """Runs given script on remote host. Script should be list where each
         item represents one command. Raises RuntimeError if command failed
         and if can_fail is True. Logging executed command, content of stdout
         and content of stderr if log is True. Parameter mask_list should
         contain words which is supposed to be masked in log messages.
+        If the script does not finish in given timeout (default is project's
+        SHELL_COMMAND_TIMEOUT), it is killed and ExecutionTimeout is raised.
         Returns (return code, content of stdout, content of stderr).
         """
+        if timeout is None:
+            timeout = project.SHELL_COMMAND_TIMEOUT
         mask_list = mask_list or []
         repl_list = [("'", "'\\''")]
         desc = description or (
@@ -212,30 +467,69 @@ class RemoteShell(object):
 
         _script = ['function script_trap(){ exit $? ; }',
                    'trap script_trap ERR']
+        if timeout:
+            pidfile = PIDFILE.format(uuid.uuid4().hex[:8])
+            _script.append('echo $$ > {pidfile}'.format(**locals()))
         _script.extend(script)
 
         if log:
             LOG.info(
                 '[{self.host}] Executing script: {desc}'.format(**locals())
             )
-        proc = subprocess.Popen(
-            [
-                'ssh',
-                    '-o', 'StrictHostKeyChecking=no',
-                    '-o', 'UserKnownHostsFile=/dev/null',
-                    '-p', str(self.port),
-                    '-i', self._get_key('private'),
-                    '{}@{}'.format(self.username, self.host),
-                    'bash -x'
-            ],
-            close_fds=True,
-            shell=False,
-            universal_newlines=True,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        stdout, stderr = proc.communicate('\n'.join(_script))
+        host_health = health.get(self.host)
+        host_health.check()
+        start = time.time()
+        try:
+            with events.span('ssh', 'script', host=self.host) as event:
+                proc = subprocess.Popen(
+                    [
+                        'ssh',
+                            '-o', 'StrictHostKeyChecking=no',
+                            '-o', 'UserKnownHostsFile=/dev/null',
+                            '-p', str(self.port),
+                            '-i', self._get_key('private'),
+                            '{}@{}'.format(self.username, self.host),
+                            'bash -x'
+                    ],
+                    close_fds=True,
+                    shell=False,
+                    universal_newlines=True,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE
+                )
+                try:
+                    stdout, stderr = proc.communicate(
+                        '\n'.join(_script), timeout=timeout
+                    )
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.communicate()
+                    self._cancel(pidfile)
+                    event['rc'] = None
+                    msg = (
+                        '[{self.host}] Script did not finish in {timeout}s: '
+                        '{desc}'.format(**locals())
+                    )
+                    LOG.error(msg)
+                    raise ExecutionTimeout(msg)
+                event['rc'] = proc.returncode
+            # ssh exits with 255 when connection to host failed
+            if proc.returncode == 255:
+                host_health.failure()
+            else:
+                host_health.success()
+        finally:
+            # probe interrupted before reporting result is given up
+            host_health.release()
+        if self.recorder:
+            self.recorder.record(
+                self.host, 'script',
+                mask_string('\n'.join(script), mask_list, repl_list), start,
+                rc=proc.returncode,
+                stdout=mask_string(stdout, mask_list, repl_list),
+                stderr=mask_string(stderr, mask_list, repl_list),
+            )
 
         if log:
             LOG.info(
@@ -250,6 +544,10 @@ class RemoteShell(object):
             )
         return proc.returncode, stdout, stderr
 
+    # async variants for asyncio based tooling
+    execute_async = asynchronous(execute)
+    run_script_async = asynchronous(run_script)
+
 
 class BaseTransfer(object):
     def __init__(self, host, remote_tmpdir, local_tmpdir):
@@ -257,10 +555,17 @@ class BaseTransfer(object):
         self._remote_tmpdir = remote_tmpdir
         self._local_tmpdir = local_tmpdir
 
-    def send(self, source, destination):
+    def _cleanup_timeout(self, deadline):
+        # cleanup has to be attempted even when the deadline has passed
+        return project.SHELL_CANCEL_TIMEOUT if deadline is not None else None
+
+    def send(self, source, destination, timeout=None):
         """Packs given local source directory/file to tarball, transfers it and
-        unpacks to given remote destination directory.
+        unpacks to given remote destination directory. Raises
+        ExecutionTimeout if the whole operation does not finish in given
+        timeout.
         """
+        deadline = get_deadline(timeout)
         # packing
         if not os.path.exists(source):
             raise ValueError(
@@ -269,24 +574,33 @@ class BaseTransfer(object):
             )
         tarball = self._pack_local(source)
         # preparation
-        tmpdir = self._check_remote_tmpdir()
+        tmpdir = self._check_remote_tmpdir(deadline)
         tmpfile = os.path.join(tmpdir, os.path.basename(tarball))
         # transfer and unpack
         try:
-            self._transfer(tarball, tmpdir, sourcetype='local')
-            self._unpack_remote(tmpfile, destination)
+            with events.span('transfer', destination, host=self._shell.host,
+                             direction='send') as event:
+                event['bytes'] = os.path.getsize(tarball)
+                self._record_transfer(tarball, tmpdir, 'local', deadline)
+            self._unpack_remote(tmpfile, destination, deadline)
         finally:
             os.unlink(tarball)
-            self._shell.execute('rm -f {tmpfile}'.format(**locals()))
+            self._shell.execute(
+                'rm -f {tmpfile}'.format(**locals()),
+                timeout=self._cleanup_timeout(deadline)
+            )
 
-    def receive(self, source, destination):
+    def receive(self, source, destination, timeout=None):
         """Packs given remote source directory/file to tarball, transfers it
-        and unpacks to given local destination directory.
+        and unpacks to given local destination directory. Raises
+        ExecutionTimeout if the whole operation does not finish in given
+        timeout.
         """
+        deadline = get_deadline(timeout)
         # packing
         rc, stdout, stderr = self._shell.execute(
             '[ -e "{source}" ]'.format(**locals()),
-            can_fail=False
+            can_fail=False, timeout=remaining(deadline)
         )
         if rc:
             host = self._shell.host
@@ -294,22 +608,51 @@ class BaseTransfer(object):
                 'Given path on host {host} does not exists: '
                 '{source}'.format(**locals())
             )
-        tarball = self._pack_remote(source)
+        tarball = self._pack_remote(source, deadline)
         # preparation
         tmpdir = self._check_local_tmpdir()
         tmpfile = os.path.join(tmpdir, os.path.basename(tarball))
         # transfer and unpack
         try:
-            self._transfer(tarball, tmpdir, sourcetype='remote')
+            with events.span('transfer', source, host=self._shell.host,
+                             direction='receive') as event:
+                self._record_transfer(tarball, tmpdir, 'remote', deadline)
+                event['bytes'] = os.path.getsize(tmpfile)
             self._unpack_local(tmpfile, destination)
         finally:
             try:
                 os.unlink(tmpfile)
             except FileNotFoundError:
                 pass
-            self._shell.execute('rm -fr {tarball}'.format(**locals()))
+            self._shell.execute(
+                'rm -fr {tarball}'.format(**locals()),
+                timeout=self._cleanup_timeout(deadline)
+            )
 
-    def _transfer(self, source, destination, sourcetype):
+    # async variants for asyncio based tooling
+    send_async = asynchronous(send)
+    receive_async = asynchronous(receive)
+
+    def _record_transfer(self, source, destination, sourcetype, deadline):
+        """Runs the transfer and records it if session recording is active.
+        Received tarballs are recorded including their content.
+        """
+        # shell can be replaced by object without recording support
+        recorder = getattr(self._shell, 'recorder', None)
+        start = time.time()
+        self._transfer(
+            source, destination, sourcetype, timeout=remaining(deadline)
+        )
+        if recorder:
+            tarball = source
+            if sourcetype == 'remote':
+                tarball = os.path.join(destination, os.path.basename(source))
+            recorder.record_transfer(
+                self._shell.host, source, destination, sourcetype, start,
+                tarball
+            )
+
+    def _transfer(self, source, destination, sourcetype, timeout=None):
         """Child class has to implement this method."""
         raise NotImplementedError()
 
@@ -317,10 +660,11 @@ class BaseTransfer(object):
         os.makedirs(self._local_tmpdir, mode=0o700, exist_ok=True)
         return self._local_tmpdir
 
-    def _check_remote_tmpdir(self):
+    def _check_remote_tmpdir(self, deadline=None):
         tmpdir = self._remote_tmpdir
         self._shell.execute(
-            'mkdir -p --mode=0700 {tmpdir}'.format(**locals())
+            'mkdir -p --mode=0700 {tmpdir}'.format(**locals()),
+            timeout=remaining(deadline)
         )
         return tmpdir
 
@@ -334,15 +678,16 @@ class BaseTransfer(object):
         os.chmod(packpath, stat.S_IRUSR | stat.S_IWUSR)
         return packpath
 
-    def _pack_remote(self, path):
+    def _pack_remote(self, path, deadline=None):
         packpath = os.path.join(
-            self._check_remote_tmpdir(),
+            self._check_remote_tmpdir(deadline),
             'transfer-{0}.tar.gz'.format(uuid.uuid4().hex[:8])
         )
         prefix = '-C {0}'.format(os.path.dirname(path))
         path = os.path.basename(path)
         self._shell.execute(
-            'tar {prefix} -cpzf {packpath} {path}'.format(**locals())
+            'tar {prefix} -cpzf {packpath} {path}'.format(**locals()),
+            timeout=remaining(deadline)
         )
         return packpath
 
@@ -364,21 +709,22 @@ class BaseTransfer(object):
                     if not is_within_directory(path, member_path):
                         raise Exception("Attempted Path Traversal in Tar File")
             
-                tar.extractall(path, members, numeric_owner) 
+                tar.extractall(path, members, numeric_owner=numeric_owner)
                 
             
             safe_extract(pack, path=destination)
 
-    def _unpack_remote(self, path, destination):
+    def _unpack_remote(self, path, destination, deadline=None):
         self._shell.execute(
             'mkdir -p --mode=0700 {destination} && '
-            'tar -C {destination} -xpzf {path}'.format(**locals())
+            'tar -C {destination} -xpzf {path}'.format(**locals()),
+            timeout=remaining(deadline)
         )
 
 
 class SCPTransfer(BaseTransfer):
     """Tranfer files via scp."""
-    def _transfer(self, source, destination, sourcetype):
+    def _transfer(self, source, destination, sourcetype, timeout=None):
         cmd = [
             'scp',
             '-o', 'StrictHostKeyChecking=no',
@@ -397,20 +743,28 @@ class SCPTransfer(BaseTransfer):
                 src=source,
                 dest=destination,
             ),
-            use_shell=True
+            use_shell=True, timeout=timeout
         )
 
 
 class SFTPTransfer(BaseTransfer):
     """Transfer files via SFTP client."""
-    def _transfer(self, source, destination, sourcetype):
+    def _transfer(self, source, destination, sourcetype, timeout=None):
         dest = os.path.join(destination, os.path.basename(source))
+        sftp = self._shell._client.open_sftp()
         try:
-            sftp = self._shell._client.open_sftp()
+            if timeout is not None:
+                sftp.get_channel().settimeout(timeout)
             if sourcetype == 'local':
                 direction = sftp.put
             else:
                 direction = sftp.get
             direction(source, dest)
+        except socket.timeout:
+            host = self._shell.host
+            raise ExecutionTimeout(
+                'Transfer of {source} ({sourcetype} source, host {host}) '
+                'did not finish in {timeout}s.'.format(**locals())
+            )
         finally:
             sftp.close()
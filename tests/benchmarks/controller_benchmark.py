@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of Controller at scale. Controller runs against given count
+of simulated hosts with synthetic plugin, which generates given count
+of markers with dependencies of given shape. Every SSH command and transfer
+on simulated host takes given latency (transfers are further limited by
+bandwidth) and every Puppet run takes given time. Simulated hosts wait
+cooperatively (see kanzo.utils.pools.pause), so latencies of concurrent
+tasks overlap like on real hosts.
+
+Wall time, controller's CPU time, peak of memory allocated by controller
+(traced by tracemalloc) and SSH operation counts are measured
+for initialization ('init' and 'prep' phases), deployment planning ('plan'
+phase including build transfers) and deployment. Results can be
+saved as JSON baseline and compared with baseline saved before, so that
+scaling regressions show up in review.
+
+Usage: python -m tests.benchmarks.controller_benchmark \\
+        [--hosts 10 100] [--shapes chain layered wide] \\
+        [--compare tests/benchmarks/baselines/controller.json]
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import sys
+
+os.environ.setdefault('KANZO_PROJECT', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'test_project.py'
+))
+
+import argparse
+import collections
+import itertools
+import json
+import logging
+import re
+import shutil
+import string
+import tempfile
+import time
+import tracemalloc
+
+from kanzo import utils
+from kanzo.conf import project
+from kanzo.core import puppet
+from kanzo.core.controller import Controller, PluginData
+
+from ..kanzo import FakeRemoteShell
+
+
+BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'baselines', 'controller.json'
+)
+CONFIG = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'test_config.txt'
+)
+SHAPES = ('chain', 'layered', 'wide', 'diamond')
+# measured values compared with baseline
+COMPARED = ('wall', 'cpu', 'memory_peak_kb', 'ssh_commands', 'transfers')
+# shorter times are too noisy to be compared
+MIN_COMPARED_TIME = 0.5
+
+
+class SimulatedSFTP(object):
+    """SFTP client of simulated host."""
+
+    def __init__(self, shell):
+        self._shell = shell
+
+    def _transfer(self, path):
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._shell.ops['transfers'] += 1
+        self._shell.ops['bytes'] += size
+        utils.pools.pause(
+            self._shell.latency + size / self._shell.bandwidth
+        )
+
+    def put(self, source, destination):
+        self._transfer(source)
+
+    def get(self, source, destination):
+        self._transfer(source)
+
+    def close(self):
+        pass
+
+
+class SimulatedClient(object):
+    """SSH client of simulated host."""
+
+    def __init__(self, shell):
+        self._shell = shell
+
+    def open_sftp(self):
+        return SimulatedSFTP(self._shell)
+
+
+def command_pattern(template):
+    """Returns regular expression matching commands formatted from given
+    command template (eg. project's PUPPET_APPLY_COMMAND).
+    """
+    parts = []
+    fields = set()
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        parts.append(re.escape(literal))
+        if field is None:
+            continue
+        if not field.isidentifier():
+            parts.append('.*')
+        elif field in fields:
+            parts.append('(?P={})'.format(field))
+        else:
+            fields.add(field)
+            parts.append('(?P<{}>.*)'.format(field))
+    return re.compile(''.join(parts) + '$', re.DOTALL)
+
+
+class SimulatedShell(FakeRemoteShell):
+    """Replacement of kanzo.utils.shell.RemoteShell simulating remote host.
+    Results of commands matching patterns of project's Puppet commands
+    (see simulate) are registered by register_execute before the command
+    is executed. Puppet runs finish after apply_time seconds.
+    """
+    latency = 0.001
+    bandwidth = 100 * 1024 ** 2
+    apply_time = 0.01
+    ops = collections.Counter()
+    patterns = []
+    history = {}
+    return_vals = {}
+    _applies = {}
+
+    def __init__(self, host):
+        super().__init__(host)
+        self._client = SimulatedClient(self)
+        self.register_execute(
+            host, 'facter -p', 0,
+            'hostname => {}\nosfamily => RedHat\n'.format(host), ''
+        )
+
+    def simulate_apply(self, cmd):
+        self._applies[self.host] = time.monotonic()
+        return 0, '', ''
+
+    def simulate_log_poll(self, cmd):
+        started = self._applies.get(self.host, 0)
+        if time.monotonic() - started >= self.apply_time:
+            return 100, 'Notice: Applied catalog\n', ''
+        return 0, '', ''
+
+    def simulate_missing(self, cmd):
+        # Puppet reports are not simulated
+        return 1, '', ''
+
+    def execute(self, cmd, can_fail=True, mask_list=None, log=True,
+                output_limit=None, line_callback=None, timeout=None,
+                decode=True):
+        self.ops['ssh_commands'] += 1
+        with utils.events.span('ssh', 'execute', host=self.host) as event:
+            utils.pools.pause(self.latency)
+            for pattern, simulation in self.patterns:
+                if pattern.match(cmd):
+                    self.register_execute(
+                        self.host, cmd, *simulation(self, cmd)
+                    )
+                    break
+            rc, stdout, stderr = super().execute(
+                cmd, can_fail=can_fail, mask_list=mask_list, log=log,
+                output_limit=output_limit, line_callback=line_callback,
+                timeout=timeout, decode=decode
+            )
+            event['rc'] = rc
+        if rc and rc != 100 and can_fail:
+            raise RuntimeError('Simulated command failed: {}'.format(cmd))
+        return rc, stdout, stderr
+
+    def run_script(self, script, can_fail=True, mask_list=None,
+                   log=False, description=None, timeout=None):
+        return self.execute('\n'.join(script))
+
+
+def marker_graph(markers, shape, layers=4):
+    """Returns ordered dictionary {marker: set of prerequisite markers}
+    of given shape. Shape 'chain' is sequence of markers, 'wide' has markers
+    without dependencies, 'layered' splits markers to layers where each
+    marker requires all markers of previous layer and 'diamond' has single
+    root required by all markers and single final marker requiring all.
+    """
+    names = ['m{:04d}'.format(i) for i in range(markers)]
+    graph = collections.OrderedDict()
+    for index, name in enumerate(names):
+        if shape == 'chain':
+            graph[name] = set(names[index - 1:index])
+        elif shape == 'wide':
+            graph[name] = set()
+        elif shape == 'layered':
+            size = max(1, -(-markers // layers))
+            layer = index // size
+            graph[name] = set(names[(layer - 1) * size:layer * size]
+                              if layer else [])
+        elif shape == 'diamond':
+            if index == 0:
+                graph[name] = set()
+            elif index == markers - 1 and markers > 2:
+                graph[name] = set(names[1:-1])
+            else:
+                graph[name] = {names[0]}
+        else:
+            raise ValueError('Unknown DAG shape: {}'.format(shape))
+    return graph
+
+
+_scenario_ids = itertools.count()
+
+
+def synthetic_plugin(hosts, graph, spread):
+    """Returns PluginData of synthetic plugin. Each marker of given graph
+    is deployed on given count (spread) of hosts.
+    """
+    prefix = 'bench{}'.format(next(_scenario_ids))
+    hosts = sorted(hosts)
+
+    def bench_init(shell, config, info, messages):
+        shell.execute('# initialization')
+
+    def bench_prep(shell, config, info, messages):
+        shell.execute('# preparation')
+
+    def bench_plan(config, info, messages):
+        records = []
+        for index, (marker, reqs) in enumerate(graph.items()):
+            name = '{}_{}'.format(prefix, marker)
+            puppet.update_manifest_inline(
+                name, "notify {{ '{name}': }}".format(**locals())
+            )
+            for offset in range(spread):
+                host = hosts[(index + offset) % len(hosts)]
+                records.append((host, name, name, [
+                    '{}_{}'.format(prefix, req) for req in reqs
+                ]))
+        return records
+
+    return PluginData(
+        name=prefix, modules=[], resources=[], init_steps=[bench_init],
+        prep_steps=[bench_prep], plan_steps=[bench_plan], clean_steps=[]
+    )
+
+
+def simulate(latency, bandwidth, apply_time):
+    """Replaces RemoteShell by SimulatedShell with given latency (s),
+    bandwidth (B/s) and duration of Puppet runs (s).
+    """
+    utils.shell.RemoteShell = SimulatedShell
+    SimulatedShell.patterns = [
+        (command_pattern(project.PUPPET_APPLY_COMMAND),
+         SimulatedShell.simulate_apply),
+        (command_pattern(project.PUPPET_LOG_POLL_COMMAND),
+         SimulatedShell.simulate_log_poll),
+        # existence check of Puppet reports directory before its transfer
+        (command_pattern('[ -e "{source}" ]'),
+         SimulatedShell.simulate_missing),
+    ]
+    SimulatedShell.latency = latency
+    SimulatedShell.bandwidth = bandwidth
+    SimulatedShell.apply_time = apply_time
+    project.PUPPET_LOG_POLL_INTERVAL = apply_time / 2
+    # simulated hosts do not provide Puppet reports, which is logged
+    logging.getLogger('kanzo.backend').addHandler(logging.NullHandler())
+
+
+def _measure(name, results, func):
+    SimulatedShell.ops.clear()
+    tracemalloc.reset_peak()
+    start_cpu = time.process_time()
+    start = time.monotonic()
+    func()
+    results[name] = {
+        'wall': round(time.monotonic() - start, 3),
+        'cpu': round(time.process_time() - start_cpu, 3),
+        'memory_peak_kb': tracemalloc.get_traced_memory()[1] // 1024,
+        'ssh_commands': SimulatedShell.ops['ssh_commands'],
+        'transfers': SimulatedShell.ops['transfers'],
+        'transfer_bytes': SimulatedShell.ops['bytes'],
+    }
+
+
+def run_scenario(hosts, markers, shape, spread=None, engine=None):
+    """Runs Controller against given count of simulated hosts and returns
+    measured results of each part of the run.
+    """
+    hostnames = [
+        '10.{}.{}.{}'.format(i // 62500, i // 250 % 250, i % 250 + 1)
+        for i in range(hosts)
+    ]
+    spread = min(spread or hosts, hosts)
+    graph = marker_graph(markers, shape)
+    tmpdir = tempfile.mkdtemp(prefix='kanzo-bench')
+    utils.config.HOST_SET.clear()
+    utils.config.inject_hosts(hostnames)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        controller = Controller(
+            CONFIG, work_dir=tmpdir, local_tmpdir=os.path.join(tmpdir, 'run'),
+            engine=engine, shards=0
+        )
+        controller.register_status_callback(lambda *a, **kw: None)
+        controller._plugins = [synthetic_plugin(hostnames, graph, spread)]
+        results = collections.OrderedDict()
+        _measure('init', results, lambda: (
+            controller._run_phase('init'), controller._run_phase('prep')
+        ))
+        _measure('plan', results, lambda: controller._run_phase('plan'))
+        _measure('deploy', results, controller.run_deployment)
+        controller.close()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+        utils.config.HOST_SET.clear()
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def scenario_name(hosts, markers, shape, spread):
+    return '{shape}-h{hosts}-m{markers}-s{spread}'.format(**locals())
+
+
+def compare(results, baseline, tolerance):
+    """Returns list of regressions of given results against given baseline.
+    Value is regression if it is higher than baseline by more than given
+    tolerance (fraction). Times shorter than MIN_COMPARED_TIME are not
+    compared.
+    """
+    regressions = []
+    for scenario, parts in results.items():
+        for part, values in parts.items():
+            base = baseline.get(scenario, {}).get(part)
+            if not base:
+                continue
+            for key in COMPARED:
+                if key not in base:
+                    continue
+                if key in ('wall', 'cpu') and base[key] < MIN_COMPARED_TIME:
+                    continue
+                if values[key] > base[key] * (1 + tolerance):
+                    regressions.append(
+                        '{scenario} {part} {key}: {} (baseline {})'.format(
+                            values[key], base[key], **locals()
+                        )
+                    )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hosts', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--markers', type=int, default=12)
+    parser.add_argument('--shapes', nargs='+', default=list(SHAPES),
+                        choices=SHAPES)
+    parser.add_argument('--spread', type=int, default=None,
+                        help='count of hosts each marker is deployed on '
+                             '(default: all hosts)')
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='latency of simulated SSH operation (s)')
+    parser.add_argument('--bandwidth', type=float, default=100,
+                        help='bandwidth of simulated transfers (MiB/s)')
+    parser.add_argument('--apply-time', type=float, default=0.01,
+                        help='duration of simulated Puppet run (s)')
+    parser.add_argument('--engine', default=None)
+    parser.add_argument('--save', metavar='PATH',
+                        help='save results as JSON baseline')
+    parser.add_argument('--compare', metavar='PATH', nargs='?',
+                        const=BASELINE, help='compare results with baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    simulate(args.latency, args.bandwidth * 1024 ** 2, args.apply_time)
+
+    results = collections.OrderedDict()
+    for hosts, shape in itertools.product(args.hosts, args.shapes):
+        name = scenario_name(hosts, args.markers, shape, args.spread or hosts)
+        results[name] = run_scenario(
+            hosts, args.markers, shape, spread=args.spread, engine=args.engine
+        )
+        print(json.dumps({name: results[name]}, sort_keys=True))
+        sys.stdout.flush()
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(
+                results, json.load(baseline_file), args.tolerance
+            )
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark comparing controller's execution engines. Controller runs
+whole drone lifecycle (initialization, Puppet installation, discovery,
+preparation, build transfers and deployment) with each engine against
+simulated hosts of controller benchmark (see controller_benchmark).
+
+Usage: python -m tests.benchmarks.engines_benchmark \\
+        [--hosts 500] [--shape layered]
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+
+os.environ.setdefault('KANZO_PROJECT', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'test_project.py'
+))
+
+import argparse
+import json
+import sys
+
+from kanzo.core import engines
+
+from .controller_benchmark import SHAPES, run_scenario, simulate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hosts', type=int, default=500)
+    parser.add_argument('--markers', type=int, default=12)
+    parser.add_argument('--shape', default='layered', choices=SHAPES)
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='latency of simulated SSH operation (s)')
+    parser.add_argument('--bandwidth', type=float, default=100,
+                        help='bandwidth of simulated transfers (MiB/s)')
+    parser.add_argument('--apply-time', type=float, default=0.01,
+                        help='duration of simulated Puppet run (s)')
+    parser.add_argument('--engines', nargs='+',
+                        default=sorted(engines.ENGINES.keys()))
+    args = parser.parse_args()
+
+    simulate(args.latency, args.bandwidth * 1024 ** 2, args.apply_time)
+    for name in args.engines:
+        results = run_scenario(
+            args.hosts, args.markers, args.shape, engine=name
+        )
+        print(json.dumps({name: results}, sort_keys=True))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of transport code (RemoteShell, SFTPTransfer and SCPTransfer)
+against in-process fake SSH servers (see tests.fakessh). Given count
+of virtual hosts with given latency and bandwidth is started on localhost,
+commands and transfers of payload of given size are run concurrently
+on all hosts and wall time of each operation is measured.
+
+Usage: python -m tests.benchmarks.transport_benchmark \\
+        [--hosts 10 100] [--latency 0.005] [--size 1024]
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+
+os.environ.setdefault('KANZO_PROJECT', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'test_project.py'
+))
+
+import argparse
+import collections
+import gevent
+import json
+import logging
+import sys
+import time
+
+from kanzo.utils import shell
+
+from ..fakessh import FakeSSHCluster
+
+
+TRANSFERS = {
+    'sftp': shell.SFTPTransfer,
+    'scp': shell.SCPTransfer,
+}
+
+
+def _measure(results, name, hosts, func):
+    start = time.monotonic()
+    gevent.joinall([gevent.spawn(func, host) for host in hosts],
+                   raise_error=True)
+    results[name] = round(time.monotonic() - start, 3)
+
+
+def run_scenario(hosts, latency, bandwidth, size, commands):
+    """Runs commands and transfers on given count of virtual hosts
+    and returns wall times of each operation.
+    """
+    results = collections.OrderedDict()
+    with FakeSSHCluster(hosts=hosts, latency=latency,
+                        bandwidth=bandwidth) as cluster:
+        payload = os.path.join(cluster.root, 'payload')
+        os.mkdir(payload)
+        with open(os.path.join(payload, 'data.bin'), 'wb') as data:
+            data.write(os.urandom(size))
+        with cluster.patch_shell():
+            _measure(results, 'connect', cluster.hosts,
+                     lambda host: shell.RemoteShell(host))
+
+            def execute(host):
+                sh = shell.RemoteShell(host)
+                for index in range(commands):
+                    sh.execute('echo {index}'.format(**locals()), log=False)
+            _measure(results, 'execute', cluster.hosts, execute)
+
+            for name, transfer_class in TRANSFERS.items():
+                def transfer(host):
+                    sandbox = cluster.sandbox(host)
+                    transfer = transfer_class(
+                        host, os.path.join(sandbox, 'tmp'), cluster.root
+                    )
+                    transfer.send(payload, os.path.join(sandbox, name))
+                _measure(results, name, cluster.hosts, transfer)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hosts', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='latency of each SSH/SFTP request (s)')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='bandwidth of each host (MiB/s)')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='size of transferred payload (KiB)')
+    parser.add_argument('--commands', type=int, default=10,
+                        help='count of commands executed on each host')
+    args = parser.parse_args()
+    logging.getLogger('kanzo.backend').addHandler(logging.NullHandler())
+
+    bandwidth = args.bandwidth and args.bandwidth * 1024 ** 2
+    for hosts in args.hosts:
+        results = run_scenario(
+            hosts, args.latency, bandwidth, args.size * 1024, args.commands
+        )
+        print(json.dumps({'hosts-{}'.format(hosts): results}))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+
+"""In-process fake SSH/SFTP servers for tests and benchmarks of transport
+code (kanzo.utils.shell.RemoteShell, SFTPTransfer and SCPTransfer) without
+real hosts.
+
+Each virtual host listens on its own loopback address (127.1.x.y) on common
+port, so that RemoteShell can connect to hosts by address as it does to real
+ones. Commands are run by bash in host's sandbox directory (which is also
+host's HOME) and SFTP relative paths are resolved against it. Commands
+missing locally (eg. restorecon used by RemoteShell) can be stubbed by shell
+scripts. Latency, bandwidth and failures of hosts can be injected.
+
+Usage:
+    with FakeSSHCluster(hosts=100, latency=0.01) as cluster:
+        with cluster.patch_shell():
+            shell.RemoteShell(cluster.hosts[0]).execute('uname -a')
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import contextlib
+import gevent
+import gevent.os
+import gevent.socket
+import logging
+import os
+import paramiko
+import random
+import re
+import shutil
+import socket
+import subprocess
+import tempfile
+
+from kanzo.utils import health, shell
+
+
+LOG = logging.getLogger('kanzo.fakessh')
+
+# default stubs of commands missing on hosts running tests
+STUB_COMMANDS = {
+    'restorecon': 'exit 0',
+}
+
+_keys = {}
+def _get_key(name):
+    """Returns RSA key generated once per process."""
+    if name not in _keys:
+        _keys[name] = paramiko.RSAKey.generate(2048)
+    return _keys[name]
+
+
+class VirtualHost(object):
+    """Configuration and state of single virtual host."""
+
+    def __init__(self, address, sandbox, latency=0.0, bandwidth=None,
+                 failure_rate=0.0, fail_commands=(), env=None):
+        self.address = address
+        self.sandbox = sandbox
+        self.env = dict(env or os.environ, HOME=sandbox)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.fail_commands = [re.compile(i) for i in fail_commands]
+        self.commands = []
+        # count of accepted SSH connections
+        self.connections = 0
+        os.makedirs(sandbox, mode=0o700, exist_ok=True)
+
+    def delay(self, size=0):
+        """Sleeps for time of transferring given count of bytes."""
+        if self.bandwidth and size:
+            gevent.sleep(size / self.bandwidth)
+
+    def should_fail(self, command):
+        if self.failure_rate and random.random() < self.failure_rate:
+            return True
+        return any(i.search(command) for i in self.fail_commands)
+
+    def path(self, path):
+        if not os.path.isabs(path):
+            path = os.path.join(self.sandbox, path)
+        return path
+
+
+class _Server(paramiko.ServerInterface):
+    """SSH server of virtual host accepting any user and key."""
+
+    def __init__(self, host):
+        self.host = host
+
+    def get_allowed_auths(self, username):
+        return 'publickey,password'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        command = command.decode('utf-8')
+        if self.host.should_fail(command):
+            LOG.debug('[{}] Injected failure of: {}'.format(
+                self.host.address, command
+            ))
+            return False
+        self.host.commands.append(command)
+        gevent.spawn(_execute, self.host, channel, command)
+        return True
+
+
+def _execute(host, channel, command):
+    """Runs given command in host's sandbox and pipes its input and output
+    from/to given channel.
+    """
+    gevent.sleep(host.latency)
+    proc = subprocess.Popen(
+        ['bash', '-c', command], cwd=host.sandbox,
+        env=host.env,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        close_fds=True, start_new_session=True,
+    )
+
+    def feed():
+        try:
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                host.delay(len(data))
+                proc.stdin.write(data)
+                proc.stdin.flush()
+        except (OSError, EOFError):
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    def pump(stream, send):
+        fd = stream.fileno()
+        gevent.os.make_nonblocking(fd)
+        while True:
+            data = gevent.os.nb_read(fd, 32768)
+            if not data:
+                break
+            host.delay(len(data))
+            try:
+                send(data)
+            except OSError:
+                # client has closed the channel
+                break
+
+    feeder = gevent.spawn(feed)
+    pumps = [
+        gevent.spawn(pump, proc.stdout, channel.sendall),
+        gevent.spawn(pump, proc.stderr, channel.sendall_stderr),
+    ]
+    try:
+        gevent.joinall(pumps)
+        rc = proc.wait()
+        if rc < 0:
+            # killed by signal
+            rc = 128 - rc
+        gevent.sleep(host.latency)
+        channel.send_exit_status(rc)
+    except (OSError, EOFError):
+        proc.kill()
+    finally:
+        feeder.kill()
+        channel.close()
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    def __init__(self, host, flags=0):
+        super(_SFTPHandle, self).__init__(flags)
+        self._host = host
+
+    def read(self, offset, length):
+        data = super(_SFTPHandle, self).read(offset, length)
+        if isinstance(data, bytes):
+            self._host.delay(len(data))
+        return data
+
+    def write(self, offset, data):
+        self._host.delay(len(data))
+        return super(_SFTPHandle, self).write(offset, data)
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.fstat(self.readfile.fileno())
+            )
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+    def chattr(self, attr):
+        try:
+            _set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+
+def _set_file_attr(path, attr):
+    # paramiko's set_file_attr truncates file to zero instead of given size
+    if attr._flags & attr.FLAG_SIZE:
+        os.truncate(path, attr.st_size)
+        attr._flags &= ~attr.FLAG_SIZE
+    paramiko.SFTPServer.set_file_attr(path, attr)
+
+
+class _SFTPSubsystem(paramiko.SFTPServer):
+    def finish_subsystem(self):
+        # OpenSSH clients (eg. scp in SFTP mode) expect exit status
+        try:
+            self.sock.send_exit_status(0)
+        except (OSError, EOFError):
+            pass
+        super(_SFTPSubsystem, self).finish_subsystem()
+
+
+def _sftp_errors(func):
+    def wrapper(self, *args, **kwargs):
+        gevent.sleep(self._host.latency)
+        try:
+            return func(self, *args, **kwargs)
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+    return wrapper
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+    """SFTP server of virtual host."""
+
+    def __init__(self, server, *args, **kwargs):
+        super(_SFTPServer, self).__init__(server, *args, **kwargs)
+        self._host = server.host
+
+    @_sftp_errors
+    def list_folder(self, path):
+        path = self._host.path(path)
+        result = []
+        for name in os.listdir(path):
+            attr = paramiko.SFTPAttributes.from_stat(
+                os.lstat(os.path.join(path, name))
+            )
+            attr.filename = name
+            result.append(attr)
+        return result
+
+    @_sftp_errors
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(
+            os.stat(self._host.path(path))
+        )
+
+    @_sftp_errors
+    def lstat(self, path):
+        return paramiko.SFTPAttributes.from_stat(
+            os.lstat(self._host.path(path))
+        )
+
+    @_sftp_errors
+    def open(self, path, flags, attr):
+        path = self._host.path(path)
+        mode = getattr(attr, 'st_mode', None)
+        fd = os.open(path, flags, 0o666 if mode is None else mode)
+        if flags & os.O_CREAT and attr is not None:
+            attr._flags &= ~attr.FLAG_PERMISSIONS
+            paramiko.SFTPServer.set_file_attr(path, attr)
+        if flags & os.O_WRONLY:
+            fmode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            fmode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            fmode = 'rb'
+        handle = _SFTPHandle(self._host, flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, fmode)
+        return handle
+
+    @_sftp_errors
+    def remove(self, path):
+        os.remove(self._host.path(path))
+        return paramiko.SFTP_OK
+
+    @_sftp_errors
+    def rename(self, oldpath, newpath):
+        os.rename(self._host.path(oldpath), self._host.path(newpath))
+        return paramiko.SFTP_OK
+
+    @_sftp_errors
+    def posix_rename(self, oldpath, newpath):
+        os.replace(self._host.path(oldpath), self._host.path(newpath))
+        return paramiko.SFTP_OK
+
+    @_sftp_errors
+    def mkdir(self, path, attr):
+        path = self._host.path(path)
+        os.mkdir(path)
+        if attr is not None:
+            paramiko.SFTPServer.set_file_attr(path, attr)
+        return paramiko.SFTP_OK
+
+    @_sftp_errors
+    def rmdir(self, path):
+        os.rmdir(self._host.path(path))
+        return paramiko.SFTP_OK
+
+    @_sftp_errors
+    def chattr(self, path, attr):
+        _set_file_attr(self._host.path(path), attr)
+        return paramiko.SFTP_OK
+
+    @_sftp_errors
+    def symlink(self, target_path, path):
+        os.symlink(target_path, self._host.path(path))
+        return paramiko.SFTP_OK
+
+    @_sftp_errors
+    def readlink(self, path):
+        return os.readlink(self._host.path(path))
+
+    def canonicalize(self, path):
+        return os.path.normpath(self._host.path(path))
+
+
+class FakeSSHCluster(object):
+    """Set of virtual hosts served by in-process SSH/SFTP servers. Parameter
+    latency is delay (s) of each command and SFTP request, bandwidth
+    (bytes/s) limits transfers and command I/O, failure_rate is probability
+    of rejecting command execution and fail_commands is list of regexps
+    of commands, execution of which is always rejected. Rejected executions
+    raise paramiko.SSHException on client side. Parameter commands can
+    contain dictionary {command name: shell script} of stubbed commands
+    (default is STUB_COMMANDS).
+    """
+
+    def __init__(self, hosts=1, root=None, port=0, latency=0.0,
+                 bandwidth=None, failure_rate=0.0, fail_commands=(),
+                 commands=None):
+        self._count = hosts
+        self._own_root = root is None
+        self.root = root or tempfile.mkdtemp(prefix='kanzo-fakessh')
+        self.port = port
+        self._options = dict(
+            latency=latency, bandwidth=bandwidth, failure_rate=failure_rate,
+            fail_commands=fail_commands,
+        )
+        self.virtual_hosts = {}
+        self._listeners = []
+        self._transports = []
+        self.keyfile = os.path.join(self.root, 'id_rsa')
+        self._commands = STUB_COMMANDS if commands is None else commands
+
+    @property
+    def hosts(self):
+        return list(self.virtual_hosts.keys())
+
+    def sandbox(self, host):
+        return self.virtual_hosts[host].sandbox
+
+    def start(self):
+        key = _get_key('client')
+        key.write_private_key_file(self.keyfile)
+        os.chmod(self.keyfile, 0o600)
+        with open('{}.pub'.format(self.keyfile), 'w') as pubkey:
+            pubkey.write('{} {}\n'.format(key.get_name(), key.get_base64()))
+        # stubbed commands
+        bindir = os.path.join(self.root, 'bin')
+        os.makedirs(bindir, exist_ok=True)
+        for name, script in self._commands.items():
+            path = os.path.join(bindir, name)
+            with open(path, 'w') as stub:
+                stub.write('#!/bin/bash\n{}\n'.format(script))
+            os.chmod(path, 0o755)
+        self._options['env'] = dict(
+            os.environ,
+            PATH='{}:{}'.format(bindir, os.environ.get('PATH', '/usr/bin'))
+        )
+        for index in range(self._count):
+            address = '127.1.{}.{}'.format(index // 250, index % 250 + 1)
+            sock = gevent.socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((address, self.port))
+            sock.listen(128)
+            # all hosts listen on the same port
+            self.port = sock.getsockname()[1]
+            host = VirtualHost(
+                address, os.path.join(self.root, address), **self._options
+            )
+            self.virtual_hosts[address] = host
+            self._listeners.append(
+                (sock, gevent.spawn(self._accept, sock, host))
+            )
+        return self
+
+    def _accept(self, sock, host):
+        while True:
+            try:
+                conn, addr = sock.accept()
+            except OSError:
+                break
+            host.connections += 1
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(_get_key('host'))
+            transport.set_subsystem_handler(
+                'sftp', _SFTPSubsystem, _SFTPServer
+            )
+            self._transports.append(transport)
+            try:
+                transport.start_server(server=_Server(host))
+            except (paramiko.SSHException, EOFError, OSError) as ex:
+                LOG.debug('Failed to start SSH session: {}'.format(ex))
+
+    def stop(self):
+        for sock, acceptor in self._listeners:
+            acceptor.kill()
+            sock.close()
+        for transport in self._transports:
+            transport.close()
+        self._listeners = []
+        self._transports = []
+        if self._own_root:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @contextlib.contextmanager
+    def patch_shell(self):
+        """Points RemoteShell to cluster's port and client key. Connections
+        to virtual hosts are closed and their health is forgotten on exit.
+        """
+        orig = (
+            shell.RemoteShell.port, shell.RemoteShell.sshkey,
+            shell.RemoteShell.username
+        )
+        shell.RemoteShell.port = self.port
+        shell.RemoteShell.sshkey = self.keyfile
+        shell.RemoteShell.username = 'kanzo'
+        try:
+            yield self
+        finally:
+            (shell.RemoteShell.port, shell.RemoteShell.sshkey,
+             shell.RemoteShell.username) = orig
+            for host in self.virtual_hosts:
+                client = shell.RemoteShell._connections.pop(host, None)
+                if client is not None:
+                    client.close()
+            health.reset()
@@ -20,7 +20,7 @@ import tempfile
 
 from unittest import TestCase
 
-from kanzo.utils import shell
+from kanzo.utils import health, shell
 
 
 Execution = collections.namedtuple('Execution', [
@@ -117,15 +117,24 @@ class FakeRemoteShell(object):
     def reconnect(self):
         pass
 
-    def execute(self, cmd, can_fail=True, mask_list=None, log=True):
+    def execute(self, cmd, can_fail=True, mask_list=None, log=True,
+                output_limit=None, line_callback=None, timeout=None,
+                decode=True):
         history = self.history.setdefault(self.host, [])
         register = self.return_vals.setdefault(self.host, {})
-        return fake_execute(cmd, can_fail=can_fail, mask_list=mask_list,
-                            use_shell=True, log=log, history=history,
-                            register=register)
+        rc, stdout, stderr = fake_execute(
+            cmd, can_fail=can_fail, mask_list=mask_list, use_shell=True,
+            log=log, history=history, register=register
+        )
+        if not decode:
+            stdout, stderr = [
+                i.encode('utf-8') if isinstance(i, str) else i
+                for i in (stdout, stderr)
+            ]
+        return rc, stdout, stderr
 
     def run_script(self, script, can_fail=True, mask_list=None,
-                   log=True, description=None):
+                   log=True, description=None, timeout=None):
         hist = self.history.setdefault(self.host, [])
         for cmd in script:
             hist.append(Execution(cmd, can_fail, mask_list, log))
@@ -172,6 +181,7 @@ class BaseTestCase(TestCase):
         _execute_history = None
         FakeRemoteShell.history = {}
         FakeRemoteShell.return_vals = {}
+        health.reset()
 
     def check_history(self, host, commands, delete_after=False):
         history = FakeRemoteShell.history[host]
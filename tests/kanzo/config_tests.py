@@ -4,11 +4,14 @@ from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
 import os
+import shutil
+import socket
 import sys
+import tempfile
 
 from unittest import TestCase
 
-from kanzo.conf import Config, validators
+from kanzo.conf import Config, ConfigCache, validators
 from kanzo.core.plugins import meta_builder
 from kanzo.utils.config import iter_hosts, get_hosts
 
@@ -117,6 +120,124 @@ class ConfigTestCase(TestCase):
         }
         self.assertRaises(ValueError, Config, self._path, meta)
 
+    def test_cache(self):
+        """[Config] Test validated config cache"""
+        tmpdir = tempfile.mkdtemp(prefix='kanzo-test')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'config.txt')
+        with open(path, 'w') as confile:
+            confile.write('[test]\nvar=a\n')
+        # values captured by validators are part of cache key, so calls
+        # are not recorded to captured lists
+        self.calls = calls = []
+        self.checks = checks = []
+
+        @validators.pure
+        def counting_validator(value, key, config):
+            self.calls.append(value)
+
+        def checking_validator(value, key, config):
+            self.checks.append(value)
+
+        meta = {'test/var': {
+            'validators': [counting_validator, checking_validator]
+        }}
+        cachedir = os.path.join(tmpdir, 'cache')
+        ConfigCache._memory.clear()
+        self.addCleanup(ConfigCache._memory.clear)
+        for i in range(2):
+            config = Config(path, meta, cache=ConfigCache(cachedir))
+            self.assertEqual(config['test/var'], 'a')
+        self.assertEqual(calls, ['a'])
+        # validators which are not pure are always run
+        self.assertEqual(checks, ['a', 'a'])
+        # cache is persisted
+        ConfigCache._memory.clear()
+        config = Config(path, meta, cache=ConfigCache(cachedir))
+        self.assertEqual(calls, ['a'])
+        # changes of plugin versions, meta or config file invalidate cache
+        Config(path, meta, cache=ConfigCache(cachedir, {'plugin': '2'}))
+        self.assertEqual(calls, ['a', 'a'])
+        meta['test/var']['default'] = 'b'
+        Config(path, meta, cache=ConfigCache(cachedir))
+        self.assertEqual(calls, ['a', 'a', 'a'])
+        with open(path, 'w') as confile:
+            confile.write('[test]\nvar=c\n')
+        config = Config(path, meta, cache=ConfigCache(cachedir))
+        self.assertEqual(config['test/var'], 'c')
+        self.assertEqual(calls, ['a', 'a', 'a', 'c'])
+
+        # closures with the same qualified name do not share entries
+        def make_validator(allowed):
+            @validators.pure
+            def validate(value, key, config):
+                if value not in allowed:
+                    raise ValueError('Invalid value: %s' % value)
+            return validate
+        cache = ConfigCache()
+        self.assertNotEqual(
+            cache.key(path, {'test/var': {'validators': [make_validator('c')]}}),
+            cache.key(path, {'test/var': {'validators': [make_validator('a')]}})
+        )
+        # cached values are not shared between configs
+        meta = {'test/var': {'is_multi': True}}
+        first = Config(path, meta, cache=cache)
+        first['test/var'].append('x')
+        second = Config(path, meta, cache=cache)
+        self.assertEqual(second['test/var'], ['c'])
+        # only recently used entries are kept in memory
+        for index in range(ConfigCache.memory_size + 1):
+            cache.set(str(index), {'test/var': index})
+        cache.get('1')
+        cache.set('last', {})
+        self.assertEqual(
+            list(ConfigCache._memory),
+            [str(i) for i in range(3, ConfigCache.memory_size + 1)] +
+            ['1', 'last']
+        )
+
+    def test_lazy(self):
+        """[Config] Test lazy validation"""
+        calls = []
+
+        def counting_validator(value, key, config):
+            calls.append(key)
+
+        meta = {
+            'test/var': {'validators': [counting_validator]},
+            'test/validator1': {
+                'validators': [counting_validator, invalid_validator]
+            },
+        }
+        config = Config(self._path, meta, lazy=True)
+        self.assertEqual(calls, [])
+        self.assertEqual(config['test/var'], 'a')
+        self.assertEqual(config.get_validated('test/var'), 'a')
+        self.assertEqual(calls, ['test/var'])
+        self.assertRaises(ValueError, config.validate_all)
+        self.assertEqual(calls, ['test/var', 'test/validator1'])
+        config['test/validator1'] = 'valid'
+        config.validate_all()
+
+    def test_pipeline(self):
+        """[Config] Test compiled parameter pipelines"""
+        meta = {
+            'test/var': {
+                'validators': [validators.validate_regexp],
+                'regexps': ['^a$', '^b$'],
+                'options': ['a', 'b'],
+            },
+        }
+        config = Config(self._path, meta)
+        self.assertEqual(config['test/var'], 'a')
+        pipeline = config._pipelines['test/var']
+        config['test/var'] = 'b'
+        self.assertIs(config._pipelines['test/var'], pipeline)
+        self.assertRaises(ValueError, config.__setitem__, 'test/var', 'c')
+        meta['test/var']['options'].append('c')
+        config = Config(self._path, meta)
+        self.assertRaises(ValueError, config.__setitem__, 'test/var', 'c')
+
 
 class ValidatorsTestCase(TestCase):
 
@@ -147,3 +268,56 @@ class ValidatorsTestCase(TestCase):
         validators.validate_port('22')
         self.assertRaises(ValueError, validators.validate_port, '-2')
         self.assertRaises(ValueError, validators.validate_port, '1000000')
+
+    def test_hostname_resolver(self):
+        """[Config] Test hostname resolver"""
+        tmpdir = tempfile.mkdtemp(prefix='kanzo-test')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        calls = []
+
+        def resolve(hostname):
+            calls.append(hostname)
+            if hostname.startswith('bad'):
+                raise socket.gaierror('Name or service not known')
+
+        cache = os.path.join(tmpdir, 'hosts.json')
+        resolver = validators.HostnameResolver(
+            resolve=resolve, cache_file=cache
+        )
+        resolver.prefetch(['good1', 'good2', 'bad1', 'good1'])
+        self.assertEqual(sorted(calls), ['bad1', 'good1', 'good2'])
+        self.assertTrue(resolver.resolve('good1'))
+        self.assertFalse(resolver.resolve('bad1'))
+        self.assertEqual(len(calls), 3)
+        # cache is persisted
+        resolver = validators.HostnameResolver(
+            resolve=resolve, cache_file=cache
+        )
+        self.assertTrue(resolver.resolve('good2'))
+        self.assertEqual(len(calls), 3)
+        # expired negative results are resolved again
+        resolver = validators.HostnameResolver(
+            resolve=resolve, negative_ttl=0
+        )
+        self.assertFalse(resolver.resolve('bad2'))
+        self.assertFalse(resolver.resolve('bad2'))
+        self.assertEqual(calls[3:], ['bad2', 'bad2'])
+
+        # config resolves all hostnames before validation
+        prefetched = []
+        resolver = validators.HostnameResolver(resolve=resolve)
+        resolver.prefetch = prefetched.extend
+        orig_resolver, validators._resolver = validators._resolver, resolver
+        try:
+            path = os.path.join(_KANZO_PATH, 'kanzo/tests/test_config.txt')
+            meta = {
+                'test/var': {'validators': [validators.validate_hostname]},
+                'test/arr': {
+                    'validators': [validators.validate_hostname],
+                    'is_multi': True
+                },
+            }
+            Config(path, meta)
+        finally:
+            validators._resolver = orig_resolver
+        self.assertEqual(sorted(prefetched), ['a', 'a', 'b', 'c'])
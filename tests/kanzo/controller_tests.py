@@ -3,12 +3,23 @@
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
+import collections
+import functools
+import gevent
+import gevent.event
+import hashlib
+import json
 import os
 import sys
+import time
 
-from kanzo.core.controller import Controller
+from kanzo.conf import project
+from kanzo.core.controller import Controller, PluginData
+from kanzo.core.engines import AsyncioEngine
+from kanzo.core.plugins import step_graph
 from kanzo.core.main import simple_reporter
-from kanzo.utils import shell
+from kanzo.core.sharding import Shard
+from kanzo.utils import decorators, events, health, pools, shell
 
 from ..plugins import sql
 from . import _KANZO_PATH, register_execute, check_history
@@ -22,6 +33,47 @@ logdir={logdir}
 hiera_config=/etc/puppet/hiera.yaml
 '''
 
+HIERA_CONFIG = '''
+---
+:backends:
+  - yaml
+:yaml:
+  :datadir: {datadir}
+:hierarchy:
+  - "%{{::fqdn}}"
+  - config
+  - "%{{::kanzo_manifest}}/host"
+  - "%{{::kanzo_manifest}}/roles"
+  - "%{{::kanzo_manifest}}"
+'''
+
+
+@decorators.execution('cpu')
+def cpu_step(shell, config, info, messages):
+    info['checksum'] = hashlib.sha256(shell.host.encode()).hexdigest()
+    messages.append('Checksum computed on {}'.format(shell.host))
+
+
+@decorators.execution('blocking')
+def blocking_step(shell, config, info, messages):
+    shell.execute('# Running blocking step here')
+
+
+def shard_step(shell, config, info, messages):
+    info['pid'] = os.getpid()
+    messages.append('Step run on {}'.format(shell.host))
+
+
+def down_step(shell, config, info, messages):
+    for attempt in range(project.HOST_FAILURE_THRESHOLD):
+        health.get(shell.host).failure()
+
+
+def flood_step(shell, config, info, messages, payload=b''):
+    for index in range(2000):
+        events.emit('flood', 'event', host=shell.host, data='x' * 1024)
+    info['payload'] = len(payload)
+
 
 class ControllerTestCase(BaseTestCase):
     def setUp(self):
@@ -35,6 +87,7 @@ class ControllerTestCase(BaseTestCase):
     def tearDown(self):
         for drone in self._controller._drones.values():
             drone.clean()
+        super().tearDown()
 
     def test_controller_init(self):
         """[Controller] Test initialization."""
@@ -49,12 +102,14 @@ class ControllerTestCase(BaseTestCase):
             'logdir': os.path.join(basedir, 'logs')
         }
         puppet_conf = PUPPET_CONFIG.format(**confmeta)
+        hiera_conf = HIERA_CONFIG.format(**confmeta)
         self.check_history('192.168.6.66', [
             '# Running initialization steps here',
             'rpm -q puppet \|\| yum install -y puppet',
             'rpm -q tar \|\| yum install -y tar',
             'facter -p',
             'cat > /etc/puppet/puppet.conf <<EOF{}EOF'.format(puppet_conf),
+            'cat > /etc/puppet/hiera.yaml <<EOF{}EOF'.format(hiera_conf),
             '# Running preparation steps here',
             '# Running deployment planning here',
             'mkdir -p --mode=0700 /var/tmp/kanzo/\d{8}-\d{6}',
@@ -101,6 +156,427 @@ class ControllerTestCase(BaseTestCase):
             {'prerequisite_1', 'prerequisite_2'}
         )
 
+    def test_controller_diff(self):
+        """[Controller] Test config change mapping to deployments."""
+        self._controller.run_init(debug=True)
+        with open(self._path) as confile:
+            content = confile.read()
+        path = os.path.join(self._tmpdir, 'changed_config.txt')
+        with open(path, 'w') as confile:
+            confile.write(content.replace('admin_user=test', 'admin_user=x'))
+        self.assertEqual(self._controller.diff(path), {})
+        with open(path, 'w') as confile:
+            confile.write(content.replace('host=192.168.6.66',
+                                          'host=192.168.6.68'))
+        self.assertEqual(
+            dict(self._controller.diff(path)),
+            {'prerequisite_1': ['192.168.6.66'], 'final': ['192.168.6.66']}
+        )
+
+    def test_controller_events(self):
+        """[Controller] Test timing events and run summary."""
+        emitted = []
+        self._controller.register_status_callback(
+            emitted.append, calltype='event'
+        )
+        self._controller.run_init()
+        kinds = set((i['type'], i['name']) for i in emitted)
+        for kind in (
+                ('run', 'init'), ('phase', 'init'), ('phase', 'prep'),
+                ('phase', 'plan'), ('step', 'test_init'),
+                ('step', 'test_planning'), ('task', 'puppet-install')
+            ):
+            self.assertIn(kind, kinds)
+        steps = [
+            i for i in emitted
+            if i['type'] == 'step' and i['name'] == 'test_init'
+        ]
+        self.assertEqual(
+            sorted(i['host'] for i in steps), ['192.168.6.66', '192.168.6.67']
+        )
+        self.assertEqual(set(i['phase'] for i in steps), {'init'})
+        transfers = [i for i in emitted if i['type'] == 'transfer']
+        self.assertEqual(len(transfers), 2)
+        self.assertEqual(set(i['phase'] for i in transfers), {'plan'})
+        path = os.path.join(self._tmpdir, 'run-summary.json')
+        self.assertEqual(self._controller.save_summary(path), path)
+        with open(path) as summary_file:
+            summary = json.load(summary_file)
+        self.assertEqual(
+            list(summary['phases'].keys()), ['init', 'prep', 'plan']
+        )
+        self.assertGreater(
+            summary['hosts']['192.168.6.66']['bytes_sent'], 0
+        )
+        self.assertEqual(
+            sorted(summary['steps']['test_init']['hosts'].keys()),
+            ['192.168.6.66', '192.168.6.67']
+        )
+        path = self._controller.save_trace(
+            os.path.join(self._tmpdir, 'run-trace.json')
+        )
+        with open(path) as trace_file:
+            trace = json.load(trace_file)
+        self.assertIn('task', set(
+            i.get('cat') for i in trace['traceEvents']
+        ))
+
+    def test_step_execution(self):
+        """[Controller] Test execution of steps in pools."""
+        self._controller._plugins = [PluginData(
+            name='test', modules=[], resources=[],
+            init_steps=[cpu_step, blocking_step], prep_steps=[],
+            plan_steps=[], clean_steps=[]
+        )]
+        self.clear_history('192.168.6.66')
+        self.clear_history('192.168.6.67')
+        try:
+            self._controller._run_phase('init')
+        finally:
+            pools.close_pools()
+        for host in ('192.168.6.66', '192.168.6.67'):
+            drone = self._controller._drones[host]
+            self.assertEqual(
+                drone.info['checksum'],
+                hashlib.sha256(host.encode()).hexdigest()
+            )
+            self.assertIn('Checksum computed on {}'.format(host),
+                          self._controller._messages)
+            self.assertEqual(
+                shell.RemoteShell.history[host][0].cmd,
+                '# Running blocking step here'
+            )
+        self.assertRaises(ValueError, decorators.execution, 'gpu')
+
+    def test_step_graph(self):
+        """[Controller] Test concurrent execution of independent steps."""
+        events = []
+
+        def slow_step(shell, config, info, messages):
+            for i in range(1 if shell.host == '192.168.6.66' else 5):
+                pools.cooperate()
+            events.append(('slow', shell.host))
+
+        @decorators.independent
+        def fast_step(shell, config, info, messages):
+            events.append(('fast', shell.host))
+
+        @decorators.requires('slow_step', 'fast_step')
+        def final_step(shell, config, info, messages):
+            events.append(('final', shell.host))
+
+        self._controller._plugins = [PluginData(
+            name='test', modules=[], resources=[],
+            init_steps=[], prep_steps=[slow_step, fast_step, final_step],
+            plan_steps=[], clean_steps=[]
+        )]
+        self._controller._run_phase('prep')
+        self.assertEqual(sorted(events[:2]), [
+            ('fast', '192.168.6.66'),
+            ('fast', '192.168.6.67'),
+        ])
+        self.assertEqual(events[2:], [
+            ('slow', '192.168.6.66'),
+            ('final', '192.168.6.66'),
+            ('slow', '192.168.6.67'),
+            ('final', '192.168.6.67'),
+        ])
+        # invalid dependencies
+        decorators.requires('final_step')(fast_step)
+        self.assertRaises(ValueError, step_graph,
+                          [slow_step, fast_step, final_step])
+        decorators.requires(cpu_step)(fast_step)
+        self.assertRaises(ValueError, step_graph, [slow_step, fast_step])
+
+    def test_step_order(self):
+        """[Controller] Test undecorated steps wait for all hosts."""
+        finished = set()
+
+        def first_step(shell, config, info, messages):
+            for i in range(1 if shell.host == '192.168.6.66' else 5):
+                pools.cooperate()
+            finished.add(shell.host)
+
+        def second_step(shell, config, info, messages):
+            if finished != {'192.168.6.66', '192.168.6.67'}:
+                raise AssertionError(
+                    'Step started on {} before previous step finished on '
+                    'all hosts.'.format(shell.host)
+                )
+
+        self._controller._plugins = [PluginData(
+            name='test', modules=[], resources=[],
+            init_steps=[], prep_steps=[first_step, second_step],
+            plan_steps=[], clean_steps=[]
+        )]
+        self._controller._run_phase('prep')
+
+    def test_step_pause(self):
+        """[Controller] Test waiting steps do not block each other."""
+        def waiting_step(shell, config, info, messages):
+            pools.pause(0.2)
+
+        self._controller._plugins = [PluginData(
+            name='test', modules=[], resources=[],
+            init_steps=[], prep_steps=[waiting_step],
+            plan_steps=[], clean_steps=[]
+        )]
+        start = time.monotonic()
+        self._controller._run_phase('prep')
+        self.assertLess(time.monotonic() - start, 0.4)
+
+    def test_sequential_init(self):
+        """[Controller] Test Puppet installation waits for 'init' phase."""
+        events = []
+
+        def init_step(shell, config, info, messages):
+            for i in range(1 if shell.host == '192.168.6.66' else 10):
+                pools.cooperate()
+            events.append(('init', shell.host))
+
+        def install_puppet(drone):
+            events.append(('install', drone.host))
+
+        self._controller._install_puppet = install_puppet
+        self._controller._plugins = [PluginData(
+            name='test', modules=[], resources=[], init_steps=[init_step],
+            prep_steps=[], plan_steps=[], clean_steps=[]
+        )]
+        self._controller._run_phase('init')
+        self.assertEqual(
+            sorted(events[:2]),
+            [('init', '192.168.6.66'), ('init', '192.168.6.67')]
+        )
+        self.assertEqual(
+            sorted(events[2:]),
+            [('install', '192.168.6.66'), ('install', '192.168.6.67')]
+        )
+
+    def test_pipeline(self):
+        """[Controller] Test per-host pipelining of initialization."""
+        events = []
+
+        def init_step(shell, config, info, messages):
+            for i in range(1 if shell.host == '192.168.6.66' else 10):
+                pools.cooperate()
+            events.append(('init', shell.host))
+
+        def prep_step(shell, config, info, messages):
+            events.append(('prep', shell.host))
+
+        def next_step(shell, config, info, messages):
+            events.append(('next', shell.host))
+
+        @decorators.barrier
+        def barrier_step(shell, config, info, messages):
+            events.append(('barrier', shell.host))
+
+        self._controller._plugins = [PluginData(
+            name='test', modules=[], resources=[],
+            init_steps=[init_step],
+            prep_steps=[prep_step, next_step, barrier_step],
+            plan_steps=[], clean_steps=[]
+        )]
+        self._controller.run_init(pipeline=True)
+        self.assertLess(
+            events.index(('prep', '192.168.6.66')),
+            events.index(('init', '192.168.6.67'))
+        )
+        # undecorated steps do not wait for slow host either
+        self.assertLess(
+            events.index(('next', '192.168.6.66')),
+            events.index(('init', '192.168.6.67'))
+        )
+        self.assertEqual(sorted(events[-2:]), [
+            ('barrier', '192.168.6.66'), ('barrier', '192.168.6.67')
+        ])
+        self.assertIn('192.168.6.67', self._controller._info)
+
+    def test_host_down(self):
+        """[Controller] Test failing fast on hosts marked down."""
+        events = []
+
+        def init_step(shell, config, info, messages):
+            events.append(shell.host)
+
+        self._controller._plugins = [PluginData(
+            name='test', modules=[], resources=[], init_steps=[init_step],
+            prep_steps=[], plan_steps=[], clean_steps=[]
+        )]
+        host = health.get('192.168.6.67')
+        for i in range(host.threshold):
+            host.failure()
+        self.assertRaises(
+            health.HostDown, self._controller._run_phase, 'init'
+        )
+        self.assertNotIn('192.168.6.67', events)
+
+    def test_deployment_probe(self):
+        """[Controller] Test deployment probing host after cool-down."""
+        host = '192.168.6.66'
+        host_health = health.get(host)
+        host_health.cooldown = 0.05
+        for i in range(host_health.threshold):
+            host_health.failure()
+        plan = self._controller._plan
+        plan['manifests'] = collections.OrderedDict([
+            ('first', [(host, 'first')]),
+        ])
+        plan['dependency'] = {'first': set()}
+        plan['waiting'] = {'first'}
+
+        def deploy(*args, **kwargs):
+            # SSH operation of deployment probes the host
+            host_health.check()
+            host_health.success()
+
+        self._controller._drones[host].deploy = deploy
+        gevent.sleep(0.06)
+        self._controller._run_deployment()
+        self.assertEqual(host_health.state, health.CLOSED)
+
+    def test_asyncio_engine(self):
+        """[Controller] Test initialization using asyncio engine."""
+        controller = Controller(
+            self._path, work_dir=self._tmpdir, engine='asyncio',
+            local_tmpdir=os.path.join(self._tmpdir, 'asyncio')
+        )
+        controller.register_status_callback(simple_reporter)
+        self.clear_history('192.168.6.66')
+        self.clear_history('192.168.6.67')
+        try:
+            controller.run_init(pipeline=True)
+        finally:
+            for drone in controller._drones.values():
+                drone.clean()
+            controller.close()
+        # engine's executor and event loop are released
+        self.assertIsNone(controller._engine._executor)
+        self.assertTrue(controller._engine._loop.is_closed())
+        for host in ('192.168.6.66', '192.168.6.67'):
+            self.assertIn('facter -p', [
+                i.cmd for i in shell.RemoteShell.history[host]
+            ])
+            self.assertIn(host, controller._info)
+        self.assertEqual(
+            list(controller._plan['manifests'].keys()),
+            ['prerequisite_1', 'final', 'prerequisite_2']
+        )
+        # failed task cancels the run
+        engine = AsyncioEngine()
+
+        def run(task):
+            if task == 'fail':
+                raise RuntimeError('Task failed')
+
+        graph = {'fail': set(), 'next': {'fail'}, 'other': set()}
+        try:
+            self.assertRaises(RuntimeError, engine.run_graph, graph, run)
+            self.assertRaises(
+                RuntimeError, engine.run_graph, {'cycle': {'cycle'}}, run
+            )
+        finally:
+            engine.close()
+
+    def test_sharded_controller(self):
+        """[Controller] Test initialization using sharded controller."""
+        controller = Controller(
+            self._path, work_dir=self._tmpdir, shards=2,
+            local_tmpdir=os.path.join(self._tmpdir, 'sharded')
+        )
+        controller.register_status_callback(simple_reporter)
+        controller._plugins.append(PluginData(
+            name='test', modules=[], resources=[], init_steps=[],
+            prep_steps=[shard_step], plan_steps=[], clean_steps=[]
+        ))
+        try:
+            controller.run_init()
+        finally:
+            for drone in controller._drones.values():
+                drone.clean()
+            controller.close()
+        pids = set(
+            controller._info[host]['pid'] for host in controller._drones
+        )
+        self.assertEqual(pids, set(i.pid for i in controller._shards))
+        self.assertNotIn(os.getpid(), pids)
+        self.assertIn('Step run on 192.168.6.67', controller._messages)
+        self.assertEqual(
+            list(controller._plan['manifests'].keys()),
+            ['prerequisite_1', 'final', 'prerequisite_2']
+        )
+
+    def test_deployment_queue(self):
+        """[Controller] Test markers queue events of deployment."""
+        host = '192.168.6.66'
+        plan = self._controller._plan
+        plan['manifests'] = collections.OrderedDict([
+            ('first', [(host, 'first')]), ('second', [(host, 'second')]),
+        ])
+        plan['dependency'] = {'first': set(), 'second': {'first'}}
+        plan['waiting'] = {'first', 'second'}
+        self._controller._drones[host].deploy = lambda *args, **kwargs: None
+        received = []
+        events.subscribe(received.append)
+        try:
+            self._controller._run_deployment()
+        finally:
+            events.unsubscribe(received.append)
+        queue = [
+            (i['ready'], i['waiting'], i['in_progress'], i['finished'])
+            for i in received if i['type'] == 'queue'
+        ]
+        self.assertEqual(
+            queue, [(0, 1, 1, 0), (1, 1, 0, 1), (0, 0, 1, 1), (0, 0, 0, 2)]
+        )
+
+    def test_sharded_health(self):
+        """[Controller] Test passing health of hosts from shard workers."""
+        host = '192.168.6.66'
+        controller = Controller(
+            self._path, work_dir=self._tmpdir, shards=2,
+            local_tmpdir=os.path.join(self._tmpdir, 'sharded')
+        )
+        try:
+            controller._drones[host].run_step(down_step)
+            self.assertEqual(health.get(host).state, health.OPEN)
+            self.assertRaises(health.HostDown, health.check, host)
+            self.assertEqual(
+                health.get('192.168.6.67').state, health.CLOSED
+            )
+        finally:
+            for drone in controller._drones.values():
+                drone.clean()
+            controller.close()
+
+    def test_shard_pipe(self):
+        """[Controller] Test sending large payload to flooding shard."""
+        host = '192.168.6.66'
+        shard = Shard(0, [host], self._controller._config)
+        flooding = gevent.event.Event()
+        received = []
+
+        def receive(event):
+            if event['type'] == 'flood':
+                received.append(event)
+                flooding.set()
+        events.subscribe(receive)
+        try:
+            flood = gevent.spawn(shard.call, host, 'run_step', flood_step)
+            flooding.wait()
+            payload = b'x' * 16 * 1024 ** 2
+            kind, result, extra = shard.call(
+                host, 'run_step', functools.partial(flood_step, payload=payload)
+            )
+            self.assertEqual(kind, 'result')
+            self.assertEqual(extra['info']['payload'], len(payload))
+            kind, result, extra = flood.get(timeout=60)
+            self.assertEqual(kind, 'result')
+        finally:
+            events.unsubscribe(receive)
+            shard.close()
+        self.assertEqual(len(received), 4000)
+
     def test_node_init(self):
         """[Controller] Test deployment execution."""
         self._controller.run_init(debug=True)
@@ -3,10 +3,12 @@
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
+import greenlet
 import os
 import sys
+import time
 
-from kanzo.conf import Config
+from kanzo.conf import Config, project
 from kanzo.core.drones import Drone
 from kanzo.core.plugins import meta_builder
 from kanzo.utils import shell
@@ -42,9 +44,11 @@ HIERA_CONFIG = '''
 :yaml:
   :datadir: {datadir}
 :hierarchy:
-  - "%{{::type}}/%{{::fqdn}}"
-  - "%{{::type}}/common"
-  - common
+  - "%{{::fqdn}}"
+  - config
+  - "%{{::kanzo_manifest}}/host"
+  - "%{{::kanzo_manifest}}/roles"
+  - "%{{::kanzo_manifest}}"
 '''
 
 class DroneTestCase(BaseTestCase):
@@ -85,11 +89,13 @@ class DroneTestCase(BaseTestCase):
             'logdir': os.path.join(self._drone1._remote_builddir, 'logs')
         }
         puppet_conf = PUPPET_CONFIG.format(**confmeta)
+        hiera_conf = HIERA_CONFIG.format(**confmeta)
         self.check_history(host, [
             'rpm -q puppet \|\| yum install -y puppet',
             'rpm -q tar \|\| yum install -y tar',
             'facter -p',
             'cat > /etc/puppet/puppet.conf <<EOF{}EOF'.format(puppet_conf),
+            'cat > /etc/puppet/hiera.yaml <<EOF{}EOF'.format(hiera_conf),
         ])
         self.assertIn('domain', info)
         self.assertEquals(info['domain'], 'redhat.com')
@@ -98,6 +104,18 @@ class DroneTestCase(BaseTestCase):
         self.assertIn('uptime', info)
         self.assertEquals(info['uptime'], '11 days')
 
+        # Hiera configuration does not depend on PUPPET_CONFIGURATION
+        orig = project.PUPPET_CONFIGURATION
+        project.PUPPET_CONFIGURATION = []
+        try:
+            self.clear_history(host)
+            self._drone1.configure()
+        finally:
+            project.PUPPET_CONFIGURATION = orig
+        self.check_history(host, [
+            'cat > /etc/puppet/hiera.yaml <<EOF{}EOF'.format(hiera_conf),
+        ])
+
     def test_drone_build(self):
         """[Drone] Test Drone build register and transfer"""
         host = '10.0.0.3'
@@ -129,3 +147,118 @@ class DroneTestCase(BaseTestCase):
             ('rm -f {self._tmpdir}/host-10.0.0.3/'
                 'transfer-\w{{8}}.tar.gz'.format(**_locals))
         ])
+
+    def test_drone_deploy(self):
+        """[Drone] Test Drone deployment and log checking"""
+        host = '10.0.0.2'
+        reports = []
+        self._drone2._reporter = (
+            lambda *args, **kwargs: reports.append((args, kwargs))
+        )
+        log = '{}/logs/test.log'.format(self._drone2._remote_builddir)
+        shell.RemoteShell.register_execute(
+            host,
+            project.PUPPET_LOG_POLL_COMMAND.format(log=log, offset=1),
+            100,
+            'Notice: ok\n\x1b[1;31mError: failed\x1b[0m\n',
+            ''
+        )
+        self.assertRaises(RuntimeError, self._drone2.deploy, 'test')
+        self.check_history(host, [
+            (
+                '\( flock {0}/puppet-run.lock env '
+                'FACTER_kanzo_manifest=test puppet apply'.format(
+                    self._drone2._remote_builddir
+                )
+            ),
+            'test -e {0} && '.format(log),
+            # fetch of Puppet run report
+            '\\[ -e "{0}/reports/test" \\]'.format(
+                self._drone2._remote_builddir
+            ),
+            'mkdir -p --mode=0700 {0}/host-10.0.0.2'.format(self._tmpdir),
+            'tar -C {0}/reports -cpzf'.format(self._drone2._remote_builddir),
+            'rm -fr {0}/host-10.0.0.2/transfer'.format(self._tmpdir),
+        ])
+        self.assertEqual(len(reports), 1)
+        args, kwargs = reports[0]
+        self.assertEqual(args, ('manifest', 'test', 'error'))
+        self.assertEqual(kwargs['additional']['errors'][0].lineno, 2)
+        local_log = '{}/logs/test.log'.format(self._drone2._local_builddir)
+        with open(local_log) as logfile:
+            self.assertIn('Error: failed', logfile.read())
+
+    def test_drone_deploy_log_offset(self):
+        """[Drone] Test polling of Puppet log split inside character"""
+        host = '10.0.0.1'
+        log = '{}/logs/test.log'.format(self._drone1._remote_builddir)
+        self._drone1._reporter = lambda *args, **kwargs: None
+        shell.RemoteShell.register_execute(
+            host,
+            project.PUPPET_LOG_POLL_COMMAND.format(log=log, offset=1),
+            0, b'Notice: \xc5', b''
+        )
+        shell.RemoteShell.register_execute(
+            host,
+            project.PUPPET_LOG_POLL_COMMAND.format(log=log, offset=10),
+            100, b'\xbelu\xc5\xa5\nError: failed\n', b''
+        )
+        interval = project.PUPPET_LOG_POLL_INTERVAL
+        project.PUPPET_LOG_POLL_INTERVAL = 0.01
+        try:
+            self.assertRaises(RuntimeError, self._drone1.deploy, 'test')
+        finally:
+            project.PUPPET_LOG_POLL_INTERVAL = interval
+        local_log = '{}/logs/test.log'.format(self._drone1._local_builddir)
+        with open(local_log) as logfile:
+            self.assertEqual(
+                logfile.read(), 'Notice: \u017elu\u0165\nError: failed\n'
+            )
+
+    def test_drone_metrics_failure(self):
+        """[Drone] Test failed fetch of Puppet report is not fatal"""
+        def receive(*args, **kwargs):
+            raise shell.ExecutionTimeout('Transfer did not finish.')
+        self._drone1._transfer.receive = receive
+        self._drone1._fetch_metrics('test', '/tmp/reports/test')
+        self.assertNotIn('test', self._drone1.metrics)
+
+    def test_drone_poll_interval(self):
+        """[Drone] Test Puppet log polls wait for interval in greenlet"""
+        interval = project.PUPPET_LOG_POLL_INTERVAL
+        project.PUPPET_LOG_POLL_INTERVAL = 0.05
+        try:
+            self._drone1._polled()
+            start = time.monotonic()
+            # controller's greenlet switches to parent while waiting
+            waiting = greenlet.greenlet(self._drone1._wait)
+            switches = 0
+            waiting.switch()
+            while not waiting.dead:
+                switches += 1
+                waiting.switch()
+        finally:
+            project.PUPPET_LOG_POLL_INTERVAL = interval
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertGreater(switches, 1)
+
+    def test_drone_deploy_timeout(self):
+        """[Drone] Test Drone deployment timeout"""
+        host = '10.0.0.3'
+        interval = project.PUPPET_LOG_POLL_INTERVAL
+        project.PUPPET_LOG_POLL_INTERVAL = 0.05
+        try:
+            # Puppet log is never finished
+            self.assertRaises(
+                shell.ExecutionTimeout, self._drone3.deploy, 'test',
+                timeout=0.3
+            )
+        finally:
+            project.PUPPET_LOG_POLL_INTERVAL = interval
+        history = shell.RemoteShell.history[host]
+        self.assertGreater(len(history), 3)
+        self.assertTrue(history[-1].cmd.startswith('pkill -TERM -f'))
+        self.assertIn(
+            '{}/manifests/test.pp'.format(self._drone3._remote_builddir),
+            history[-1].cmd
+        )
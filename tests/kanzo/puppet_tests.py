@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import re
+import sys
+import traceback
+import yaml
+
+from kanzo.conf import Config
+from kanzo.core.puppet import HieraYAMLLibrary, LogChecker, _compile_rules
+from kanzo.core.puppet import ManifestLibrary
+from kanzo.core.puppet import parse_run_report, scan_log
+from kanzo.utils import pools
+
+from . import BaseTestCase
+
+
+class HieraTestCase(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._hiera = HieraYAMLLibrary()
+        self._hiera.set_dict('test', {'port': 80, 'user': 'admin'})
+        self._hiera.set_dict('test', {'port': 8080, 'debug': True},
+                             role='web')
+        self._hiera.set('test', 'user', 'root', host='10.0.0.1')
+        self._hiera.set('test', 'port', 8080, host='10.0.0.1')
+        self._hiera.assign_role('10.0.0.1', 'web')
+
+    def _load(self, *path):
+        with open(os.path.join(self._tmpdir, *path)) as hierafile:
+            return yaml.safe_load(hierafile)
+
+    def test_hiera_view(self):
+        """[Hiera] Test layered view of hiera file"""
+        view = self._hiera.view('test', host='10.0.0.1')
+        self.assertEqual(
+            dict(view), {'port': 8080, 'user': 'root', 'debug': True}
+        )
+        self.assertEqual(self._hiera.get('test', 'port', host='10.0.0.2'), 80)
+        self.assertRaises(TypeError, view.__setitem__, 'port', 22)
+        self.assertEqual(self._hiera.get('test', 'port'), 80)
+
+    def test_hiera_render(self):
+        """[Hiera] Test rendering of host overlays"""
+        self._hiera.render('test', tmpdir=self._tmpdir, host='10.0.0.1')
+        self.assertEqual(
+            self._load('test.yaml'), {'port': 80, 'user': 'admin'}
+        )
+        self.assertEqual(
+            self._load('test', 'roles.yaml'), {'port': 8080, 'debug': True}
+        )
+        # port is already overridden by role, so only user should be left
+        self.assertEqual(self._load('test', 'host.yaml'), {'user': 'root'})
+        # hosts without overlays get common layer only
+        tmpdir = os.path.join(self._tmpdir, 'other')
+        os.mkdir(tmpdir)
+        self._hiera.render('test', tmpdir=tmpdir, host='10.0.0.2')
+        self.assertEqual(os.listdir(tmpdir), ['test.yaml'])
+
+
+class ManifestTestCase(BaseTestCase):
+
+    def test_manifest_consumed(self):
+        """[Manifest] Test tracking of config parameters read by templates"""
+        path = os.path.join(self._tmpdir, 'config.txt')
+        with open(path, 'w') as confile:
+            confile.write('[sql]\nhost=10.0.0.1\nuser=admin\n')
+        config = Config(path, {'sql/host': {}, 'sql/user': {}})
+        library = ManifestLibrary()
+        fragment = os.path.join(self._tmpdir, 'fragment.pp')
+        with open(fragment, 'w') as template:
+            template.write(
+                "host { '{{ config['sql/host'] }}': port => {{ port }} }"
+            )
+        library._env.loader.searchpath.append(self._tmpdir)
+        library.add_fragment('test', 'fragment.pp', context={'port': 22})
+        self.assertEqual(
+            library.dump('test', config=config),
+            "host { '10.0.0.1': port => 22 }"
+        )
+        self.assertEqual(library.consumed('test'), {'sql/host'})
+
+    def test_manifest_render(self):
+        """[Manifest] Test precedence of config and errors in templates"""
+        library = ManifestLibrary()
+        library._env.loader.searchpath.append(self._tmpdir)
+        with open(os.path.join(self._tmpdir, 'fragment.pp'), 'w') as fragment:
+            fragment.write("$port = {{ port }}\n$unused = {{ 1 // zero }}")
+        library.add_fragment(
+            'render', 'fragment.pp', context={'port': 22, 'zero': 1}
+        )
+        # config values override fragment's context
+        self.assertEqual(
+            library.dump('render', config={'port': 2222}),
+            '$port = 2222\n$unused = 1'
+        )
+        self.assertEqual(library.consumed('render'), {'port'})
+        # errors point to line of template
+        try:
+            library.dump('render', config={'zero': 0})
+        except ZeroDivisionError:
+            frames = traceback.extract_tb(sys.exc_info()[2])
+        else:
+            self.fail('ZeroDivisionError was not raised')
+        self.assertIn(
+            (os.path.join(self._tmpdir, 'fragment.pp'), 2),
+            [(frame.filename, frame.lineno) for frame in frames]
+        )
+
+
+SUMMARY = '''---
+  version:
+    config: 1465400000
+    puppet: "3.8.7"
+  time:
+    file: 0.5
+    package: 12.25
+    config_retrieval: 1.5
+    total: 14.25
+    last_run: 1465400100
+'''
+
+REPORT = '''--- !ruby/object:Puppet::Transaction::Report
+  host: node1
+  resource_statuses:
+    "Package[httpd]": !ruby/object:Puppet::Resource::Status
+      resource_type: Package
+      title: httpd
+      evaluation_time: 10.0
+    "Package[vim]": !ruby/object:Puppet::Resource::Status
+      resource_type: Package
+      title: vim
+      evaluation_time: 2.25
+    "File[/etc/motd]": !ruby/object:Puppet::Resource::Status
+      resource_type: File
+      title: /etc/motd
+      evaluation_time: 0.5
+'''
+
+
+class ReportTestCase(BaseTestCase):
+
+    def test_parse_report(self):
+        """[Report] Test Puppet run report parsing"""
+        summary = os.path.join(self._tmpdir, 'last_run_summary.yaml')
+        report = os.path.join(self._tmpdir, 'last_run_report.yaml')
+        with open(summary, 'w') as statefile:
+            statefile.write(SUMMARY)
+        with open(report, 'w') as statefile:
+            statefile.write(REPORT)
+        metrics = parse_run_report(summary, report, slowest=2)
+        self.assertEqual(metrics['total'], 14.25)
+        self.assertEqual(
+            metrics['types'], {'file': 0.5, 'package': 12.25}
+        )
+        self.assertEqual(metrics['phases'], {'config_retrieval': 1.5})
+        self.assertEqual(
+            metrics['slowest'],
+            [['Package[httpd]', 10.0], ['Package[vim]', 2.25]]
+        )
+        # report only
+        metrics = parse_run_report(None, report)
+        self.assertEqual(metrics['total'], 12.75)
+        self.assertEqual(metrics['types'], {'package': 12.25, 'file': 0.5})
+        self.assertEqual(metrics['phases'], {})
+
+
+class CustomLogChecker(LogChecker):
+    ignore = [re.compile('expected failure')]
+    surrogates = [
+        (re.compile('Package\\[(\\w+)\\]'), 'Failed to install %(arg1)s')
+    ]
+    rules = _compile_rules(['expected failure'], ['Package\\[(\\w+)\\]'])
+
+
+class LogCheckerTestCase(BaseTestCase):
+
+    def test_rules_backreference(self):
+        """[LogChecker] Test rules with backreferences are not combined"""
+        self.assertIsNotNone(_compile_rules(['(a)b'], ['\\\\1']))
+        self.assertIsNone(_compile_rules(['(a)b'], ['(x+) \\1']))
+        self.assertIsNone(_compile_rules(['(?P<x>a)(?P=x)'], []))
+
+    def test_log_feed(self):
+        """[LogChecker] Test streamed log validation"""
+        checker = CustomLogChecker()
+        self.assertEqual(checker.feed('Notice: start\nError: first'), [])
+        errors = checker.feed(
+            ' one\n\x1b[1;31mError: expected failure\x1b[0m\nNotice: ok\n'
+        )
+        self.assertEqual(
+            [(i.lineno, i.message) for i in errors], [(2, 'Error: first one')]
+        )
+        checker.feed('Error: Package[httpd] failed')
+        result = checker.close()
+        self.assertEqual(result.lines, 5)
+        self.assertEqual(
+            [(i.lineno, i.message) for i in result.errors],
+            [(2, 'Error: first one'), (5, 'Failed to install httpd')]
+        )
+        self.assertRaises(RuntimeError, result.raise_for_errors)
+
+    def test_log_validate(self):
+        """[LogChecker] Test log file validation"""
+        path = os.path.join(self._tmpdir, 'puppet.log')
+        with open(path, 'w') as logfile:
+            logfile.write('Notice: all fine\nNotice: still fine\n')
+        result = CustomLogChecker.validate(path, chunk_size=8)
+        self.assertFalse(result.failed)
+        self.assertEqual(result.lines, 2)
+        with open(path, 'a') as logfile:
+            logfile.write('Error: one\nError: expected failure\nError: two')
+        try:
+            CustomLogChecker.validate(path, chunk_size=8)
+        except RuntimeError as ex:
+            self.assertEqual(str(ex), 'Error: one\nError: two')
+        else:
+            raise AssertionError('Log validation did not fail.')
+
+    def test_log_scan(self):
+        """[LogChecker] Test memory-mapped log scanning"""
+        path = os.path.join(self._tmpdir, 'puppet.log')
+        with open(path, 'w') as logfile:
+            logfile.write(
+                'Debug: foo\n' * 1000 +
+                '\x1b[1;31mError: expected failure\x1b[0m\n' +
+                'Debug: bar\n' * 1000 +
+                'Error: Package[vim] failed'
+            )
+        result = CustomLogChecker.scan(path, window=64)
+        self.assertEqual(result.lines, 2002)
+        self.assertEqual(
+            [(i.lineno, i.message) for i in result.errors],
+            [(2002, 'Failed to install vim')]
+        )
+        # scanning in process pool with default rules
+        try:
+            result = pools.wait_for(
+                pools.get_pool('process').submit(scan_log, path)
+            )
+        finally:
+            pools.close_pools()
+        self.assertEqual(
+            [i.lineno for i in result.errors], [1001, 2002]
+        )
@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import gevent
 import os
+import paramiko
+import re
+import tempfile
+import time
 
-from kanzo.utils import shell
+from unittest import TestCase
 
+from kanzo.conf import project
+from kanzo.core.drones import Drone
+from kanzo.utils import decorators, health, pools, sessions, shell
+
+from ..fakessh import FakeSSHCluster
 from . import BaseTestCase
 
 
@@ -95,3 +105,236 @@ class SFTPTransferTestCase(BaseTestCase):
             'tar \-C /path/to \-cpzf /bar/transfer\-\w{8}\.tar\.gz foodir',
             'rm -fr /bar/transfer\-\w{8}\.tar\.gz'
         ])
+
+
+@decorators.execution('blocking')
+def blocking_step(shell, config, info, messages):
+    info['blocking'] = shell.execute('echo blocking')[1]
+
+
+@decorators.execution('cpu')
+def cpu_step(shell, config, info, messages):
+    info['cpu'] = shell.host
+
+
+class FakeSSHTestCase(TestCase):
+
+    def setUp(self):
+        self._cluster = FakeSSHCluster(hosts=3).start()
+        self._patch = self._cluster.patch_shell()
+        self._patch.__enter__()
+        self._tmpdir = tempfile.mkdtemp(dir=self._cluster.root)
+        self.testdir = os.path.join(self._tmpdir, 'foodir')
+        os.mkdir(self.testdir)
+        with open(os.path.join(self.testdir, 'file.foo'), 'w') as foo:
+            foo.write('test' * 1000)
+
+    def tearDown(self):
+        self._patch.__exit__(None, None, None)
+        self._cluster.stop()
+
+    def test_remote_shell(self):
+        """[FakeSSH] Test commands and scripts over SSH"""
+        host = self._cluster.hosts[0]
+        sandbox = self._cluster.sandbox(host)
+        sh = shell.RemoteShell(host)
+        rc, stdout, stderr = sh.execute('echo out; echo err >&2; pwd')
+        self.assertEqual((rc, stdout, stderr),
+                         (0, 'out\n{}\n'.format(sandbox), 'err\n'))
+        rc, stdout, stderr = sh.execute('exit 3', can_fail=False)
+        self.assertEqual(rc, 3)
+        rc, stdout, stderr = sh.run_script(['echo script'])
+        self.assertEqual(stdout, 'script\n')
+        # ssh-key was registered by script on connect
+        self.assertTrue(
+            os.path.exists(os.path.join(sandbox, '.ssh', 'authorized_keys'))
+        )
+        # commands run concurrently on all hosts
+        results = gevent.joinall([
+            gevent.spawn(shell.RemoteShell(i).execute, 'hostname -I; true')
+            for i in self._cluster.hosts
+        ])
+        self.assertEqual([i.value[0] for i in results], [0, 0, 0])
+
+    def test_output_streaming(self):
+        """[FakeSSH] Test concurrent draining of large outputs"""
+        sh = shell.RemoteShell(self._cluster.hosts[0])
+        # stderr larger than SSH window is written before stdout
+        size = 3 * 1024 ** 2
+        rc, stdout, stderr = sh.execute(
+            'head -c {size} /dev/zero | tr "\\0" e >&2; echo out'.format(
+                **locals()
+            ),
+            log=False
+        )
+        self.assertEqual((rc, stdout, len(stderr)), (0, 'out\n', size))
+        lines = []
+        rc, stdout, stderr = sh.execute(
+            'seq 1000', output_limit=100, log=False,
+            line_callback=lambda name, line: lines.append(line)
+        )
+        self.assertEqual(len(lines), 1000)
+        self.assertTrue(stdout.startswith('1\n2\n'))
+        self.assertIn('bytes of output dropped', stdout)
+
+    def test_timeouts(self):
+        """[FakeSSH] Test timeouts and cancellation of remote commands"""
+        host = self._cluster.hosts[0]
+        sh = shell.RemoteShell(host)
+        start = time.monotonic()
+        self.assertRaises(
+            shell.ExecutionTimeout, sh.execute,
+            'sleep 31.25 & echo started; sleep 31.25', timeout=0.5
+        )
+        self.assertLess(time.monotonic() - start, 10)
+        # whole process group of timed out command was killed
+        gevent.sleep(0.2)
+        rc, stdout, stderr = shell.execute(
+            ['pgrep', '-f', 'sleep 31.25'], can_fail=False, log=False
+        )
+        self.assertEqual(rc, 1)
+                # commands finishing in time are not affected
+        self.assertEqual(
+            sh.execute('echo ok; exit 3', can_fail=False, timeout=5),
+            (3, 'ok\n', '')
+        )
+        # transfers respect the deadline
+        self._cluster.virtual_hosts[host].latency = 0.3
+        transfer = shell.SFTPTransfer(
+            host, os.path.join(self._cluster.sandbox(host), 'tmp'),
+            self._tmpdir
+        )
+        self.assertRaises(
+            shell.ExecutionTimeout, transfer.send, self.testdir,
+            os.path.join(self._cluster.sandbox(host), 'dest'), timeout=0.5
+        )
+
+    def test_failure_injection(self):
+        """[FakeSSH] Test injected failures of commands"""
+        host = self._cluster.hosts[1]
+        sh = shell.RemoteShell(host)
+        self._cluster.virtual_hosts[host].fail_commands = [
+            re.compile('^fail')
+        ]
+        orig_delay = project.SHELL_RETRY_DELAY
+        project.SHELL_RETRY_DELAY = 0
+        try:
+            for attempt in range(project.HOST_FAILURE_THRESHOLD):
+                self.assertRaises(RuntimeError, sh.execute, 'fail now')
+        finally:
+            project.SHELL_RETRY_DELAY = orig_delay
+        self.assertNotIn('fail now', self._cluster.virtual_hosts[host].commands)
+        # host is marked down, so further commands fail without retries
+        start = time.monotonic()
+        self.assertRaises(health.HostDown, sh.execute, 'echo ok')
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertNotIn('echo ok', self._cluster.virtual_hosts[host].commands)
+        # other hosts are not affected
+        rc, stdout, stderr = shell.RemoteShell(
+            self._cluster.hosts[0]
+        ).execute('echo ok')
+        self.assertEqual(stdout, 'ok\n')
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(shell.IgnorePolicy())
+        client.connect(host, port=self._cluster.port, username='test',
+                       key_filename=self._cluster.keyfile)
+        try:
+            self.assertRaises(
+                paramiko.SSHException, client.exec_command, 'fail again'
+            )
+        finally:
+            client.close()
+
+    def test_transfers(self):
+        """[FakeSSH] Test SFTP and SCP transfers"""
+        for host, transfer_class in zip(
+                self._cluster.hosts,
+                (shell.SFTPTransfer, shell.SCPTransfer)):
+            sandbox = self._cluster.sandbox(host)
+            transfer = transfer_class(
+                host, os.path.join(sandbox, 'tmp'), self._tmpdir
+            )
+            transfer.send(self.testdir, os.path.join(sandbox, 'dest'))
+            path = os.path.join(sandbox, 'dest', 'foodir', 'file.foo')
+            with open(path) as foo:
+                self.assertEqual(foo.read(), 'test' * 1000)
+            local = os.path.join(self._tmpdir, host)
+            transfer.receive(os.path.join(sandbox, 'dest'), local)
+            self.assertEqual(
+                os.listdir(os.path.join(local, 'dest', 'foodir')),
+                ['file.foo']
+            )
+            # temporary tarballs are removed
+            self.assertEqual(os.listdir(os.path.join(sandbox, 'tmp')), [])
+
+    def test_session_replay(self):
+        """[FakeSSH] Test recording and replaying of remote session"""
+        host = self._cluster.hosts[0]
+        sandbox = self._cluster.sandbox(host)
+        remote = os.path.join(sandbox, 'dest')
+        path = os.path.join(self._tmpdir, 'session.jsonl')
+        with sessions.recording(path):
+            sh = shell.RemoteShell(host)
+            recorded = sh.execute('date +%N; echo err >&2')
+            self.assertEqual(sh.execute('exit 2', can_fail=False)[0], 2)
+            transfer = shell.SFTPTransfer(
+                host, os.path.join(sandbox, 'tmp'), self._tmpdir
+            )
+            transfer.send(self.testdir, remote)
+            transfer.receive(remote, os.path.join(self._tmpdir, 'recorded'))
+        # replay does not touch hosts
+        shell.RemoteShell._connections.pop(host).close()
+        os.rename(remote, os.path.join(sandbox, 'moved'))
+        with sessions.replaying(path, time_scale=0):
+            sh = shell.RemoteShell(host)
+            self.assertIsInstance(sh, sessions.ReplayShell)
+            self.assertEqual(sh.execute('date +%N; echo err >&2'), recorded)
+            self.assertRaises(RuntimeError, sh.execute, 'exit 2')
+            # commands missing in session succeed
+            self.assertEqual(sh.execute('uptime'), (0, '', ''))
+            transfer = shell.SFTPTransfer(
+                host, os.path.join(sandbox, 'tmp'), self._tmpdir
+            )
+            transfer.send(self.testdir, remote)
+            local = os.path.join(self._tmpdir, 'replayed')
+            transfer.receive(remote, local)
+            path = os.path.join(local, 'dest', 'foodir', 'file.foo')
+            with open(path) as foo:
+                self.assertEqual(foo.read(), 'test' * 1000)
+        self.assertNotIn(host, shell.RemoteShell._connections)
+        self.assertIsNot(shell.RemoteShell, sessions.ReplayShell)
+
+    def test_drone_log_stream(self):
+        """[FakeSSH] Test streaming of Puppet log larger than output limit"""
+        host = self._cluster.hosts[0]
+        log = os.path.join(self._cluster.sandbox(host), 'test.log')
+        content = ''.join('line {}\n'.format(i) for i in range(1000))
+        with open(log, 'w') as logfile:
+            logfile.write(content)
+        drone = Drone(host, {}, [], work_dir=self._tmpdir)
+        local_log = os.path.join(self._tmpdir, 'test.log')
+        limit = project.SHELL_OUTPUT_LIMIT
+        project.SHELL_OUTPUT_LIMIT = 100
+        try:
+            drone._stream_log('test', log, local_log, None)
+        finally:
+            project.SHELL_OUTPUT_LIMIT = limit
+        with open(local_log) as logfile:
+            self.assertEqual(logfile.read(), content)
+
+    def test_drone_step_execution(self):
+        """[FakeSSH] Test steps run in pools over SSH"""
+        host = self._cluster.hosts[0]
+        drone = Drone(host, {}, [], work_dir=self._tmpdir)
+        try:
+            drone.run_step(blocking_step)
+            self.assertEqual(drone.info['blocking'], 'blocking\n')
+            # cpu step which does not run commands does not connect to host
+            connections = self._cluster.virtual_hosts[host].connections
+            drone.run_step(cpu_step)
+            self.assertEqual(drone.info['cpu'], host)
+            self.assertEqual(
+                self._cluster.virtual_hosts[host].connections, connections
+            )
+        finally:
+            pools.close_pools()
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import gevent
+import greenlet
 import grp
+import io
 import os
 import paramiko
+import pstats
 import pwd
+import shutil
 import subprocess
+import tempfile
 import types
 from unittest import TestCase
 try:
@@ -12,8 +18,10 @@ try:
 except ImportError:
     from mock import Mock
 
-from kanzo.utils.decorators import retry
-from kanzo.utils.shell import RemoteShell, execute
+from kanzo.conf import project
+from kanzo.utils import events, health, metrics, profiling
+from kanzo.utils.decorators import backoff_delay, retry
+from kanzo.utils.shell import OutputBuffer, RemoteShell, execute
 from kanzo.utils.shortcuts import get_current_user, get_current_username
 from kanzo.utils.strings import color_text, mask_string, state_message
 
@@ -35,21 +43,32 @@ def run_sum():
 class FakeChannel(object):
     def __init__(self):
         self.exit_code = 0
+        self.eof_received = True
+        self.closed = False
+        self.stdout = b''
+        self.stderr = b''
 
     def recv_exit_status(self):
         return self.exit_code
 
+    def recv_ready(self):
+        return bool(self.stdout)
 
-class FakeChannelFile(object):
-    def __init__(self):
-        self.output = []
-        self.channel = FakeChannel()
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
 
-    def __iter__(self):
-        return iter(self.output)
+    def recv(self, nbytes):
+        data, self.stdout = self.stdout[:nbytes], self.stdout[nbytes:]
+        return data
 
-    def readlines(self):
-        return self.output
+    def recv_stderr(self, nbytes):
+        data, self.stderr = self.stderr[:nbytes], self.stderr[nbytes:]
+        return data
+
+
+class FakeChannelFile(object):
+    def __init__(self, channel):
+        self.channel = channel
 
 
 class FakeSSHClient(object):
@@ -65,13 +84,18 @@ class FakeSSHClient(object):
     def close(self):
         pass
 
-    def exec_command(self, cmd):
-        chf = FakeChannelFile()
+    def exec_command(self, cmd, timeout=None):
+        channel = FakeChannel()
         if cmd == 'pass':
-            chf.output = ['passed']
+            channel.stdout = channel.stderr = b'passed'
+        elif cmd == 'lines':
+            channel.stdout = b'line1\nline2\nlast'
+        elif cmd == 'broken':
+            raise paramiko.SSHException('Channel closed.')
         else:
-            chf.channel.exit_code = 1
-            chf.output = ['failed']
+            channel.exit_code = 1
+            channel.stdout = channel.stderr = b'failed'
+        chf = FakeChannelFile(channel)
         return chf, chf, chf
 
 
@@ -88,7 +112,7 @@ class FakePopen(object):
         self.returncode = 0
         self.cmd = cmd
 
-    def communicate(self, input=None):
+    def communicate(self, input=None, timeout=None):
         lines = input.split('\n') if input else []
         # test script prefix
         if lines:
@@ -132,6 +156,7 @@ class UtilsTestCase(TestCase):
         os.getgid = self.real_getgid
         paramiko.SSHClient = self.real_sshclient
         subprocess.Popen = self.real_popen
+        health.reset()
 
     def test_decorators(self):
         """[Utils] Test decorators"""
@@ -143,6 +168,16 @@ class UtilsTestCase(TestCase):
             pass
         self.assertEqual(cnt, 4)
         self.assertRaises(ValueError, run_sum)
+        # exponential backoff with jitter
+        self.assertEqual(backoff_delay(3, 0.5), 4.0)
+        self.assertEqual(backoff_delay(10, 0.5, max_delay=30), 30)
+        for attempt in range(5):
+            delay = backoff_delay(attempt, 1, max_delay=8, jitter=0.5)
+            self.assertTrue(
+                min(8, 2 ** attempt) / 2 <= delay <= min(8, 2 ** attempt)
+            )
+        self.assertRaises(ValueError, retry, backoff=0.5)
+        self.assertRaises(ValueError, retry, jitter=2)
 
     def test_strings(self):
         """[Utils] Test strings"""
@@ -209,3 +244,250 @@ class UtilsTestCase(TestCase):
         self.assertEqual(out, 'passed')
         rc, out, err = execute(['ssh', 'bash -x'])
         self.assertEqual(out, 'passed')
+
+    def test_shell_output(self):
+        """[Utils] Test streaming of command output"""
+        RemoteShell._connections['127.0.0.1'] = FakeSSHClient()
+        shell = RemoteShell('127.0.0.1')
+        lines = []
+        rc, out, err = shell.execute(
+            'lines', line_callback=lambda *args: lines.append(args)
+        )
+        self.assertEqual(out, 'line1\nline2\nlast')
+        self.assertEqual(lines, [
+            ('stdout', 'line1\n'), ('stdout', 'line2\n'), ('stdout', 'last')
+        ])
+        rc, out, err = shell.execute('lines', decode=False)
+        self.assertEqual(out, b'line1\nline2\nlast')
+        # only head and tail of output over limit is kept
+        rc, out, err = shell.execute('lines', output_limit=8)
+        self.assertEqual(
+            out, 'line\n[... 8 bytes of output dropped ...]\nlast'
+        )
+        # output_limit 0 overrides project's limit by unlimited output
+        orig_limit = project.SHELL_OUTPUT_LIMIT
+        project.SHELL_OUTPUT_LIMIT = 8
+        try:
+            rc, out, err = shell.execute('lines')
+            self.assertIn('bytes of output dropped', out)
+            rc, out, err = shell.execute('lines', output_limit=0)
+            self.assertEqual(out, 'line1\nline2\nlast')
+        finally:
+            project.SHELL_OUTPUT_LIMIT = orig_limit
+        output = OutputBuffer('stdout', limit=5)
+        for chunk in (b'ab', b'cdefg', b'h', b'ijk'):
+            output.feed(chunk)
+        self.assertEqual(
+            output.close(), 'abc\n[... 6 bytes of output dropped ...]\njk'
+        )
+        # output over memory limit is spilled to disk
+        output = OutputBuffer('stdout', memory_limit=10)
+        output.feed('žluť\n'.encode('utf-8'))
+        self.assertFalse(output._file._rolled)
+        output.feed(b'x' * 10)
+        self.assertTrue(output._file._rolled)
+        self.assertEqual(output.close(), 'žluť\n' + 'x' * 10)
+
+    def test_host_health(self):
+        """[Utils] Test circuit breaker of hosts"""
+        host = health.HostHealth('10.0.0.1', threshold=2, cooldown=0.05)
+        host.failure()
+        host.check()
+        host.success()
+        host.failure()
+        self.assertEqual(host.state, health.CLOSED)
+        host.failure()
+        self.assertEqual(host.state, health.OPEN)
+        self.assertRaises(health.HostDown, host.check)
+        # single operation is let through after cool-down
+        gevent.sleep(0.06)
+        host.check()
+        self.assertEqual(host.state, health.HALF_OPEN)
+        host.failure()
+        self.assertRaises(health.HostDown, host.check)
+        gevent.sleep(0.06)
+        host.check()
+        # other operations fail until the probe finishes
+        probe = gevent.spawn(host.check)
+        self.assertRaises(health.HostDown, probe.get)
+        host.success()
+        self.assertEqual(host.state, health.CLOSED)
+        gevent.spawn(host.check).get()
+        # fail fast check does not become the probe
+        host.failure()
+        host.failure()
+        gevent.sleep(0.06)
+        host.check(probe=False)
+        self.assertEqual(host.state, health.OPEN)
+        # probe finished without result lets other operation probe the host
+        def release():
+            host.check()
+            host.release()
+        gevent.spawn(release).get()
+        self.assertEqual(host.state, health.HALF_OPEN)
+        host.check()
+        host.success()
+
+        # failing host is marked down and further commands fail fast
+        orig_delay = project.SHELL_RETRY_DELAY
+        project.SHELL_RETRY_DELAY = 0
+        RemoteShell._connections['127.0.0.1'] = FakeSSHClient()
+        shell = RemoteShell('127.0.0.1')
+        try:
+            # failed retry cycle of command counts as single failure
+            for attempt in range(project.HOST_FAILURE_THRESHOLD):
+                self.assertEqual(health.get('127.0.0.1').state, health.CLOSED)
+                self.assertRaises(RuntimeError, shell.execute, 'broken')
+            self.assertEqual(health.get('127.0.0.1').state, health.OPEN)
+            self.assertRaises(health.HostDown, shell.execute, 'pass')
+            self.assertRaises(health.HostDown, shell.run_script, ['pass'])
+            self.assertRaises(health.HostDown, RemoteShell, '127.0.0.1')
+        finally:
+            project.SHELL_RETRY_DELAY = orig_delay
+            RemoteShell._connections.pop('127.0.0.1')
+
+    def test_events(self):
+        """[Utils] Test timing events"""
+        RemoteShell._connections['127.0.0.1'] = FakeSSHClient()
+        shell = RemoteShell('127.0.0.1')
+        summary = events.RunSummary()
+        emitted = []
+        events.subscribe(summary)
+        events.subscribe(emitted.append)
+        try:
+            with events.context(phase='init', step='test'):
+                shell.execute('pass')
+                self.assertRaises(RuntimeError, shell.execute, 'fail')
+                with events.span('step', 'test', host='127.0.0.1'):
+                    events.bind(shell.run_script, marker='final')(['pass'])
+        finally:
+            events.unsubscribe(summary)
+            events.unsubscribe(emitted.append)
+        shell.execute('pass')
+        self.assertEqual(
+            [(i['type'], i['name'], i.get('rc')) for i in emitted],
+            [('ssh', 'execute', 0), ('ssh', 'execute', 1),
+             ('ssh', 'script', 0), ('step', 'test', None)]
+        )
+        for event in emitted:
+            self.assertEqual(event['phase'], 'init')
+            self.assertEqual(event['host'], '127.0.0.1')
+            self.assertLessEqual(event['start'], event['end'])
+        self.assertEqual(emitted[2]['marker'], 'final')
+        self.assertNotIn('marker', emitted[3])
+        result = summary.summary()
+        self.assertEqual(result['hosts']['127.0.0.1']['ssh_commands'], 3)
+        self.assertEqual(list(result['steps'].keys()), ['test'])
+
+    def test_chrome_trace(self):
+        """[Utils] Test export of events to Chrome trace"""
+        emitted = [
+            {'type': 'marker', 'name': 'first', 'start': 10.0, 'end': 12.0,
+             'requires': []},
+            {'type': 'apply', 'name': 'first', 'host': 'host1',
+             'marker': 'first', 'start': 10.0, 'end': 11.0},
+            {'type': 'apply', 'name': 'first', 'host': 'host2',
+             'marker': 'first', 'start': 10.0, 'end': 12.0},
+            {'type': 'ssh', 'name': 'execute', 'host': 'host2',
+             'marker': 'first', 'start': 10.5, 'end': 10.75, 'rc': 0},
+            {'type': 'marker', 'name': 'second', 'start': 12.0, 'end': 13.0,
+             'requires': ['first']},
+            {'type': 'apply', 'name': 'second', 'host': 'host1',
+             'marker': 'second', 'start': 12.0, 'end': 13.0},
+        ]
+        trace = events.chrome_trace(emitted)['traceEvents']
+        tracks = dict(
+            (i['args']['name'], i['tid']) for i in trace
+            if i['ph'] == 'M' and i['name'] == 'thread_name'
+        )
+        self.assertEqual(
+            tracks, {'controller': 0, 'host1': 1, 'host2': 2}
+        )
+        spans = [
+            (i['cat'], i['tid'], i['ts'], i['dur'])
+            for i in trace if i['ph'] == 'X'
+        ]
+        self.assertIn(('ssh', 2, 500000.0, 250000.0), spans)
+        self.assertIn(('marker', 0, 2000000.0, 1000000.0), spans)
+        # arrow from the straggler of prerequisite marker
+        flows = [(i['ph'], i['tid'], i['ts']) for i in trace
+                 if i['ph'] in ('s', 'f')]
+        self.assertEqual(flows, [('s', 2, 1999999.0), ('f', 1, 2000000.0)])
+
+    def test_metrics_exporter(self):
+        """[Utils] Test Prometheus textfile metrics exporter"""
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'kanzo.prom')
+        exporter = metrics.MetricsExporter(path, interval=0.01)
+        for event in (
+                {'type': 'ssh', 'start': 0.0, 'end': 0.02, 'rc': 0},
+                {'type': 'ssh', 'start': 0.0, 'end': 3.0, 'rc': 1},
+                {'type': 'reconnect', 'start': 1.0, 'end': 1.0},
+                {'type': 'transfer', 'start': 0.0, 'end': 2.0, 'bytes': 2048,
+                 'direction': 'send'},
+                {'type': 'queue', 'start': 0.0, 'end': 0.0, 'ready': 3,
+                 'waiting': 4},
+                {'type': 'health', 'name': 'open', 'start': 0.0, 'end': 0.0,
+                 'host': '10.0.0.1'},
+            ):
+            exporter(event)
+        try:
+            exporter.start()
+            gevent.sleep(0.05)
+            self.assertTrue(os.path.exists(path))
+            exporter.stop()
+            with open(path) as textfile:
+                content = textfile.read().splitlines()
+            # temporary files are renamed to the textfile
+            self.assertEqual(os.listdir(tmpdir), ['kanzo.prom'])
+        finally:
+            shutil.rmtree(tmpdir)
+        for line in (
+                '# TYPE kanzo_ssh_command_duration_seconds histogram',
+                'kanzo_ssh_command_duration_seconds_bucket{le="0.025"} 1.0',
+                'kanzo_ssh_command_duration_seconds_bucket{le="+Inf"} 2.0',
+                'kanzo_ssh_command_duration_seconds_count 2.0',
+                'kanzo_ssh_command_failures_total 1.0',
+                'kanzo_ssh_reconnects_total 1.0',
+                'kanzo_transfer_bytes_total{direction="send"} 2048.0',
+                'kanzo_markers{state="ready"} 3.0',
+                'kanzo_host_down{host="10.0.0.1"} 1.0',
+            ):
+            self.assertIn(line, content)
+
+    def test_profiling(self):
+        """[Utils] Test greenlet aware profiling"""
+        def busy():
+            return sum(range(100000))
+
+        def child_run():
+            busy()
+            greenlet.getcurrent().parent.switch()
+            busy()
+
+        def waiter(child):
+            child.switch()
+
+        tmpdir = tempfile.mkdtemp()
+        output = io.StringIO()
+        try:
+            with profiling.profiled('test', tmpdir, backend='cprofile',
+                                    top=5, stream=output) as path:
+                child = greenlet.greenlet(child_run)
+                waiter(child)
+                waiter(child)
+            stats = pstats.Stats(path)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertIn('Profile of test saved to', output.getvalue())
+        functions = dict(
+            (key[2], value) for key, value in stats.stats.items()
+        )
+        # busy() was called twice from child greenlet and never from waiter
+        callers = functions['busy'][4]
+        self.assertEqual(
+            set(key[2] for key in callers), {'child_run'}
+        )
+        self.assertEqual(functions['busy'][1], 2)
+        self.assertEqual(functions['waiter'][1], 2)
+        self.assertRaises(ValueError, profiling.get_profiler, 'unknown')
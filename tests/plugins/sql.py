@@ -111,6 +111,14 @@ RESOURCES = []
 # info - empty dictionary
 # messages - list for messages generated by step which can be presented to user
 #            in final application
+# Steps doing CPU heavy or blocking work should be decorated by
+# kanzo.utils.decorators.execution('cpu') or execution('blocking'), so that
+# they are run in process or thread pool and do not block other hosts.
+# By default step starts on host after all preceding steps of the phase are
+# finished on that host. Steps decorated by decorators.independent do not wait
+# for preceding steps and steps decorated by decorators.requires(*steps) wait
+# only for given steps. Steps decorated by decorators.barrier wait until their
+# prerequisites are finished on all hosts.
 INITIALIZATION = [test_init]
 
 # List of callables (steps) which will run right before Puppet is run,